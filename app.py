@@ -1,59 +1,98 @@
 import sqlite3
 import streamlit as st
 import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+from datetime import timedelta
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
-import yaml
 import subprocess
 import os
+import json
+import time
+import urllib.request
+import uuid
+
+from archive import DustArchive
+from downsample import downsample
+from episodes import episode_summary
+from dust_store import (
+    DustDataCache,
+    SUMMARY_WINDOWS,
+    count_history,
+    export_history,
+    history_range,
+    list_tables,
+    query_history,
+    time_column,
+    time_window,
+)
+from metrics import histogram_delta, quantile
+from config_loader import load_config, threshold_lines
 
 
-# 讀取 YAML 配置文件
-def load_config(config_path="config.yaml"):
-    """讀取配置文件"""
-    with open(config_path, "r", encoding="utf-8") as file:
-        config = yaml.safe_load(file)
-    return config
-
-
-# HTML 自動刷新加載配置
+# 讀取 YAML 配置文件，每次重新執行只讀一次，檔案沒有修改時沿用已解析的結果
 config = load_config()
+
+# 即時更新設定
 refresh_interval = config["settings"]["refresh_interval"]
+live_update = config["settings"].get("live_update", True)
 
-# HTML 自動刷新 (每 10 秒刷新一次)
-st.markdown(
-    """
-    <meta http-equiv="refresh" content="{refresh_interval}">
-    """,
-    unsafe_allow_html=True
-)
+# 未開啟即時更新時沿用 HTML 自動刷新（整頁重新載入）
+if not live_update:
+    st.markdown(
+        f"""
+        <meta http-equiv="refresh" content="{refresh_interval}">
+        """,
+        unsafe_allow_html=True
+    )
 
 
 # 連接 SQLite 資料庫並取得資料
 
+@st.cache_resource
+def get_archive():
+    # 歸檔的檔案資訊快取在跨頁面重新執行時保留
+    return DustArchive.from_config(config)
+
+
+@st.cache_resource
+def get_data_cache(db_path="dust_data.db", table_name="dust_data"):
+    """所有分頁共用的增量資料快取"""
+    return DustDataCache(db_path, table_name)
+
+
 def load_data_from_sqlite(db_path="dust_data.db", table_name="dust_data"):
-    """從 SQLite 資料庫讀取資料"""
+    """從 SQLite 資料庫讀取最近的資料，只查詢上次之後新增的資料列"""
     try:
-        conn = sqlite3.connect(db_path)
-        query = f"SELECT * FROM {table_name}"
-        df = pd.read_sql(query, conn)
-        conn.close()
-        return df
+        return get_data_cache(db_path, table_name).refresh()
     except Exception as e:
         st.error(f"無法讀取資料庫: {e}")
         return pd.DataFrame({"Timestamp": [], "Dust_Level": []})
 
 
-# 載入資料
-df = load_data_from_sqlite()
-if not df.empty:
-    # st.success("成功從資料庫讀取資料！")
-    df["Timestamp"] = pd.to_datetime(df["Timestamp"])
-else:
-    st.warning("資料庫中沒有資料！")
+def memoize(name, key, compute):
+    """資料版本與參數都沒變時沿用上次的結果，不重新查詢"""
+    cached = st.session_state.get(name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    value = compute()
+    st.session_state[name] = (key, value)
+    return value
+
+
+EXPORT_FOLDER = "exports"
+EXPORT_MAX_AGE = 3600  # 匯出檔保留秒數，匯出中途中斷留下的檔案超過後刪除
+
+
+def cleanup_exports(max_age=EXPORT_MAX_AGE):
+    """刪除超過 max_age 秒的匯出檔"""
+    now = time.time()
+    for name in os.listdir(EXPORT_FOLDER):
+        path = os.path.join(EXPORT_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
 
 
 
@@ -87,7 +126,6 @@ st.subheader("產線：碼槽 BC6 硫磺產線")
 
 
 # 初始化警戒值
-config = load_config()
 default_yellow_line = config["thresholds"]["yellow_line"]
 default_red_line = config["thresholds"]["red_line"]
 
@@ -96,10 +134,8 @@ st.sidebar.header("調整警戒值")
 yellow_line = st.sidebar.slider("黃色警戒值", 0, 100, default_yellow_line)
 red_line = st.sidebar.slider("紅色警戒值", yellow_line, 100, default_red_line)
 
-# 警戒計算
-yellow_alerts = (df["Dust_Level"] > yellow_line).sum()
-red_alerts = (df["Dust_Level"] > red_line).sum()
-safe_alerts = len(df) - yellow_alerts
+# 統計區間
+summary_window = st.sidebar.selectbox("統計區間", SUMMARY_WINDOWS)
 
 # 初始化 Session State
 if "page" not in st.session_state:
@@ -115,139 +151,223 @@ with st.sidebar:
     if st.button("歷史資料"):
         st.session_state.page = "歷史資料"
 
+    if st.button("系統效能"):
+        st.session_state.page = "系統效能"
 
 
 
 
 
-# 第零個區塊：即時紅綠燈顯示
-st.markdown('<div class="custom-block">', unsafe_allow_html=True)
-st.markdown('<div class="custom-title">即時粉塵狀態</div>', unsafe_allow_html=True)
 
-if not df.empty:
-    # 獲取最新的粉塵數據
-    latest_dust_level = df["Dust_Level"].iloc[-1]
+def render_live_panel():
+    """即時區塊：紅綠燈、統計與時間序列圖，即時更新時只有這個區塊會定時重新執行"""
+    # 載入資料
+    df = load_data_from_sqlite()
+    if df.empty:
+        st.warning("資料庫中沒有資料！")
+    data_version = get_data_cache().version
 
-    # 確定當前狀態
-    if latest_dust_level > red_line:
-        current_status = "危險"
-        color = "red"
-    elif latest_dust_level > yellow_line:
-        current_status = "警告"
-        color = "orange"
+    # 警戒計算（在資料庫端依統計區間計算，不需載入全部資料）
+    summary_start, summary_end = time_window(
+        summary_window,
+        shift_starts=config.get("summary", {}).get("shift_starts", ["08:00", "20:00"]))
+    try:
+        band_counts = memoize(
+            "band_counts",
+            (data_version, summary_window, summary_start.strftime("%Y-%m-%d %H:%M"),
+             yellow_line, red_line),
+            lambda: get_data_cache().band_counts(
+                summary_start, summary_end, yellow_line, red_line))
+    except Exception as e:
+        st.error(f"無法讀取資料庫: {e}")
+        band_counts = {"安全": 0, "警告": 0, "危險": 0, "總數": 0}
+    safe_alerts = band_counts["安全"]
+    yellow_alerts = band_counts["警告"] + band_counts["危險"]
+    red_alerts = band_counts["危險"]
+
+    # 第零個區塊：即時紅綠燈顯示
+    st.markdown('<div class="custom-block">', unsafe_allow_html=True)
+    st.markdown('<div class="custom-title">即時粉塵狀態</div>', unsafe_allow_html=True)
+
+    if not df.empty:
+        # 狀態燈由寫入端偵測的進行中警報事件決定（超過 config.yaml 警戒值且持續 min_duration 秒以上），
+        # 事件的峰值再依側欄的警戒值分級；側欄低於 config.yaml 黃線的部分不會產生事件
+        episodes_config = config.get("episodes", {})
+        episodes = get_data_cache().open_episodes(
+            episodes_config.get("max_gap", 120) + episodes_config.get("update_interval", 10))
+        if episodes is not None:
+            alarm_level = max(
+                (peak for _, level, _, peak in episodes if level in ("yellow", "red")), default=0.0)
+        else:
+            # 舊資料庫還沒有事件表時沿用最新一筆讀數判斷
+            alarm_level = df["Dust_Level"].iloc[-1]
+
+        # 確定當前狀態
+        if alarm_level > red_line:
+            current_status = "危險"
+            color = "red"
+        elif alarm_level > yellow_line:
+            current_status = "警告"
+            color = "orange"
+        else:
+            current_status = "安全"
+            color = "green"
+
+        # 顯示紅綠燈
+        st.markdown(
+            f"""
+            <style>
+            .status-indicator {{
+                display: flex;
+                justify-content: center;
+                align-items: center;
+                height: 75px;
+                background-color: {color};
+                color: white;
+                font-size: 22px;
+                font-weight: bold;
+                border-radius: 8px;
+            }}
+            </style>
+            <div class="status-indicator">
+                {current_status}
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+        if episodes:
+            episode_yellow, episode_red = threshold_lines(config)
+            st.caption(
+                f"進行中的警報事件（config.yaml 警戒值 {episode_yellow}/{episode_red}，"
+                f"持續 {episodes_config.get('min_duration', 30)} 秒以上）")
+            level_names = {"yellow": "警告", "red": "危險", "rate": "快速上升"}
+            for camera_id, level, started, peak in episodes:
+                st.caption(f"{camera_id or '攝影機'} {level_names.get(level, level)}：{started} 起，峰值 {peak:.1f}")
     else:
-        current_status = "安全"
-        color = "green"
-
-    # 顯示紅綠燈
-    st.markdown(
-        f"""
-        <style>
-        .status-indicator {{
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            height: 75px;
-            background-color: {color};
-            color: white;
-            font-size: 22px;
-            font-weight: bold;
-            border-radius: 8px;
-        }}
-        </style>
-        <div class="status-indicator">
-            {current_status}
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
-else:
-    st.warning("目前無法顯示即時狀態，因為資料庫中沒有數據！")
-
-st.markdown('</div>', unsafe_allow_html=True)
-
-# 第一個區塊：圓餅圖與表格
-st.markdown('<div class="custom-block">', unsafe_allow_html=True)
-st.markdown('<div class="custom-title">本日粉塵安全度總覽</div>',
-            unsafe_allow_html=True)
-
-# 圓餅圖
-col1, col2 = st.columns(2)
-
-with col1:
-    # 設定圖表大小
-    fig = go.Figure(make_subplots(
-        rows=1, cols=1, specs=[[{'type': 'domain'}]]
-    ))
-    fig.add_trace(go.Pie(
-        labels=["安全", "警告", "危險"],
-        values=[safe_alerts, yellow_alerts - red_alerts, red_alerts],
-        hole=.5,
-        marker_colors=["green", "orange", "red"]
-    ))
-    fig.update_traces(hoverinfo='label+percent',
-                      textinfo='label', textfont_size=14)
-    fig.update_layout(
-        width=400,  # 圖表寬度
-        height=400  # 圖表高度
-    )
-    st.plotly_chart(fig, use_container_width=False)  # 禁用自動調整寬度
-
-with col2:
-    # 表格內容與樣式
-    table_data = pd.DataFrame({
-        "狀態": ["危險", "警告", "安全"],
-        "觸發次數": [red_alerts, yellow_alerts - red_alerts, safe_alerts]
-    })
-    st.markdown("""
-        <style>
-        .custom-table {
-            border-collapse: collapse;
-            width: 100%;
-            height: 400px; /* 與圖表高度對齊 */
-            display: flex; /* 使用 flex 布局 */
-            justify-content: center; /* 水平居中 */
-            align-items: center; /* 垂直居中 */
-        }
-        .custom-table th, .custom-table td {
-            border: 1px solid #ddd;
-            padding: 8px;
-            text-align: center;
-        }
-        .custom-table th {
-            background-color: #f2f2f2;
-            font-weight: bold;
-        }
-        </style>
-    """, unsafe_allow_html=True)
-    st.markdown(
-        f'<div class="custom-table">{table_data.to_html(index=False)}</div>',
-        unsafe_allow_html=True
-    )
-
-
-# 第二個區塊：時間序列圖
-st.markdown('<div class="custom-block">', unsafe_allow_html=True)
-st.markdown('<div class="custom-title">粉塵隨時間變化</div>', unsafe_allow_html=True)
-
-if not df.empty:
-    filtered_df = df.tail(360)
-    fig, ax = plt.subplots(figsize=(12, 6))
-    ax.plot(filtered_df["Timestamp"], filtered_df["Dust_Level"],
-            label="Dust Level", linewidth=1)
-    ax.axhline(y=yellow_line, color='yellow', linestyle='--',
-               label=f'Yellow Warning Line ({yellow_line})')
-    ax.axhline(y=red_line, color='red', linestyle='--',
-               label=f'Red Warning Line ({red_line})')
-    ax.set_title("Dust Level Change for the Last 1 hour", fontsize=14)
-    ax.set_xlabel("Time", fontsize=12)
-    ax.set_ylabel("Dust Level", fontsize=12)
-    ax.legend()
-    ax.grid(True, linestyle='--', alpha=0.7)
-    plt.xticks(rotation=45, fontsize=10)
-    st.pyplot(fig)
-
-st.markdown('</div>', unsafe_allow_html=True)
+        st.warning("目前無法顯示即時狀態，因為資料庫中沒有數據！")
+
+    st.markdown('</div>', unsafe_allow_html=True)
+
+    # 第一個區塊：圓餅圖與表格
+    st.markdown('<div class="custom-block">', unsafe_allow_html=True)
+    st.markdown(f'<div class="custom-title">{summary_window}粉塵安全度總覽</div>',
+                unsafe_allow_html=True)
+
+    # 圓餅圖
+    col1, col2 = st.columns(2)
+
+    with col1:
+        # 設定圖表大小
+        fig = go.Figure(make_subplots(
+            rows=1, cols=1, specs=[[{'type': 'domain'}]]
+        ))
+        fig.add_trace(go.Pie(
+            labels=["安全", "警告", "危險"],
+            values=[safe_alerts, yellow_alerts - red_alerts, red_alerts],
+            hole=.5,
+            marker_colors=["green", "orange", "red"]
+        ))
+        fig.update_traces(hoverinfo='label+percent',
+                          textinfo='label', textfont_size=14)
+        fig.update_layout(
+            width=400,  # 圖表寬度
+            height=400  # 圖表高度
+        )
+        st.plotly_chart(fig, use_container_width=False)  # 禁用自動調整寬度
+
+    with col2:
+        # 表格內容與樣式
+        table_data = pd.DataFrame({
+            "狀態": ["危險", "警告", "安全"],
+            "觸發次數": [red_alerts, yellow_alerts - red_alerts, safe_alerts]
+        })
+        st.markdown("""
+            <style>
+            .custom-table {
+                border-collapse: collapse;
+                width: 100%;
+                height: 400px; /* 與圖表高度對齊 */
+                display: flex; /* 使用 flex 布局 */
+                justify-content: center; /* 水平居中 */
+                align-items: center; /* 垂直居中 */
+            }
+            .custom-table th, .custom-table td {
+                border: 1px solid #ddd;
+                padding: 8px;
+                text-align: center;
+            }
+            .custom-table th {
+                background-color: #f2f2f2;
+                font-weight: bold;
+            }
+            </style>
+        """, unsafe_allow_html=True)
+        st.markdown(
+            f'<div class="custom-table">{table_data.to_html(index=False)}</div>',
+            unsafe_allow_html=True
+        )
+
+
+    # 第二個區塊：時間序列圖
+    st.markdown('<div class="custom-block">', unsafe_allow_html=True)
+    st.markdown('<div class="custom-title">粉塵隨時間變化</div>', unsafe_allow_html=True)
+
+    # 1 小時使用原始資料，較長的區間改讀彙總表；點數超過上限時在伺服器端降採樣
+    chart_windows = {
+        "1 小時": (timedelta(hours=1), None),
+        "24 小時": (timedelta(hours=24), "minute"),
+        "7 天": (timedelta(days=7), "hour"),
+    }
+    max_points = config.get("chart", {}).get("max_points", 500)
+
+    if not df.empty:
+        chart_window = st.radio("顯示區間", list(chart_windows), horizontal=True)
+        window, level = chart_windows[chart_window]
+        # 以最新一筆資料的時間為區間終點
+        chart_end = df["Timestamp"].iloc[-1]
+        chart_start = chart_end - window
+
+        fig = go.Figure()
+        if level is None:
+            filtered_df = df[df["Timestamp"] >= chart_start]
+            filtered_df = downsample(filtered_df, "Timestamp", "Dust_Level", max_points)
+            fig.add_trace(go.Scatter(x=filtered_df["Timestamp"], y=filtered_df["Dust_Level"],
+                                     mode="lines", name="Dust Level", line=dict(width=1)))
+        else:
+            try:
+                trend_df = memoize(
+                "trend",
+                (data_version, level, chart_start, chart_end),
+                lambda: get_data_cache().trend(level, chart_start, chart_end))
+            except Exception as e:
+                st.warning(f"無法讀取彙總表，請先執行 python rollup.py：{e}")
+                trend_df = pd.DataFrame({"Timestamp": [], "Mean": [], "Max": []})
+            mean_df = downsample(trend_df, "Timestamp", "Mean", max_points)
+            max_df = downsample(trend_df, "Timestamp", "Max", max_points, method="minmax")
+            fig.add_trace(go.Scatter(x=mean_df["Timestamp"], y=mean_df["Mean"],
+                                     mode="lines", name="Mean", line=dict(width=1)))
+            fig.add_trace(go.Scatter(x=max_df["Timestamp"], y=max_df["Max"],
+                                     mode="lines", name="Max",
+                                     line=dict(width=1, dash="dot", color="gray")))
+        fig.add_hline(y=yellow_line, line_dash="dash", line_color="yellow",
+                      annotation_text=f"Yellow Warning Line ({yellow_line})")
+        fig.add_hline(y=red_line, line_dash="dash", line_color="red",
+                      annotation_text=f"Red Warning Line ({red_line})")
+        fig.update_layout(
+            title=f"Dust Level Change for the Last {chart_window}",
+            xaxis_title="Time",
+            yaxis_title="Dust Level",
+            height=500,
+        )
+        st.plotly_chart(fig, use_container_width=True)
+
+    st.markdown('</div>', unsafe_allow_html=True)
+
+
+# 即時更新時以 fragment 定時重新執行即時區塊，其餘區塊不會重算
+if live_update:
+    render_live_panel = st.fragment(run_every=refresh_interval)(render_live_panel)
+render_live_panel()
 
 
 # "調整設定"頁面部分
@@ -273,6 +393,64 @@ if st.session_state.page == "調整設定":
     else:
         st.error("配置文件不存在！請確認路徑是否正確。")
 
+def label_text(labels):
+    return ", ".join(f"{k}={v}" for k, v in sorted(labels.items()))
+
+
+def render_metrics_panel():
+    """系統效能：各步驟的耗時分位數與處理量，以兩次抓取之間的差值計算最近一段時間的數值"""
+    metrics_url = (config.get("metrics") or {}).get(
+        "url", "http://127.0.0.1:9108/metrics.json")
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=1) as response:
+            snapshot = json.loads(response.read().decode("utf-8"))
+    except Exception as e:
+        st.warning(f"無法讀取分析程式的效能指標（{metrics_url}）：{e}")
+        return
+
+    # 上一次快照至少保留 refresh_interval 秒，避免手動操作重新執行時區間太短
+    previous = st.session_state.get("metrics_snapshot")
+    if previous is None or snapshot["time"] - previous["time"] >= refresh_interval:
+        st.session_state.metrics_snapshot = snapshot
+    elapsed = snapshot["time"] - previous["time"] if previous is not None else 0
+    previous_histograms = {}
+    if previous is not None:
+        previous_histograms = {
+            (h["name"], label_text(h["labels"])): h for h in previous["histograms"]}
+
+    rows = []
+    for histogram in snapshot["histograms"]:
+        labels = label_text(histogram["labels"])
+        recent = histogram_delta(histogram, previous_histograms.get((histogram["name"], labels)))
+        p50, p99 = quantile(recent, 0.5), quantile(recent, 0.99)
+        rows.append({
+            "指標": histogram["name"],
+            "標籤": labels,
+            "次數/秒": recent["count"] / elapsed if elapsed > 0 else None,
+            "p50 (ms)": p50 * 1000 if p50 is not None else None,
+            "p99 (ms)": p99 * 1000 if p99 is not None else None,
+            "平均 (ms)": 1000 * recent["sum"] / recent["count"] if recent["count"] else None,
+            "累計次數": histogram["count"],
+        })
+    st.markdown(f"**各步驟耗時**（最近 {elapsed:.0f} 秒）" if elapsed > 0 else "**各步驟耗時**（累計）")
+    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+    states = [
+        {"指標": entry["name"], "標籤": label_text(entry["labels"]), "數值": entry["value"]}
+        for entry in snapshot["counters"] + snapshot["gauges"]
+    ]
+    st.markdown("**計數與狀態**")
+    st.dataframe(pd.DataFrame(states), use_container_width=True, hide_index=True)
+
+
+# "系統效能"頁面部分
+if st.session_state.page == "系統效能":
+    st.header("系統效能")
+    if live_update:
+        st.fragment(run_every=refresh_interval)(render_metrics_panel)()
+    else:
+        render_metrics_panel()
+
 # "歷史資料"頁面部分
 if st.session_state.page == "歷史資料":
     st.markdown("<div class=\"custom-block\">", unsafe_allow_html=True)
@@ -288,48 +466,86 @@ if st.session_state.page == "歷史資料":
             st.success("成功連接資料庫！")
 
             # 顯示資料表列表
-            query = "SELECT name FROM sqlite_master WHERE type='table';"
-            tables = pd.read_sql(query, conn)
+            tables = list_tables(conn)
 
-            if not tables.empty:
-                table_name = st.selectbox("選擇資料表", tables["name"])
+            if tables:
+                table_name = st.selectbox("選擇資料表", tables)
 
-                # 查詢選定的資料表
+                # 查詢選定的資料表（資料表名稱經過驗證，日期條件在 SQL 端過濾）
                 if table_name:
-                    query = f"SELECT * FROM {table_name}"
-                    data = pd.read_sql(query, conn)
-
-                    if not data.empty:
-                        # 確保 Timestamp 欄位正確轉換為 datetime 格式
-                        if "Timestamp" in data.columns:
-                            data["Timestamp"] = pd.to_datetime(data["Timestamp"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
-                            if data["Timestamp"].isna().any():
-                                st.warning("部分 Timestamp 資料無法解析，請檢查資料格式！")
-                            
+                    # 主資料庫的原始資料表同時查詢已移到 Parquet 的歸檔
+                    archive = get_archive()
+                    if not archive.covers(db_path, table_name):
+                        archive = None
+                    elif archive.partitions():
+                        st.caption(f"包含 {archive.folder} 中已歸檔的資料")
+                    first, last = history_range(conn, table_name, archive)
+                    start = end = None
+
+                    if first is not None:
                         # 日期篩選
                         col1, col2 = st.columns(2)
                         with col1:
-                            start_date = st.date_input("選擇起始日期", value=data["Timestamp"].min().date() if "Timestamp" in data.columns and not data["Timestamp"].isna().all() else None)
+                            start_date = st.date_input("選擇起始日期", value=first.date())
                         with col2:
-                            end_date = st.date_input("選擇結束日期", value=data["Timestamp"].max().date() if "Timestamp" in data.columns and not data["Timestamp"].isna().all() else None)
-
-                        if "Timestamp" in data.columns and not data["Timestamp"].isna().all():
-                            filtered_data = data[(data["Timestamp"] >= pd.Timestamp(start_date)) & (data["Timestamp"] <= pd.Timestamp(end_date)+timedelta(seconds=86400))]
-                        else:
-                            st.warning("選擇的資料表中不包含有效的 'Timestamp' 欄位，無法進行日期篩選！")
-                            filtered_data = data
-
-                        # 顯示篩選後的數據
+                            end_date = st.date_input("選擇結束日期", value=last.date())
+                        start = pd.Timestamp(start_date)
+                        end = pd.Timestamp(end_date) + timedelta(days=1)
+                    elif time_column(conn, table_name) is None:
+                        st.warning("選擇的資料表中不包含有效的 'Timestamp' 欄位，無法進行日期篩選！")
+
+                    total_rows = count_history(conn, table_name, start, end, archive)
+
+                    if table_name == "alarm_episodes" and total_rows > 0:
+                        # 安全報表：各等級的事件數與持續時間，直接由事件表統計
+                        summary = pd.DataFrame(
+                            episode_summary(conn, start, end),
+                            columns=["等級", "事件數", "總持續秒數", "最長持續秒數", "最高峰值"])
+                        summary["等級"] = summary["等級"].map(
+                            {"yellow": "警告", "red": "危險", "rate": "快速上升"}).fillna(summary["等級"])
+                        st.dataframe(summary, use_container_width=True, hide_index=True)
+
+                    if total_rows > 0:
+                        # 分頁顯示篩選後的數據
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            page_size = st.selectbox("每頁筆數", [100, 500, 1000], index=1)
+                        page_count = (total_rows - 1) // page_size + 1
+                        with col2:
+                            page = st.number_input(
+                                f"頁數（共 {page_count} 頁，{total_rows} 筆）",
+                                min_value=1, max_value=page_count, value=1)
+                        filtered_data = query_history(
+                            conn, table_name, start, end,
+                            limit=page_size, offset=(page - 1) * page_size, archive=archive)
                         st.dataframe(filtered_data, use_container_width=True)
 
-                        # CSV 文件下載
-                        csv = filtered_data.to_csv(index=False).encode('utf-8')
-                        st.download_button(
-                            label="下載篩選後的數據為 CSV",
-                            data=csv,
-                            file_name=f"{table_name}_filtered.csv",
-                            mime="text/csv"
-                        )
+                        # 檔案匯出：分塊寫入每個工作階段各自的暫存檔，查詢時不在記憶體中組出整份資料
+                        # st.download_button 會把整個檔案讀進記憶體交給瀏覽器，所以只在按下「產生匯出檔」
+                        # 的這次執行顯示一次，讀取後立即刪除暫存檔；之後任何操作都需重新產生。
+                        # 極大的區間請改用 dust_store.export_history 或 archive.py 直接輸出檔案
+                        file_format = st.radio("匯出格式", ["csv", "parquet"], horizontal=True)
+                        if st.button("產生匯出檔"):
+                            os.makedirs(EXPORT_FOLDER, exist_ok=True)
+                            cleanup_exports()
+                            export_path = os.path.join(
+                                EXPORT_FOLDER, f"{table_name}_{uuid.uuid4().hex}.{file_format}")
+                            try:
+                                with st.spinner("匯出中..."):
+                                    export_history(conn, table_name, export_path,
+                                                   start, end, file_format=file_format,
+                                                   archive=archive)
+                                with open(export_path, "rb") as export_file:
+                                    st.download_button(
+                                        label=f"下載篩選後的數據為 {file_format.upper()}",
+                                        data=export_file,
+                                        file_name=f"{table_name}_filtered.{file_format}",
+                                        mime="text/csv" if file_format == "csv"
+                                        else "application/octet-stream"
+                                    )
+                            finally:
+                                if os.path.exists(export_path):
+                                    os.remove(export_path)
                     else:
                         st.warning("該資料表中沒有數據！")
                 else:
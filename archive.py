@@ -0,0 +1,318 @@
+import argparse
+import glob
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from config_loader import file_version, load_config
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+PARTITIONS = ("day", "month")
+
+
+def _pyarrow():
+    # pyarrow 只有歸檔與讀取歸檔時才需要
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    return pa, pq
+
+
+def _text(moment):
+    return moment.strftime(TIMESTAMP_FORMAT)
+
+
+class DustArchive(object):
+    """把已結束的日（或月）的原始讀數移到依時間分割、zstd 壓縮的 Parquet 檔，SQLite 只保留最近 hot_days 天
+
+    檔案為 <folder>/<資料表>/<年-月>/<年-月-日>.parquet（partition 為 month 時為 <folder>/<資料表>/<年-月>.parquet），
+    每個檔案內依 Timestamp 排序；查詢與匯出經由 dust_store 的 history 函式同時讀取歸檔與 SQLite
+    """
+
+    def __init__(self, folder="archive", db_file="dust_data.db", table_name="dust_data",
+                 partition="day", hot_days=30, retention_days=0, row_group_size=100000):
+        # hot_days: SQLite 保留最近幾天的原始讀數，儀表板的即時資料來自這裡，至少 1 天
+        # retention_days: 歸檔保留天數，0 為永久保留
+        if partition not in PARTITIONS:
+            raise ValueError("partition 只能是 day 或 month：{}".format(partition))
+        if hot_days < 1:
+            raise ValueError("hot_days 至少為 1")
+        self.folder = folder
+        self.db_file = db_file
+        self.table_name = table_name
+        self.partition = partition
+        self.hot_days = hot_days
+        self.retention_days = retention_days
+        self.row_group_size = row_group_size
+        self.lock = threading.Lock()
+        self.info_cache = {}
+
+    @classmethod
+    def from_config(cls, config_dict, table_name="dust_data"):
+        archive_config = config_dict.get("archive") or {}
+        return cls(
+            archive_config.get("folder", "archive"),
+            archive_config.get("db_file", "dust_data.db"),
+            table_name,
+            archive_config.get("partition", "day"),
+            archive_config.get("hot_days", 30),
+            archive_config.get("retention_days", 0),
+        )
+
+    def covers(self, db_path, table_name):
+        """db_path 的 table_name 是否為此歸檔的來源"""
+        return table_name == self.table_name and (
+            os.path.abspath(db_path) == os.path.abspath(self.db_file)
+        )
+
+    # ---- 分割 ----
+
+    def bounds(self, moment):
+        """moment 所在分割的 (起, 迄)"""
+        start = datetime(moment.year, moment.month, 1 if self.partition == "month" else moment.day)
+        if self.partition == "day":
+            return start, start + timedelta(days=1)
+        if start.month == 12:
+            return start, start.replace(year=start.year + 1, month=1)
+        return start, start.replace(month=start.month + 1)
+
+    def path(self, start):
+        table_folder = os.path.join(self.folder, self.table_name)
+        if self.partition == "month":
+            return os.path.join(table_folder, start.strftime("%Y-%m") + ".parquet")
+        return os.path.join(table_folder, start.strftime("%Y-%m"), start.strftime("%Y-%m-%d") + ".parquet")
+
+    def partitions(self, start=None, end=None):
+        """已歸檔的 [(起, 迄, 路徑)]，依時間排序；start/end 只回傳與區間重疊的分割
+
+        改過 partition 設定後新舊兩種檔案可以並存
+        """
+        table_folder = os.path.join(self.folder, self.table_name)
+        found = []
+        for path in glob.glob(os.path.join(glob.escape(table_folder), "**", "*.parquet"), recursive=True):
+            name = os.path.basename(path)[: -len(".parquet")]
+            try:
+                if len(name) == 7:
+                    first = datetime.strptime(name, "%Y-%m")
+                    last = (first + timedelta(days=32)).replace(day=1)
+                else:
+                    first = datetime.strptime(name, "%Y-%m-%d")
+                    last = first + timedelta(days=1)
+            except ValueError:
+                continue
+            if (start is None or last > start) and (end is None or first < end):
+                found.append((first, last, path))
+        return sorted(found)
+
+    def info(self, path):
+        """檔案的筆數與最早、最晚時間，由 Parquet 中繼資料取得不讀取資料，檔案沒有改變時使用快取"""
+        version = file_version(path)
+        with self.lock:
+            entry = self.info_cache.get(path)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+        _, pq = _pyarrow()
+        metadata = pq.read_metadata(path)
+        extra = metadata.metadata or {}
+        info = {
+            "rows": metadata.num_rows,
+            "first": extra.get(b"first", b"").decode() or None,
+            "last": extra.get(b"last", b"").decode() or None,
+        }
+        with self.lock:
+            self.info_cache[path] = (version, info)
+        return info
+
+    # ---- 歸檔與保留 ----
+
+    def cutoff(self, now=None):
+        """早於此時間的資料可以歸檔（今天 0 點往前 hot_days 天）"""
+        now = now or datetime.now()
+        return now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=self.hot_days)
+
+    def pending(self, conn, now=None):
+        """SQLite 中可以歸檔的分割 [(起, 迄)]，只包含整段都早於 cutoff 的分割"""
+        quoted = '"{}"'.format(self.table_name.replace('"', '""'))
+        cutoff = self.cutoff(now)
+        result = []
+        first = conn.execute('SELECT MIN("Timestamp") FROM {}'.format(quoted)).fetchone()[0]
+        while first is not None:
+            start, end = self.bounds(datetime.strptime(first[:19], TIMESTAMP_FORMAT))
+            if end > cutoff:
+                break
+            result.append((start, end))
+            # 經由索引跳到下一筆資料所在的分割，中間沒有資料的日子不用逐日檢查
+            first = conn.execute(
+                'SELECT MIN("Timestamp") FROM {} WHERE "Timestamp" >= ?'.format(quoted), (_text(end),)
+            ).fetchone()[0]
+        return result
+
+    def _to_table(self, df):
+        pa, _ = _pyarrow()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # 整欄為空值（例如沒有 Camera_ID）時型別未知，與匯出相同改用字串欄位
+        return table.cast(pa.schema([
+            field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+            for field in table.schema
+        ]))
+
+    def _write(self, table, path):
+        pa, pq = _pyarrow()
+        table = table.sort_by("Timestamp")
+        timestamps = table.column("Timestamp")
+        table = table.replace_schema_metadata({
+            "first": str(timestamps[0]),
+            "last": str(timestamps[-1]),
+        })
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        pq.write_table(table, temp_path, compression="zstd", row_group_size=self.row_group_size)
+        os.replace(temp_path, path)
+
+    def archive_partition(self, conn, start, end):
+        """把 [start, end) 的原始讀數寫入 Parquet 後從 SQLite 刪除，回傳筆數
+
+        分割已有歸檔檔案（之後補進的舊資料）時合併後重寫；只刪除讀取時已存在的資料列，
+        歸檔期間寫入器新增的資料留到下次處理
+        """
+        pa, pq = _pyarrow()
+        quoted = '"{}"'.format(self.table_name.replace('"', '""'))
+        max_rowid = conn.execute("SELECT MAX(rowid) FROM {}".format(quoted)).fetchone()[0]
+        if max_rowid is None:
+            return 0
+        where = ' WHERE "Timestamp" >= ? AND "Timestamp" < ? AND rowid <= ?'
+        params = (_text(start), _text(end), max_rowid)
+        df = pd.read_sql_query("SELECT * FROM {}{}".format(quoted, where), conn, params=params)
+        if df.empty:
+            return 0
+
+        table = self._to_table(df)
+        path = self.path(start)
+        if os.path.exists(path):
+            existing = pq.read_table(path).replace_schema_metadata(None)
+            table = pa.concat_tables([existing, table.cast(existing.schema)])
+        self._write(table, path)
+
+        conn.execute("DELETE FROM {}{}".format(quoted, where), params)
+        conn.commit()
+        return len(df)
+
+    def expire(self, now=None):
+        """刪除超過 retention_days 的歸檔檔案，回傳刪除的路徑"""
+        if not self.retention_days:
+            return []
+        now = now or datetime.now()
+        limit = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=self.retention_days)
+        removed = []
+        for _, end, path in self.partitions():
+            if end <= limit:
+                os.remove(path)
+                removed.append(path)
+        return removed
+
+    def run(self, conn, now=None, dry_run=False):
+        """依保留政策歸檔並清理，回傳 {"partitions", "rows", "expired"}"""
+        result = {"partitions": 0, "rows": 0, "expired": []}
+        for start, end in self.pending(conn, now):
+            if dry_run:
+                quoted = '"{}"'.format(self.table_name.replace('"', '""'))
+                rows = conn.execute(
+                    'SELECT COUNT(*) FROM {} WHERE "Timestamp" >= ? AND "Timestamp" < ?'.format(quoted),
+                    (_text(start), _text(end)),
+                ).fetchone()[0]
+            else:
+                rows = self.archive_partition(conn, start, end)
+            print("{} {}: {} 筆".format("待歸檔" if dry_run else "已歸檔", start.date(), rows))
+            result["partitions"] += 1
+            result["rows"] += rows
+        if not dry_run:
+            result["expired"] = self.expire(now)
+            for path in result["expired"]:
+                print("已刪除過期歸檔：{}".format(path))
+        return result
+
+    # ---- 查詢 ----
+
+    def range(self):
+        """歸檔資料的最早與最晚時間，沒有歸檔時回傳 (None, None)"""
+        partitions = self.partitions()
+        if not partitions:
+            return None, None
+        return self.info(partitions[0][2])["first"], self.info(partitions[-1][2])["last"]
+
+    def _filters(self, start, end):
+        filters = []
+        if start is not None:
+            filters.append(("Timestamp", ">=", _text(start)))
+        if end is not None:
+            filters.append(("Timestamp", "<", _text(end)))
+        return filters or None
+
+    def _inside(self, first, last, start, end):
+        # 分割整段落在查詢區間內時筆數直接取自中繼資料
+        return (start is None or first >= start) and (end is None or last <= end)
+
+    def count(self, start=None, end=None):
+        _, pq = _pyarrow()
+        total = 0
+        for first, last, path in self.partitions(start, end):
+            if self._inside(first, last, start, end):
+                total += self.info(path)["rows"]
+            else:
+                total += pq.read_table(path, columns=["Timestamp"],
+                                       filters=self._filters(start, end)).num_rows
+        return total
+
+    def read(self, start=None, end=None):
+        """逐個分割回傳區間內的 DataFrame，欄位與 SQLite 資料表相同"""
+        _, pq = _pyarrow()
+        for _, _, path in self.partitions(start, end):
+            table = pq.read_table(path, filters=self._filters(start, end))
+            if table.num_rows:
+                yield table.replace_schema_metadata(None).to_pandas()
+
+    def page(self, start=None, end=None, limit=500, offset=0):
+        """依時間排序的第 offset 筆起 limit 筆，只讀取涵蓋該頁的分割"""
+        _, pq = _pyarrow()
+        frames = []
+        for first, last, path in self.partitions(start, end):
+            if limit <= 0:
+                break
+            if self._inside(first, last, start, end):
+                rows = self.info(path)["rows"]
+                if offset >= rows:
+                    offset -= rows
+                    continue
+            table = pq.read_table(path, filters=self._filters(start, end))
+            if offset >= table.num_rows:
+                offset -= table.num_rows
+                continue
+            table = table.slice(offset, limit)
+            frames.append(table.replace_schema_metadata(None).to_pandas())
+            limit -= table.num_rows
+            offset = 0
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把 SQLite 中較舊的原始讀數移到 Parquet 歸檔並清理過期歸檔")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--table", default="dust_data")
+    parser.add_argument("--dry-run", action="store_true", help="只列出會歸檔的分割，不寫入也不刪除")
+    parser.add_argument("--vacuum", action="store_true", help="歸檔後 VACUUM，把刪除的空間還給檔案系統")
+    args = parser.parse_args()
+
+    archive = DustArchive.from_config(load_config(args.config), table_name=args.table)
+    conn = sqlite3.connect(archive.db_file, timeout=30)
+    try:
+        result = archive.run(conn, dry_run=args.dry_run)
+        print("{} 個分割、{} 筆".format(result["partitions"], result["rows"]))
+        if args.vacuum and not args.dry_run:
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
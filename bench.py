@@ -0,0 +1,424 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from config_loader import load_config, threshold_lines
+from db_writer import DustDBWriter
+from dust_cv import Dust_Monitor
+from dust_store import DustDataCache, count_history, history_range, query_history, time_window
+from metrics import histogram_delta, quantile, registry
+from replay import ReplayEngine, load_signal
+from rollup import DustRollup
+
+BENCH_CAMERA = "bench"
+
+
+def latency_summary(samples):
+    """每次耗時（秒）的統計，輸出單位為毫秒"""
+    samples = np.asarray(samples, dtype=np.float64) * 1000
+    if samples.size == 0:
+        return {"count": 0}
+    return {
+        "count": int(samples.size),
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "max_ms": float(samples.max()),
+    }
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return latency_summary(samples)
+
+
+def environment():
+    """比較不同版本、不同機器的結果時需要的環境資訊"""
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+
+# ---------- 影像分析 ----------
+
+
+def synthetic_frames(count, shape=(1080, 1920, 3), seed=0):
+    """模糊程度與亮度逐張變化的雜訊影像，模擬粉塵由少到多"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(count):
+        noise = rng.integers(0, 256, shape, dtype=np.uint8)
+        sigma = 1 + 6 * i / max(count - 1, 1)
+        frame = cv2.GaussianBlur(noise, (0, 0), sigma)
+        frames.append(cv2.convertScaleAbs(frame, alpha=1.0, beta=40 * i / max(count - 1, 1)))
+    return frames
+
+
+def load_fixture(source, limit):
+    """讀取測試影像，回傳 (影像清單, 每張解碼耗時)
+
+    source 為影片檔或串流網址、JPEG 資料夾（例如 save_image/），或 synthetic
+    """
+    if source == "synthetic":
+        return synthetic_frames(limit), []
+    frames, decode = [], []
+    if os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, "*.jpg")))[:limit]
+        if not paths:
+            raise ValueError("資料夾內沒有 JPEG：{}".format(source))
+        for path in paths:
+            with open(path, "rb") as f:
+                data = np.frombuffer(f.read(), dtype=np.uint8)
+            started = time.perf_counter()
+            frame = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            decode.append(time.perf_counter() - started)
+            frames.append(frame)
+    else:
+        cap = cv2.VideoCapture(source)
+        while len(frames) < limit:
+            started = time.perf_counter()
+            status, frame = cap.read()
+            if not status:
+                break
+            decode.append(time.perf_counter() - started)
+            frames.append(frame)
+        cap.release()
+        if not frames:
+            raise ValueError("無法讀取影片：{}".format(source))
+    return frames, decode
+
+
+class _FixtureReader(object):
+    # 以 LatestFrameReader 的介面輪流回傳預先載入的影像
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def read(self, timeout=None):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return True, frame
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return {"frames_read": self.index}
+
+    def pop_gaps(self):
+        return []
+
+
+class FixtureMonitor(Dust_Monitor):
+    """不連線串流、改讀取測試影像的 Dust_Monitor，其餘分析流程與正式執行相同"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        super().__init__(camera={"id": BENCH_CAMERA, "rtsp_url": None})
+
+    def open_stream(self, url):
+        return _FixtureReader(self.frames)
+
+
+def stage_histograms():
+    return {
+        h["labels"]["stage"]: h
+        for h in registry.snapshot()["histograms"]
+        if h["name"] == "stage_seconds" and h["labels"].get("camera") == BENCH_CAMERA
+    }
+
+
+def bench_vision(source, frames=1000, fixture_frames=30, warmup=20):
+    """process_frame（ROI、各影像指標、視窗平均）的每張耗時與吞吐量"""
+    fixture, decode = load_fixture(source, fixture_frames)
+    monitor = FixtureMonitor(fixture)
+    for _ in range(warmup):
+        monitor.process_frame(monitor.cap.read()[1])
+
+    before = stage_histograms()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(frames):
+        frame = monitor.cap.read()[1]
+        frame_started = time.perf_counter()
+        monitor.process_frame(frame)
+        samples.append(time.perf_counter() - frame_started)
+    elapsed = time.perf_counter() - started
+
+    stages = {}
+    for stage, histogram in stage_histograms().items():
+        recent = histogram_delta(histogram, before.get(stage))
+        if recent["count"]:
+            stages[stage] = {
+                "p50_ms": 1000 * quantile(recent, 0.5),
+                "p99_ms": 1000 * quantile(recent, 0.99),
+                "mean_ms": 1000 * recent["sum"] / recent["count"],
+            }
+    result = {
+        "source": source,
+        "resolution": list(fixture[0].shape),
+        "fixture_frames": len(fixture),
+        "metrics": list(monitor.analyzer.metrics),
+        "process_frame": dict(latency_summary(samples), fps=frames / elapsed),
+        "stages": stages,
+    }
+    if decode:
+        result["decode"] = dict(latency_summary(decode), fps=len(decode) / sum(decode))
+    return result
+
+
+# ---------- 寫入 ----------
+
+
+def bench_writer(folder, rows, rollup, engine):
+    db_file = os.path.join(folder, "writer_{}.db".format("rollup" if rollup else "plain"))
+    values = engine.generate(rows).tolist()
+    start = datetime.now() - timedelta(seconds=10 * rows)
+    stamps = [(start + timedelta(seconds=10 * i)).strftime("%Y-%m-%d %H:%M:%S") for i in range(rows)]
+    writer = DustDBWriter(db_file, batch_size=500, max_queue=rows + 1, rollup=rollup).start()
+    started = time.perf_counter()
+    writer.write_many(zip(stamps, values, [None] * rows))
+    writer.flush()
+    elapsed = time.perf_counter() - started
+    stats = writer.stats()
+    writer.close()
+    return {
+        "rows": rows,
+        "rows_per_s": stats["rows_written"] / elapsed,
+        "rows_dropped": stats["rows_dropped"],
+    }
+
+
+def bench_csv_ingest(folder, files, rows_per_file, config_path, engine):
+    """sqlite.py 匯入流程：解析 CSV 檔並與匯入紀錄在同一個交易寫入"""
+    from sqlite import CSVIngestor
+
+    csv_folder = os.path.join(folder, "csv")
+    os.makedirs(csv_folder)
+    start = datetime.now() - timedelta(seconds=10 * files * rows_per_file)
+    paths = []
+    for i in range(files):
+        path = os.path.join(csv_folder, "data_{:05d}.csv".format(i))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("Timestamp,Dust_Level\n")
+            for j, value in enumerate(engine.generate(rows_per_file)):
+                stamp = start + timedelta(seconds=10 * (i * rows_per_file + j))
+                f.write("{},{:.4f}\n".format(stamp.strftime("%Y-%m-%d %H:%M:%S"), value))
+        paths.append(path)
+
+    ingestor = CSVIngestor(csv_folder, os.path.join(folder, "csv.db"), config_path=config_path)
+    for path in paths:
+        ingestor.add_candidate(path)
+    started = time.perf_counter()
+    ingestor.ingest(paths)
+    ingestor.writer.flush()
+    elapsed = time.perf_counter() - started
+    ingestor.writer.close()
+    return {
+        "files": files,
+        "rows": files * rows_per_file,
+        "files_per_s": files / elapsed,
+        "rows_per_s": files * rows_per_file / elapsed,
+    }
+
+
+def bench_ingest(rows, csv_files, config, config_path, engine):
+    with tempfile.TemporaryDirectory() as folder:
+        return {
+            "writer": bench_writer(folder, rows, None, engine),
+            "writer_rollup": bench_writer(folder, rows, DustRollup.from_config(config), engine),
+            "csv": bench_csv_ingest(folder, csv_files, 10, config_path, engine),
+        }
+
+
+# ---------- 儀表板查詢 ----------
+
+
+def seed_database(seed_dir, rows, config, engine):
+    """以 replay 產生 rows 筆讀數（每 10 秒一筆）與彙總表，已存在且筆數相同時直接沿用"""
+    os.makedirs(seed_dir, exist_ok=True)
+    db_file = os.path.join(seed_dir, "seed_{}.db".format(rows))
+    if os.path.exists(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            if conn.execute('SELECT COUNT(*) FROM "dust_data"').fetchone()[0] == rows:
+                return db_file, None
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.close()
+        os.remove(db_file)
+    started = time.perf_counter()
+    engine.bulk_insert(db_file, rows, rollup=DustRollup.from_config(config))
+    return db_file, time.perf_counter() - started
+
+
+def bench_queries(db_file, repeat, config):
+    """儀表板各區塊實際使用的查詢，時間區間以資料庫內最後一筆為準"""
+    yellow_line, red_line = threshold_lines(config)
+    shift_starts = (config.get("summary") or {}).get("shift_starts", ("08:00", "20:00"))
+    conn = sqlite3.connect(db_file)
+    now = history_range(conn, "dust_data")[1].to_pydatetime()
+    month = (now - timedelta(days=30), now)
+
+    def cold_refresh():
+        cache = DustDataCache(db_file)
+        cache.refresh()
+        cache.close()
+
+    cache = DustDataCache(db_file)
+    cache.refresh()
+    results = {
+        "cache_cold": timed(cold_refresh, repeat),
+        "cache_unchanged": timed(cache.refresh, repeat),
+    }
+    for name, window in (("day", "本日"), ("shift", "本班"), ("hour", "最近一小時")):
+        start, end = time_window(window, now=now, shift_starts=shift_starts)
+        results["band_counts_" + name] = timed(
+            lambda: cache.band_counts(start, end, yellow_line, red_line), repeat
+        )
+    for level, days in (("minute", 1), ("hour", 30), ("day", 365)):
+        start = now - timedelta(days=days)
+        results["trend_{}_{}d".format(level, days)] = timed(
+            lambda: cache.trend(level, start, now), repeat
+        )
+    results["history_range"] = timed(lambda: history_range(conn, "dust_data"), repeat)
+    results["history_count_30d"] = timed(lambda: count_history(conn, "dust_data", *month), repeat)
+    results["history_page_first"] = timed(
+        lambda: query_history(conn, "dust_data", *month, limit=500), repeat
+    )
+    results["history_page_deep"] = timed(
+        lambda: query_history(conn, "dust_data", *month, limit=500, offset=200000), repeat
+    )
+    cache.close()
+    conn.close()
+    return results
+
+
+# ---------- 比較 ----------
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, tolerance=0.1):
+    """與先前的結果比較，耗時（_ms）越低越好、吞吐量（fps、_per_s）越高越好，回傳退步的項目"""
+    current, baseline = flatten(current), flatten(baseline)
+    regressions = []
+    for key, value in sorted(current.items()):
+        old = baseline.get(key)
+        if not old or key.startswith("environment."):
+            continue
+        if key.endswith(("p50_ms", "p99_ms")):
+            change = value / old - 1
+        elif key.endswith(("fps", "_per_s")):
+            change = old / value - 1 if value else float("inf")
+        else:
+            continue
+        flag = "退步" if change > tolerance else ""
+        print("{:<60} {:>12.4g} -> {:<12.4g} {:>+7.1%} {}".format(key, old, value, change, flag))
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def run(args):
+    config = load_config(args.config)
+    engine = ReplayEngine(load_signal(args.signal), seed=0)
+    results = {"environment": environment()}
+
+    if "vision" in args.only:
+        print("影像分析：{}".format(args.source))
+        results["vision"] = bench_vision(args.source, args.frames, args.fixture_frames, args.warmup)
+    if "ingest" in args.only:
+        print("寫入：{} 筆".format(args.ingest_rows))
+        results["ingest"] = bench_ingest(args.ingest_rows, args.csv_files, config, args.config, engine)
+    if "queries" in args.only:
+        results["queries"] = {}
+        for rows in args.rows:
+            print("儀表板查詢：{} 筆".format(rows))
+            db_file, seed_seconds = seed_database(args.seed_dir, rows, config, engine)
+            results["queries"][str(rows)] = dict(
+                bench_queries(db_file, args.repeat, config), seed_seconds=seed_seconds
+            )
+    return results
+
+
+if __name__ == "__main__":
+    default_source = "save_image" if glob.glob("save_image/*.jpg") else "synthetic"
+    parser = argparse.ArgumentParser(description="粉塵監控的效能基準測試，結果輸出為 JSON")
+    parser.add_argument("--only", nargs="+", default=["vision", "ingest", "queries"],
+                        choices=["vision", "ingest", "queries"])
+    parser.add_argument("--source", default=default_source,
+                        help="影片檔、JPEG 資料夾或 synthetic，預設為 save_image/")
+    parser.add_argument("--frames", type=int, default=1000, help="分析的影像張數")
+    parser.add_argument("--fixture-frames", type=int, default=30, help="預先載入並輪流使用的影像張數")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--ingest-rows", type=int, default=100000)
+    parser.add_argument("--csv-files", type=int, default=500)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000000, 10000000],
+                        help="查詢測試的資料庫筆數")
+    parser.add_argument("--repeat", type=int, default=20, help="每個查詢重複次數")
+    parser.add_argument("--seed-dir", default="bench_data", help="查詢測試資料庫的存放位置，重複執行時沿用")
+    parser.add_argument("--signal", default="params.pkl")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--output", default=None, help="結果 JSON，預設為 bench_results/<時間>_<版本>.json")
+    parser.add_argument("--compare", default=None, help="與先前的結果 JSON 比較")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="比較時超過此比例視為退步")
+    args = parser.parse_args()
+
+    results = run(args)
+    output = args.output
+    if output is None:
+        os.makedirs("bench_results", exist_ok=True)
+        output = os.path.join("bench_results", "{}_{}.json".format(
+            datetime.now().strftime("%Y%m%d-%H%M%S"), results["environment"]["commit"] or "unknown"))
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print("結果已寫入 {}".format(output))
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
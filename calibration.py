@@ -0,0 +1,196 @@
+import argparse
+import glob
+import os
+import re
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from config_loader import Calibration
+from frame_metrics import METRICS, FrameAnalyzer
+from roi import RoiMapper
+
+
+def robust_inliers(values, sigma=3.5):
+    """以中位數與 MAD 判斷離群值，|x - 中位數| 超過 sigma 倍（換算成標準差）者為離群"""
+    median = np.median(values)
+    deviation = np.abs(values - median)
+    # MAD 乘上 1.4826 後與常態分布的標準差相當；畫面完全不變時 MAD 為 0，只留與中位數相同的值
+    spread = 1.4826 * np.median(deviation)
+    return deviation <= max(sigma * spread, 1e-12 * max(abs(median), 1.0))
+
+
+class BaselineRecorder(object):
+    """收集 count 張 ROI 影像的直方圖與各指標值，寫入預先配置的陣列並累加直方圖總和
+
+    全部收集後剔除離群影像（鏡頭被遮擋、車輛經過、補光變化），其餘影像平均成新的基準
+    """
+
+    def __init__(self, count=140, reject_sigma=3.5, canny=(50, 150), min_inliers=0.5):
+        if count < 1:
+            raise ValueError("校正張數至少為 1")
+        self.count = count
+        self.reject_sigma = reject_sigma
+        self.min_inliers = min_inliers
+        # 所有指標都計算，新的上下界與基準一次取得；只用 analyze()，上下界不影響結果
+        self.analyzer = FrameAnalyzer(
+            np.ones(256),
+            metrics={name: 1.0 for name in METRICS},
+            bounds={"contrast": {"max": 1.0, "min": 0.0}},
+            canny=canny,
+        )
+        self.hists = np.zeros((count, 256), dtype=np.float32)
+        self.values = np.zeros((count, len(METRICS)), dtype=np.float64)
+        self.total = np.zeros(256, dtype=np.float64)
+        self.filled = 0
+        self.started = time.time()
+
+    @property
+    def full(self):
+        return self.filled >= self.count
+
+    def add(self, image):
+        """加入一張 ROI 影像，收集完成時回傳 True"""
+        if self.full:
+            return True
+        self.values[self.filled] = self.analyzer.analyze(image)
+        row = self.hists[self.filled]
+        row[:] = self.analyzer.hist[:, 0]
+        row /= max(row.sum(), 1.0)
+        self.total += row
+        self.filled += 1
+        return self.full
+
+    def inliers(self):
+        """回傳非離群影像的布林遮罩：直方圖與中位直方圖的 L1 距離，以及各指標值都要在範圍內"""
+        hists = self.hists[: self.filled]
+        distance = np.abs(hists - np.median(hists, axis=0)).sum(axis=1)
+        mask = robust_inliers(distance, self.reject_sigma)
+        for i, name in enumerate(METRICS):
+            if name != "hist":
+                mask &= robust_inliers(self.values[: self.filled, i], self.reject_sigma)
+        return mask
+
+    def result(self, previous=None, info=None):
+        """產生新的 Calibration：基準直方圖為非離群影像的平均，各指標乾淨端 (max) 更新為非離群影像的平均
+
+        粉塵端 (min) 無法由乾淨畫面推得，沿用 previous 的值
+        """
+        if self.filled == 0:
+            raise ValueError("沒有收集到任何影像")
+        mask = self.inliers()
+        kept = int(mask.sum())
+        if kept < self.min_inliers * self.filled:
+            raise ValueError("離群影像過多（{}/{}），畫面不穩定，請稍後再校正".format(
+                self.filled - kept, self.filled))
+        # 總和已逐張累加，只需扣掉離群影像
+        init_hist = (self.total - self.hists[: self.filled][~mask].sum(axis=0)) / kept
+
+        clean = {
+            name: float(self.values[: self.filled][mask, i].mean())
+            for i, name in enumerate(METRICS) if name != "hist"
+        }
+        bounds = dict(previous.bounds) if previous is not None else {}
+        for name, bound in list(bounds.items()):
+            # 新的乾淨值越過粉塵端時上下界會反向，保留原本的值
+            if name in clean and (clean[name] - bound["min"]) * (bound["max"] - bound["min"]) > 0:
+                bounds[name] = {"max": clean[name], "min": bound["min"]}
+
+        info = dict(info or {})
+        info.update(
+            created=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            frames=self.filled,
+            rejected=self.filled - kept,
+            seconds=round(time.time() - self.started, 3),
+            clean=clean,
+        )
+        return Calibration(init_hist, bounds, info=info)
+
+
+def similarity(calibration, previous):
+    """兩個基準直方圖的相關係數"""
+    return float(cv2.compareHist(calibration.init_hist, previous.init_hist, cv2.HISTCMP_CORREL))
+
+
+class BaselineStore(object):
+    """每台攝影機、每個 ROI 的基準分別存檔，每次校正遞增版本，舊版本保留供比對與回復
+
+    檔名為 {攝影機}__{ROI}__v0001.npz
+    """
+
+    def __init__(self, folder="calibration"):
+        self.folder = folder
+
+    @staticmethod
+    def key(camera_id, roi_config):
+        roi = RoiMapper.from_config(roi_config)
+        key = "{}__{}x{}_{}-{}_{}-{}".format(
+            camera_id or "default", roi.reference_size[0], roi.reference_size[1],
+            roi.x[0], roi.x[1], roi.y[0], roi.y[1],
+        )
+        return re.sub(r"[^\w.-]", "_", key)
+
+    def path(self, camera_id, roi_config, version):
+        return os.path.join(
+            self.folder, "{}__v{:04d}.npz".format(self.key(camera_id, roi_config), version)
+        )
+
+    def versions(self, camera_id, roi_config):
+        pattern = os.path.join(self.folder, glob.escape(self.key(camera_id, roi_config)) + "__v*.npz")
+        versions = []
+        for path in glob.glob(pattern):
+            match = re.search(r"__v(\d+)\.npz$", path)
+            if match:
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def latest(self, camera_id, roi_config):
+        """最新版本的基準，沒有或無法讀取時回傳 None"""
+        for version in reversed(self.versions(camera_id, roi_config)):
+            try:
+                return Calibration.load(self.path(camera_id, roi_config, version))
+            except (ValueError, KeyError, OSError) as e:
+                print("基準 v{} 無法讀取：{}".format(version, e))
+        return None
+
+    def save(self, camera_id, roi_config, calibration):
+        """存成新版本並回傳版本號"""
+        os.makedirs(self.folder, exist_ok=True)
+        versions = self.versions(camera_id, roi_config)
+        version = versions[-1] + 1 if versions else 1
+        calibration.info.update(version=version, camera=camera_id, roi=roi_config)
+        calibration.save(self.path(camera_id, roi_config, version))
+        return version
+
+
+def main():
+    from dust_cv import Dust_Monitor
+    from config_loader import load_config
+
+    parser = argparse.ArgumentParser(description="快速校正：錄製乾淨畫面的基準並存成新版本")
+    parser.add_argument("--camera", help="config.yaml cameras 中的攝影機 id，未指定時使用 rtsp_url")
+    parser.add_argument("--frames", type=int, help="校正張數，預設為 calibration.frames")
+    parser.add_argument("--list", action="store_true", help="只列出已存的版本")
+    args = parser.parse_args()
+
+    camera = None
+    if args.camera:
+        cameras = {c["id"]: c for c in load_config("config.yaml").get("cameras") or []}
+        if args.camera not in cameras:
+            raise SystemExit("config.yaml 沒有攝影機 {}".format(args.camera))
+        camera = cameras[args.camera]
+    monitor = Dust_Monitor(camera=camera)
+    try:
+        if args.list:
+            for version in monitor.baselines.versions(monitor.camera_id, monitor.roi_config):
+                print(monitor.baselines.path(monitor.camera_id, monitor.roi_config, version))
+            return
+        monitor.record_init_hist(frames=args.frames)
+    finally:
+        monitor.close()
+
+
+if __name__ == "__main__":
+    main()
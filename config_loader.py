@@ -0,0 +1,155 @@
+import copy
+import json
+import os
+import pickle
+import threading
+
+import numpy as np
+import yaml
+
+from window_stats import mean_bounds
+
+# calibration.npz 的格式版本，格式改變時遞增，舊檔會自動重新計算
+CALIBRATION_VERSION = 2
+
+
+def file_version(path):
+    """以 (修改時間, 大小) 判斷檔案是否改變，檔案不存在時回傳 None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _FileCache(object):
+    # 每個檔案只在內容改變後才重新讀取，同一個行程內共用
+    def __init__(self, loader):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        version = file_version(path)
+        if version is None:
+            raise FileNotFoundError(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+        value = self.loader(path)
+        with self.lock:
+            self.entries[path] = (version, value)
+        return value
+
+
+def _read_yaml(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+
+def _read_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+_configs = _FileCache(_read_yaml)
+_params = _FileCache(_read_pickle)
+
+
+def load_config(config_path="config.yaml"):
+    """讀取 config.yaml，檔案沒有改變時不重新解析；回傳複本，呼叫端可自由修改"""
+    return copy.deepcopy(_configs.get(config_path))
+
+
+def load_params(params_path="params.pkl"):
+    """讀取 params.pkl 的原始內容（contrast_var_list、hist），請勿修改回傳值"""
+    return _params.get(params_path)
+
+
+def threshold_lines(config_dict):
+    """回傳 (黃線, 紅線)，Dust_Monitor 讀取設定時會把 yellow_line 改名為 yellow"""
+    thresholds = config_dict.get("thresholds") or {}
+    return (
+        thresholds.get("yellow_line", thresholds.get("yellow", 45)),
+        thresholds.get("red_line", thresholds.get("red", 60)),
+    )
+
+
+class Calibration(object):
+    """校正值：初始直方圖與各指標的正規化上下界，info 記錄來源（影格數、攝影機、ROI、版本等）"""
+
+    def __init__(self, init_hist, bounds, source=None, info=None):
+        self.init_hist = np.asarray(init_hist, dtype=np.float32).reshape(256, 1)
+        self.bounds = {
+            name: {"max": float(bound["max"]), "min": float(bound["min"])}
+            for name, bound in bounds.items()
+        }
+        self.source = source  # 推導來源 params.pkl 的 file_version
+        self.info = dict(info or {})
+
+    @property
+    def max_min(self):
+        max_min = {"hist": {"max": 1.0, "min": 0.0}}
+        max_min.update({name: dict(bound) for name, bound in self.bounds.items()})
+        return max_min
+
+    @classmethod
+    def from_params(cls, params_path="params.pkl", window=100):
+        params = load_params(params_path)
+        return cls(
+            params["hist"],
+            {"contrast": mean_bounds(params["contrast_var_list"], window)},
+            source=file_version(params_path),
+            info={"origin": params_path},
+        )
+
+    def save(self, path):
+        # np.savez 會自動補上 .npz，先寫暫存檔再改名，避免其他行程讀到寫一半的檔案
+        temp_path = path + ".tmp.npz"
+        np.savez(
+            temp_path,
+            version=CALIBRATION_VERSION,
+            init_hist=self.init_hist,
+            bounds=json.dumps(self.bounds),
+            source=np.array(self.source or (0, 0), dtype=np.int64),
+            info=json.dumps(self.info, ensure_ascii=False),
+        )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != CALIBRATION_VERSION:
+                raise ValueError("calibration 格式版本不符：{}".format(path))
+            source = tuple(int(v) for v in data["source"])
+            return cls(
+                data["init_hist"],
+                json.loads(str(data["bounds"])),
+                source=source if any(source) else None,
+                info=json.loads(str(data["info"])),
+            )
+
+
+def load_calibration(params_path="params.pkl", cache_path="calibration.npz"):
+    """優先讀取 calibration.npz；params.pkl 比快取新（修改時間或大小不同）時重新計算並寫回
+
+    只有 calibration.npz、沒有 params.pkl 時直接使用快取
+    """
+    params_version = file_version(params_path)
+    if file_version(cache_path) is not None:
+        try:
+            calibration = Calibration.load(cache_path)
+            if params_version is None or calibration.source == params_version:
+                return calibration
+        except (ValueError, KeyError, OSError) as e:
+            print("calibration 快取無法使用，重新計算：{}".format(e))
+    if params_version is None:
+        raise FileNotFoundError(params_path)
+    calibration = Calibration.from_params(params_path)
+    try:
+        calibration.save(cache_path)
+    except OSError as e:
+        print("無法寫入 calibration 快取：{}".format(e))
+    return calibration
@@ -4,35 +4,140 @@ import random
 import threading
 import os
 import csv
+import json
+import socket
+import argparse
+import urllib.request
+import urllib.error
 
 # Global variable to control the emulation
 is_running = True
 
-# Ensure the data folder exists
-os.makedirs("data", exist_ok=True)
+MAX_BATCH = 5000  # gateway.max_batch default, larger requests are refused with 413
+MAX_DATAGRAM = 60000  # bytes, below the 65507-byte UDP payload limit
 
-def generate_data():
-    """Function to generate data every 10 seconds and save it to a CSV file.""" 
+
+class BatchRejected(Exception):
+    """The gateway refused the batch itself (400/413), sending it again unchanged cannot succeed."""
+
+    def __init__(self, code, message):
+        super().__init__(f"HTTP {code}: {message}")
+        self.code = code
+
+
+def post_readings(url, readings, timeout=5):
+    """POST a batch to the ingestion gateway. Returns the seconds to wait before retrying, 0 on success."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps({"readings": readings}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        if e.code == 503:
+            # Gateway is applying backpressure, keep the batch and retry later
+            return float(e.headers.get("Retry-After", 1))
+        if e.code in (400, 413):
+            raise BatchRejected(e.code, e.read().decode("utf-8", "replace"))
+        raise
+    for rejected in result.get("rejected", []):
+        print(f"Rejected reading {rejected['index']}: {rejected['error']}")
+    return 0
+
+
+def save_csv(readings):
+    # Ensure the data folder exists
+    os.makedirs("data", exist_ok=True)
+    file_path = f"data/data_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+    with open(file_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(["Timestamp", "Dust_Level"])
+        for reading in readings:
+            csv_writer.writerow([reading["Timestamp"], reading["Dust_Level"]])
+
+
+def deliver(mode, target, sock, buffer, max_batch=MAX_BATCH):
+    """Send the buffered readings in chunks of at most max_batch, removing each chunk once delivered.
+
+    Returns the seconds to wait before retrying when the gateway is busy, 0 when the buffer is empty.
+    Network errors propagate with the undelivered readings still in the buffer.
+    """
+    while buffer:
+        # sqlite.py has no per-file limit, keep one CSV file per delivery
+        chunk = buffer[:] if mode == "csv" else buffer[:max_batch]
+        if mode == "csv":
+            save_csv(chunk)
+        elif mode == "http":
+            try:
+                delay = post_readings(target, chunk)
+            except BatchRejected as e:
+                if e.code == 413 and len(chunk) > 1:
+                    # The gateway limit is lower than ours, split the chunk
+                    max_batch = len(chunk) // 2
+                    continue
+                print(f"Gateway rejected {len(chunk)} readings, dropping them: {e}")
+                delay = 0
+            if delay:
+                return delay
+        elif mode == "udp":
+            payload = json.dumps({"readings": chunk}).encode("utf-8")
+            if len(payload) > MAX_DATAGRAM:
+                if len(chunk) > 1:
+                    max_batch = len(chunk) // 2
+                    continue
+                print("Reading does not fit in a datagram, dropping it")
+            else:
+                host, port = target.rsplit(":", 1)
+                sock.sendto(payload, (host, int(port)))
+        del buffer[:len(chunk)]
+    return 0
+
+
+def generate_data(mode="csv", target=None, interval=10, batch=1, camera_id=None, max_buffer=10000,
+                  max_batch=MAX_BATCH):
+    """Generate a reading every `interval` seconds and deliver it in batches of `batch`.
+
+    mode "csv" writes one CSV file per batch into data/ (picked up by sqlite.py),
+    "http" posts to the gateway URL and "udp" sends datagrams to the gateway host:port.
+    Undelivered readings stay buffered (up to max_buffer) and are retried in chunks of at most max_batch.
+    """
     global is_running
+    if not 1 <= batch <= max_batch:
+        raise ValueError(f"batch must be between 1 and {max_batch}")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if mode == "udp" else None
+    buffer = []
+    retry_at = 0
     while is_running:
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
         dust_level = round(random.uniform(10, 50), 2)  # Simulating dust level between 10 and 50
         print(f"Timestamp: {timestamp}, Dust Level: {dust_level}")
-        
-        # Save data to a CSV file
-        file_path = f"data/data_{time.strftime('%Y%m%d_%H%M%S')}.csv"
-        with open(file_path, 'w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            csv_writer.writerow(["Timestamp", "Dust_Level"])
-            csv_writer.writerow([timestamp, dust_level])
-        
-        time.sleep(10)
-
-def start_emulation():
+        reading = {"Timestamp": timestamp, "Dust_Level": dust_level}
+        if camera_id:
+            reading["Camera_ID"] = camera_id
+        buffer.append(reading)
+        del buffer[:-max_buffer]
+
+        if len(buffer) >= batch and time.monotonic() >= retry_at:
+            try:
+                delay = deliver(mode, target, sock, buffer, max_batch)
+                if delay:
+                    print(f"Gateway busy, retrying in {delay} s")
+                    retry_at = time.monotonic() + delay
+            except (OSError, ValueError) as e:
+                print(f"Failed to send {len(buffer)} readings, will retry: {e}")
+
+        time.sleep(interval)
+    if sock is not None:
+        sock.close()
+
+def start_emulation(**kwargs):
     """Starts the data emulation in a separate thread.""" 
     global is_running
     is_running = True
-    emulation_thread = threading.Thread(target=generate_data, daemon=True)
+    emulation_thread = threading.Thread(target=generate_data, kwargs=kwargs, daemon=True)
     emulation_thread.start()
 
 def stop_emulation():
@@ -42,9 +147,26 @@ def stop_emulation():
     print("Emulation paused.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dust reading emulator")
+    parser.add_argument("--mode", choices=["csv", "http", "udp"], default="csv",
+                        help="csv: one file per batch in data/; http/udp: send to gateway.py")
+    parser.add_argument("--target", default=None,
+                        help="gateway URL for http (default http://127.0.0.1:8765/readings) "
+                             "or host:port for udp (default 127.0.0.1:8766)")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between readings")
+    parser.add_argument("--batch", type=int, default=1, help="readings per file / request")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH,
+                        help="largest request sent to the gateway, match gateway.max_batch")
+    parser.add_argument("--camera", default=None)
+    args = parser.parse_args()
+    if not 1 <= args.batch <= args.max_batch:
+        parser.error(f"--batch must be between 1 and --max-batch ({args.max_batch})")
+    target = args.target or {"http": "http://127.0.0.1:8765/readings", "udp": "127.0.0.1:8766"}.get(args.mode)
+
     print("Starting data emulator. Press Ctrl+C to stop.")
     try:
-        start_emulation()
+        start_emulation(mode=args.mode, target=target, interval=args.interval, batch=args.batch,
+                        camera_id=args.camera, max_batch=args.max_batch)
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
@@ -0,0 +1,354 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from episodes import ensure_episode_table
+from metrics import registry
+from rollup import ensure_rollup_tables
+
+
+def ensure_dust_table(conn, table_name="dust_data"):
+    """建立粉塵資料表與 Timestamp 索引，舊資料庫沒有 Camera_ID 欄位時補上"""
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS "{}" ("Timestamp" TEXT, "Dust_Level" REAL, "Camera_ID" TEXT)'.format(
+            table_name
+        )
+    )
+    columns = [row[1] for row in conn.execute('PRAGMA table_info("{}")'.format(table_name))]
+    if "Camera_ID" not in columns:
+        conn.execute('ALTER TABLE "{}" ADD COLUMN "Camera_ID" TEXT'.format(table_name))
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS "idx_{0}_timestamp" ON "{0}" ("Timestamp")'.format(table_name)
+    )
+    conn.commit()
+
+
+def ensure_ingested_table(conn):
+    """記錄已匯入的 CSV 檔，重新啟動時不會重複匯入"""
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS "ingested_files" ("Path" TEXT PRIMARY KEY, '
+        '"Size" INTEGER, "Mtime" REAL, "Rows" INTEGER, "Ingested_At" TEXT)'
+    )
+    conn.commit()
+
+
+def ensure_gap_table(conn):
+    """串流中斷的區間，讓沒有讀數的時段可以和「粉塵為 0」區分"""
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS "stream_gaps" ("Camera_ID" TEXT, "Start" TEXT, '
+        '"End" TEXT, "Seconds" REAL, "Reason" TEXT)'
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS "idx_stream_gaps_start" ON "stream_gaps" ("Start")')
+    conn.commit()
+
+
+_STOP = object()
+
+
+class _FileBatch(object):
+    # 一批 CSV 檔的讀數與檔案紀錄，兩者在同一個交易內寫入；done 不為 None 時寫入或丟棄後通知呼叫端
+    def __init__(self, rows, files, done=None):
+        self.rows = rows
+        self.files = files
+        self.done = done
+        self.committed = False
+
+
+class _Gap(object):
+    # 一筆串流中斷紀錄 (Camera_ID, Start, End, Seconds, Reason)
+    def __init__(self, row):
+        self.row = row
+
+
+class DustDBWriter(object):
+    """長駐的 SQLite 寫入器：單一連線、WAL、批次 executemany，寫入在背景執行緒進行"""
+
+    def __init__(self, db_file="dust_data.db", table_name="dust_data", batch_size=50,
+                 flush_interval=1.0, max_queue=10000, rollup=None, episodes=None):
+        # batch_size: 累積幾筆寫入一次
+        # flush_interval: 最久幾秒一定寫入一次
+        # max_queue: 佇列上限，資料庫被鎖住時超過的讀數會被丟棄而不會卡住影像分析
+        # rollup: DustRollup，寫入原始讀數時一併更新分、時、日彙總表
+        # episodes: EpisodeDetector，寫入原始讀數時一併更新警報事件表，關閉時結束進行中的事件
+        self.db_file = db_file
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.rollup = rollup
+        self.episodes = episodes
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.insert_sql = 'INSERT INTO "{}" ("Timestamp", "Dust_Level", "Camera_ID") VALUES (?, ?, ?)'.format(
+            table_name
+        )
+
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.write_errors = 0
+        self.last_write_latency = None
+        self.start_error = None
+
+    def start(self):
+        """啟動背景執行緒，連線或建立資料表失敗（例如資料庫被鎖住）時在這裡拋出例外"""
+        if self.thread is not None:
+            return self
+        ready = threading.Event()
+        self.start_error = None
+        self.thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.start_error is not None:
+            self.thread.join()
+            self.thread = None
+            raise self.start_error
+        atexit.register(self.close)
+        registry.add_collector(self._collect)
+        return self
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=5)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            ensure_dust_table(conn, self.table_name)
+            ensure_ingested_table(conn)
+            ensure_gap_table(conn)
+            if self.rollup is not None:
+                ensure_rollup_tables(conn)
+            if self.episodes is not None:
+                ensure_episode_table(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def write(self, val, timestamp=None, camera_id=None):
+        """放入一筆讀數，佇列已滿時丟棄並回傳 False，不會阻塞呼叫端"""
+        if timestamp is None:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            self.queue.put_nowait((timestamp, float(val), camera_id))
+            return True
+        except queue.Full:
+            self.rows_dropped += 1
+            return False
+
+    def write_many(self, rows):
+        """rows: (Timestamp, Dust_Level, Camera_ID) 的序列，回傳成功放入佇列的筆數"""
+        accepted = 0
+        for timestamp, val, camera_id in rows:
+            accepted += self.write(val, timestamp=timestamp, camera_id=camera_id)
+        return accepted
+
+    def write_files(self, rows, files, timeout=None, wait=False):
+        """寫入一批 CSV 檔的讀數，並在同一個交易內記錄 files [(路徑, 大小, 修改時間, 筆數)]
+
+        與 write() 不同，佇列已滿時會等待 timeout 秒（None 為一直等待），由匯入端承受背壓；
+        wait 為 True 時等到這批資料提交後才回傳，資料有誤被丟棄時回傳 False
+        """
+        thread = self.thread
+        batch = _FileBatch(list(rows), list(files), threading.Event() if wait else None)
+        try:
+            self.queue.put(batch, timeout=timeout)
+        except queue.Full:
+            return False
+        if not wait:
+            return True
+        while not batch.done.wait(1):
+            if thread is None or not thread.is_alive():
+                return False
+        return batch.committed
+
+    def write_batch(self, rows, timeout=0):
+        """整批讀數 (Timestamp, Dust_Level, Camera_ID) 作為一個項目放入佇列，同一次提交寫入
+
+        佇列已滿時等待 timeout 秒後回傳 False，整批都不寫入，由呼叫端決定重送或回覆忙碌
+        """
+        return self.write_files(rows, (), timeout=timeout)
+
+    def write_gap(self, start, end, camera_id=None, reason="stall"):
+        """記錄一段串流中斷，start/end 為 datetime，佇列已滿時丟棄並回傳 False"""
+        row = (
+            camera_id,
+            start.strftime("%Y-%m-%d %H:%M:%S"),
+            end.strftime("%Y-%m-%d %H:%M:%S"),
+            (end - start).total_seconds(),
+            reason,
+        )
+        try:
+            self.queue.put_nowait(_Gap(row))
+            return True
+        except queue.Full:
+            return False
+
+    def flush(self, timeout=None):
+        """等待目前佇列內的讀數寫入資料庫"""
+        if self.thread is None or not self.thread.is_alive():
+            return False
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """停止背景執行緒，寫完剩餘讀數並做一次完整的 checkpoint"""
+        if self.thread is None:
+            return
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        self.thread = None
+        atexit.unregister(self.close)
+        registry.remove_collector(self._collect)
+
+    def stats(self):
+        return {
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+            "write_errors": self.write_errors,
+            "queue_depth": self.queue.qsize(),
+            "last_write_latency": self.last_write_latency,
+        }
+
+    def _collect(self):
+        labels = {"db": self.db_file, "table": self.table_name}
+        return [
+            ("db_rows_written", labels, self.rows_written),
+            ("db_rows_dropped", labels, self.rows_dropped),
+            ("db_write_errors", labels, self.write_errors),
+            ("db_queue_depth", labels, self.queue.qsize()),
+        ]
+
+    def _rollback(self, conn, last_seen, episode_state):
+        # 交易失敗時連同彙總與警報事件的記憶體狀態一起回到交易前
+        conn.rollback()
+        if self.rollup is not None:
+            self.rollup.last_seen = last_seen
+        if self.episodes is not None:
+            self.episodes.restore_state(episode_state)
+        self.write_errors += 1
+
+    def _commit(self, conn, pending, files=(), gaps=()):
+        """寫入一批資料，成功回傳 True；資料庫被鎖住時回傳 False 由呼叫端保留重試；
+        資料本身有誤（重試也不會成功）時整批丟棄並回傳 None
+        """
+        start = time.perf_counter()
+        last_seen = dict(self.rollup.last_seen) if self.rollup is not None else None
+        episode_state = self.episodes.save_state() if self.episodes is not None else None
+        try:
+            if self.rollup is not None:
+                self.rollup.apply(conn, pending)
+            if self.episodes is not None:
+                self.episodes.apply(conn, pending)
+            conn.executemany(self.insert_sql, pending)
+            if files:
+                ingested_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                conn.executemany(
+                    'INSERT OR REPLACE INTO "ingested_files" VALUES (?, ?, ?, ?, ?)',
+                    [tuple(f) + (ingested_at,) for f in files],
+                )
+            if gaps:
+                conn.executemany('INSERT INTO "stream_gaps" VALUES (?, ?, ?, ?, ?)', gaps)
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # 資料庫被鎖住時保留這批資料，下次再寫
+            self._rollback(conn, last_seen, episode_state)
+            print("寫入資料庫失敗：{}".format(e))
+            return False
+        except Exception as e:
+            # 例如時間格式錯誤，丟棄這批資料讓背景執行緒繼續寫入之後的讀數
+            self._rollback(conn, last_seen, episode_state)
+            self.rows_dropped += len(pending)
+            print("寫入資料庫失敗，丟棄 {} 筆：{}".format(len(pending), e))
+            return None
+        self.last_write_latency = time.perf_counter() - start
+        registry.observe("db_write_seconds", self.last_write_latency, table=self.table_name)
+        self.rows_written += len(pending)
+        return True
+
+    @staticmethod
+    def _finish_batches(batches, committed):
+        for batch in batches:
+            batch.committed = committed
+            batch.done.set()
+
+    def _run(self, ready):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self.start_error = e
+            return
+        finally:
+            ready.set()
+        pending, files, gaps, waiters, stopping = [], [], [], [], False
+        batches = []  # 等待提交結果的 _FileBatch
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = max(self.flush_interval - (time.monotonic() - last_flush), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                    elif isinstance(item, threading.Event):
+                        waiters.append(item)
+                    elif isinstance(item, _FileBatch):
+                        pending.extend(item.rows)
+                        files.extend(item.files)
+                        if item.done is not None:
+                            batches.append(item)
+                    elif isinstance(item, _Gap):
+                        gaps.append(item.row)
+                    else:
+                        pending.append(item)
+                    if len(pending) >= self.batch_size:
+                        break
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            due = time.monotonic() - last_flush >= self.flush_interval
+            if (pending or files or gaps) and (
+                len(pending) >= self.batch_size or due or waiters or batches or stopping
+            ):
+                committed = self._commit(conn, pending, files, gaps)
+                if committed is not False:
+                    pending, files, gaps = [], [], []
+                    self._finish_batches(batches, bool(committed))
+                    batches = []
+                elif len(pending) > self.max_queue and not files:
+                    self.rows_dropped += len(pending) - self.max_queue
+                    pending = pending[-self.max_queue :]
+                last_flush = time.monotonic()
+            elif due:
+                last_flush = time.monotonic()
+
+            if not pending and not files and not gaps:
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
+            if stopping:
+                break
+
+        # 結束前改用 FULL 同步並把 WAL 併回主檔，確保資料落地
+        conn.execute("PRAGMA synchronous=FULL")
+        committed = True
+        if pending or files or gaps:
+            committed = self._commit(conn, pending, files, gaps)
+            if committed is False:
+                self.rows_dropped += len(pending)
+        self._finish_batches(batches, bool(committed))
+        if self.episodes is not None:
+            try:
+                self.episodes.finish(conn)
+                conn.commit()
+            except sqlite3.OperationalError as e:
+                print("無法結束進行中的警報事件：{}".format(e))
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        for waiter in waiters:
+            waiter.set()
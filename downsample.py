@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets 降採樣，保留折線的外形，回傳被選取的索引"""
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # 頭尾固定保留，中間切成 n_out - 2 個桶
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    prev = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        # 下一個桶的平均點，最後一個桶以終點代替
+        if i + 2 < len(edges):
+            next_x = x[edges[i + 1] : edges[i + 2]].mean()
+            next_y = y[edges[i + 1] : edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs(
+            (x[prev] - next_x) * (y[start:stop] - y[prev])
+            - (x[prev] - x[start:stop]) * (next_y - y[prev])
+        )
+        prev = start + int(np.argmax(area))
+        selected[i + 1] = prev
+    return selected
+
+
+def minmax_buckets(y, n_out):
+    """每個桶保留最小與最大值，回傳排序後的索引，適合需要保留尖峰的警戒圖"""
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype(np.int64)
+    selected = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        if stop <= start:
+            continue
+        segment = y[start:stop]
+        selected.append(start + int(np.argmin(segment)))
+        selected.append(start + int(np.argmax(segment)))
+    return np.unique(selected)
+
+
+def downsample(df, x_column, y_column, n_out, method="lttb"):
+    """依點數上限降採樣 DataFrame，x 欄位可為時間"""
+    if len(df) <= n_out:
+        return df
+    if method == "lttb":
+        x = df[x_column].to_numpy()
+        if np.issubdtype(x.dtype, np.datetime64):
+            x = x.astype("datetime64[ns]").astype(np.int64)
+        index = lttb(x, df[y_column].to_numpy(), n_out)
+    elif method == "minmax":
+        index = minmax_buckets(df[y_column].to_numpy(), n_out)
+    else:
+        raise ValueError("未知的降採樣方法：{}".format(method))
+    return df.iloc[index]
@@ -1,15 +1,23 @@
-import numpy as np
 import cv2
-import pandas as pd
-import random
-import pickle
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import sqlite3
 import os
 import matplotlib.pyplot as plt
-import subprocess
-import yaml
+
+from stream_reader import Backoff, LatestFrameReader, StreamSession, open_capture
+from roi import RoiMapper
+from db_writer import DustDBWriter, ensure_dust_table
+from rollup import DustRollup
+from episodes import EpisodeDetector
+from frame_metrics import FrameAnalyzer
+from light_tower import LightTowerController
+from metrics import registry, start_http_server, stop_http_server
+from sampler import AdaptiveSampler
+from window_stats import WindowStats
+from calibration import BaselineRecorder, BaselineStore, similarity
+from config_loader import file_version, load_calibration, load_config, load_params, threshold_lines
+from replay import ReplayEngine, timestamps as replay_timestamps
 
 
 class UserCaseException(Exception):
@@ -17,7 +25,10 @@ class UserCaseException(Exception):
 
 
 class Dust_Monitor(object):
-    def __init__(self, rtsp_site=None):
+    reload_interval = 1.0  # 檢查 config.yaml 是否修改的間隔（秒）
+
+    def __init__(self, rtsp_site=None, camera=None):
+        # camera: 多攝影機設定中的一筆 {"id", "rtsp_url", "roi"}，由 multi_camera.py 傳入
         self.config_dict = self.process_config_file()
 
         if self.config_dict["to_db"].lower() == "true":
@@ -25,34 +36,51 @@ class Dust_Monitor(object):
         else:
             self.to_db = False
 
-        if self.config_dict["rtsp_url"] is not None:
-            self.cap = cv2.VideoCapture(self.config_dict["rtsp_url"])
+        self.camera_id, roi_config = None, self.config_dict.get("roi")
+        self.camera = camera
+        if camera is not None:
+            self.camera_id = camera["id"]
+            self.rtsp_url = camera["rtsp_url"]
+            roi_config = camera.get("roi", roi_config)
+        elif rtsp_site is not None:
+            self.rtsp_url = rtsp_site
+        elif self.config_dict["rtsp_url"] is not None:
+            self.rtsp_url = self.config_dict["rtsp_url"]
         else:
-            self.cap = cv2.VideoCapture(rtsp_site)
-
-        if (
-            os.path.isfile("./light/Red/OFF/Debug/Comport.exe") == False
-            or os.path.isfile("./light/Red/ON/Debug/Comport.exe") == False
-        ):
-            raise UserCaseException("Red light執行檔不存在!!")
-        self.light_exe = {
-            "red": {
-                "on": os.path.join("./light/Red/ON/Debug/Comport.exe"),
-                "off": os.path.join("./light/Red/OFF/Debug/Comport.exe"),
-            }
-        }
+            raise UserCaseException("config.yaml沒有設定rtsp_url!!")
+        self.metrics_camera = self.camera_id or "default"
+        # 設定 sampling 時擷取端只 retrieve() 需要分析的影像，讀數接近警戒線時提高頻率
+        sampling_config = self.config_dict.get("sampling") or {}
+        self.sampler = None
+        if sampling_config.get("rate"):
+            self.sampler = AdaptiveSampler.from_config(self.config_dict)
+        self.cap = self.open_stream(self.rtsp_url)
+        self.roi = RoiMapper.from_config(roi_config)
+        self.roi_config = roi_config
+
+        # 警示燈在 vedio_stream 才開啟，多攝影機時由 multi_camera.py 的主行程統一控制
+        self.light = None
+        self.metrics_server = None
 
-        if "params.pkl" not in os.listdir("."):
-            raise UserCaseException("params.pkl不存在!!")
-        with open("./params.pkl", "rb") as f:
-            params = pickle.load(f)
-            self.contrast_var_list = params["contrast_var_list"]
-            self.init_hist = params["hist"]
-
-        contrast_var_mv = self.moving_average(self.contrast_var_list, 100)
-        self.max_min = {
-            "contrast": {"max": max(contrast_var_mv), "min": min(contrast_var_mv)},
-            "hist": {"max": 1.0, "min": 0.0},
+        # 優先使用此攝影機、此 ROI 最新一版的基準；沒有時由 params.pkl 推導（存成 calibration.npz）
+        self.calibration_config = self.config_dict.get("calibration") or {}
+        self.baselines = BaselineStore(self.calibration_config.get("folder", "calibration"))
+        calibration = self.baselines.latest(self.camera_id, roi_config)
+        if calibration is None:
+            if "params.pkl" not in os.listdir(".") and "calibration.npz" not in os.listdir("."):
+                raise UserCaseException("params.pkl不存在!!")
+            calibration = load_calibration("params.pkl", "calibration.npz")
+        self.calibration = calibration
+        self.init_hist = calibration.init_hist
+        self.max_min = calibration.max_min
+        # 灰階只轉一次，依設定計算各指標並加權成粉塵分數
+        self.analyzer = FrameAnalyzer.from_config(
+            self.config_dict.get("analysis"), self.init_hist, self.max_min
+        )
+        # 各步驟的耗時直方圖，decode 由 LatestFrameReader 記錄
+        self.stage_timers = {
+            stage: registry.histogram("stage_seconds", stage=stage, camera=self.metrics_camera)
+            for stage in ["roi"] + self.analyzer.stages + ["window"]
         }
 
         if "dust_data.db" not in os.listdir("."):
@@ -62,28 +90,59 @@ class Dust_Monitor(object):
             "dust_data",
             "dust_data_simulation.db",
         )
+        self.writers = {}
 
-        self.val_list, self.idx = [], random.randint(0, 6177 - 80)
+        # 每張影像的指標值放進環狀緩衝，依設定的視窗模式輸出讀數
+        self.window = WindowStats.from_config(self.config_dict.get("window"))
 
-    def process_config_file(self):
+        # 定期校正在讀數低於黃線時於分析迴圈中順帶收集影像，不會中斷讀數
+        self.recorder = None
+        self.last_reading = None
+        self.next_calibration = self.schedule_calibration()
+
+        # config.yaml 修改後，警戒值與 ROI 在執行中重新載入
+        self.config_version = file_version("config.yaml")
+        self.next_reload_check = time.monotonic() + self.reload_interval
+
+    def open_stream(self, url):
+        # 連線與重連由 StreamSession 在背景進行，分析端只拿最新的影像
+        capture_config = self.config_dict.get("capture") or {}
+        backoff = Backoff(
+            capture_config.get("reconnect_initial", 1.0),
+            capture_config.get("reconnect_max", 60.0),
+        )
+        return StreamSession(
+            self.open_reader,
+            url,
+            read_timeout=capture_config.get("read_timeout", 5.0),
+            open_timeout=capture_config.get("open_timeout", 10.0),
+            backoff=backoff,
+            camera=self.metrics_camera,
+        ).start()
+
+    def open_reader(self, url):
+        # 開啟與讀取都設定逾時，卡住的連線不會讓擷取執行緒永遠停在 read()
+        capture_config = self.config_dict.get("capture") or {}
+        reader = LatestFrameReader(
+            open_capture(
+                url,
+                capture_config.get("open_timeout", 10.0),
+                capture_config.get("read_timeout", 5.0),
+            ),
+            maxlen=capture_config.get("buffer_size", 1),
+            max_age=capture_config.get("max_frame_age", 1.0),
+            sampler=self.sampler,
+            camera=self.metrics_camera,
+        )
+        return reader.start()
+
+    @staticmethod
+    def process_config_file():
         if "config.yaml" not in os.listdir("."):
             raise UserCaseException("config.yaml不存在!!")
-        with open("config.yaml", "r", encoding="utf-8") as f:
-            lines = f.readlines()
-
-        filtered_lines = []
-        skip_block = False
-        for line in lines:
-            stripped_line = line.strip()
-            if stripped_line.startswith("settings:"):
-                skip_block = True
-            elif skip_block and not stripped_line:
-                skip_block = False
-            elif not skip_block:
-                filtered_lines.append(line)
-
-        filtered_text = "".join(filtered_lines)
-        config_dict = yaml.safe_load(filtered_text)
+        # settings 為儀表板的設定，分析程式不使用
+        config_dict = load_config("config.yaml")
+        config_dict.pop("settings", None)
 
         if "thresholds" in config_dict:
             config_dict["thresholds"] = {
@@ -92,43 +151,123 @@ class Dust_Monitor(object):
             }
         return config_dict
 
-    def data2db(self, val, mode="shot"):
-        current_time = datetime.now()
-        df = pd.DataFrame([current_time.strftime("%Y-%m-%d %H:%M:%S"), val]).T
-        df.columns = ["Timestamp", "Dust_Level"]
+    def reload_config(self):
+        """config.yaml 修改後重新載入警戒值與 ROI，不需重新啟動；有重新載入時回傳 True"""
+        now = time.monotonic()
+        if now < self.next_reload_check:
+            return False
+        self.next_reload_check = now + self.reload_interval
+        version = file_version("config.yaml")
+        if version is None or version == self.config_version:
+            return False
+        self.config_version = version
+        try:
+            config_dict = self.process_config_file()
+        except Exception as e:
+            # 編輯到一半的檔案可能無法解析，沿用目前的設定，下次修改時再試
+            print("config.yaml 重新載入失敗：{}".format(e))
+            return False
+
+        lines = threshold_lines(config_dict)
+        if lines != threshold_lines(self.config_dict):
+            if self.sampler is not None:
+                self.sampler.lines = lines
+            if self.light is not None:
+                self.light.lines = lines
+            for writer in self.writers.values():
+                if writer.rollup is not None:
+                    writer.rollup.yellow_line, writer.rollup.red_line = lines
+                if writer.episodes is not None:
+                    writer.episodes.lines = lines
+            print("警戒值已更新：黃 {} 紅 {}".format(*lines))
+
+        roi_config = config_dict.get("roi")
+        if self.camera is not None:
+            for camera in config_dict.get("cameras") or []:
+                if camera["id"] == self.camera_id:
+                    roi_config = camera.get("roi", roi_config)
+        if roi_config != self.roi_config:
+            self.roi = RoiMapper.from_config(roi_config)
+            self.roi_config = roi_config
+            print("ROI 已更新：{}".format(roi_config))
+            # 換成新 ROI 的基準，進行中的校正是舊 ROI 的影像，直接放棄
+            self.recorder = None
+            calibration = self.baselines.latest(self.camera_id, roi_config)
+            if calibration is not None:
+                self.apply_calibration(calibration)
+                print("已載入此 ROI 的基準 v{}".format(calibration.info.get("version")))
+
+        self.config_dict["thresholds"] = config_dict.get("thresholds")
+        self.config_dict["roi"] = config_dict.get("roi")
+        self.config_dict["cameras"] = config_dict.get("cameras")
+        return True
 
+    def get_writer(self, mode="shot"):
+        # 每個資料庫只開一個長駐的寫入器，第一次寫入時才建立
         if mode == "simulation":
-            conn = sqlite3.connect(self.db_file_simulation)
+            db_file = self.db_file_simulation
         elif mode == "shot":
-            conn = sqlite3.connect(self.db_file)
+            db_file = self.db_file
         else:
             raise UserCaseException("請輸入shot或simulation!!")
-        df.to_sql(self.table_name, conn, if_exists="append", index=False)
-        conn.close()
-
-    def moving_average(self, x, w):
-        return np.convolve(x, np.ones(w), "valid") / w
+        if mode not in self.writers:
+            self.writers[mode] = DustDBWriter(
+                db_file,
+                self.table_name,
+                rollup=DustRollup.from_config(self.config_dict, self.table_name),
+                episodes=EpisodeDetector.from_config(self.config_dict),
+            ).start()
+        return self.writers[mode]
 
-    def test2db(self, w=70):
-        conn = sqlite3.connect(self.db_file_simulation)
-        original_df = pd.read_sql_query(
-            "SELECT * FROM {};".format(self.table_name), conn
-        )
+    def data2db(self, val, mode="shot"):
+        self.get_writer(mode).write(val, camera_id=self.camera_id)
 
-        for _ in range(0, w * 100):
-            self.val_list.append(self.contrast_var_list[self.idx])
-            self.idx += 1
+    def record_gaps(self):
+        """把已結束的串流中斷區間寫入資料庫"""
+        for start, end, reason in self.cap.pop_gaps():
+            print("串流中斷 {} ~ {}（{}）".format(start, end, reason))
+            if self.to_db == True:
+                self.get_writer("shot").write_gap(start, end, self.camera_id, reason)
 
-            if len(self.val_list) == w:
-                val_mv = self.moving_average(self.val_list, w)
-                normalized_val_mv = self.normalization(val_mv)
-                self.data2db(normalized_val_mv)
-                self.val_list, self.idx = [], random.randint(0, 6177 - 80)
+    def close(self):
+        self.cap.release()
+        self.record_gaps()  # release() 會結束進行中的中斷區間
+        registry.remove_collector(self.collect_metrics)
+        stop_http_server(self.metrics_server)
+        self.metrics_server = None
+        if self.light is not None:
+            self.light.close()
+            self.light = None
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
 
+    def test2db(self, w=70, count=100, seed=None):
+        """以 contrast_var_list 回放產生 count 筆模擬讀數，寫入模擬資料庫並確認有存進去"""
         conn = sqlite3.connect(self.db_file_simulation)
-        modify_df = pd.read_sql_query("SELECT * FROM {};".format(self.table_name), conn)
+        ensure_dust_table(conn, self.table_name)
+        original_count = conn.execute(
+            "SELECT COUNT(*) FROM {};".format(self.table_name)
+        ).fetchone()[0]
 
-        if len(modify_df) <= len(original_df):
+        engine = ReplayEngine(
+            load_params("params.pkl")["contrast_var_list"],
+            w=w,
+            seed=seed,
+            bounds=self.max_min["contrast"],
+            camera_id=self.camera_id,
+        )
+        values = engine.generate(count)
+        stamps = replay_timestamps(datetime.now() - timedelta(seconds=count - 1), count, 1)
+        writer = self.get_writer("simulation")
+        writer.write_many(zip(stamps.tolist(), values.tolist(), [self.camera_id] * count))
+        writer.flush()
+
+        modify_count = conn.execute(
+            "SELECT COUNT(*) FROM {};".format(self.table_name)
+        ).fetchone()[0]
+        conn.close()
+        if modify_count <= original_count:
             raise UserCaseException("模擬資料沒有存進db!!")
         else:
             print("模擬資料有存進db!!")
@@ -159,46 +298,160 @@ class Dust_Monitor(object):
         correlation = cv2.compareHist(hist, self.init_hist, cv2.HISTCMP_CORREL)
         return correlation
 
-    def record_init_hist(self, fps=7, sec=20):
-        self.init_hist = []
-        while self.cap.isOpened() == True and len(self.init_hist) < fps * sec:
+    def new_recorder(self, frames=None):
+        analysis_config = self.config_dict.get("analysis") or {}
+        return BaselineRecorder(
+            frames or self.calibration_config.get("frames", 140),
+            reject_sigma=self.calibration_config.get("reject_sigma", 3.5),
+            canny=analysis_config.get("canny", (50, 150)),
+        )
+
+    def apply_calibration(self, calibration):
+        """改用新的基準，設定檔中的 bounds 仍優先於校正值"""
+        self.calibration = calibration
+        self.init_hist = calibration.init_hist
+        self.max_min = calibration.max_min
+        bounds = dict(self.max_min)
+        bounds.update((self.config_dict.get("analysis") or {}).get("bounds") or {})
+        self.analyzer.set_bounds(bounds)
+        self.analyzer.set_reference(self.init_hist)
+
+    def finish_calibration(self, recorder, scheduled=False):
+        """由收集完的影像產生新基準並存成新版本；定期校正與目前基準差異過大時不採用，回傳是否採用"""
+        try:
+            calibration = recorder.result(self.calibration)
+        except ValueError as e:
+            print("校正失敗：{}".format(e))
+            return False
+        score = similarity(calibration, self.calibration)
+        calibration.info["similarity"] = score
+        min_similarity = self.calibration_config.get("min_similarity", 0.8)
+        if scheduled and score < min_similarity:
+            # 畫面與上次基準差太多，可能是鏡頭移位或收集期間起粉塵，需人工確認後手動校正
+            print("定期校正未採用：與目前基準的相關係數 {:.3f} 低於 {}".format(score, min_similarity))
+            return False
+        self.apply_calibration(calibration)
+        try:
+            version = self.baselines.save(self.camera_id, self.roi_config, calibration)
+            print("基準已更新為 v{}（剔除 {}/{} 張，相關係數 {:.3f}）".format(
+                version, calibration.info["rejected"], calibration.info["frames"], score))
+        except OSError as e:
+            print("無法儲存基準：{}".format(e))
+        return True
+
+    def record_init_hist(self, fps=7, sec=20, frames=None):
+        """連續讀取 frames 張（預設 fps * sec）影像重新校正，存成此攝影機、此 ROI 的新版本"""
+        recorder = self.new_recorder(frames or fps * sec)
+        while self.cap.isOpened() == True and not recorder.full:
             status, frame = self.cap.read()
-            image = cv2.resize(frame, (1000, 750), interpolation=cv2.INTER_AREA)
-            image_crop = image[230:300, 310:410]
-            dust_gray = cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY)
-            hist = cv2.calcHist([dust_gray], [0], None, [256], [0, 256])
-            hist /= hist.sum()
-            self.init_hist.append(hist.reshape(-1))
-
-        self.init_hist = np.array(self.init_hist)
-        self.init_hist = self.init_hist.mean(axis=0).reshape([-1, 1])
-
-    def vedio_stream(self, w=70, cv2_show=True):
-        while self.cap.isOpened() == True:
-            try:
+            if status == False:
+                continue
+            recorder.add(self.roi.extract(frame))
+        self.finish_calibration(recorder)
+        self.next_calibration = self.schedule_calibration()
+
+    def schedule_calibration(self):
+        """下次定期校正的時間（time.time()），未設定 interval_hours 時回傳 None"""
+        interval = self.calibration_config.get("interval_hours")
+        if not interval:
+            return None
+        created = self.calibration.info.get("created")
+        last = datetime.strptime(created, "%Y-%m-%d %H:%M:%S").timestamp() if created else 0
+        return max(last + interval * 3600, time.time())
+
+    def calibrate_in_background(self, image_crop):
+        # 到了排定時間且上一筆讀數低於黃線才開始收集，收集時依 calibration.fps 取樣
+        now = time.time()
+        if self.recorder is None:
+            yellow = threshold_lines(self.config_dict)[0]
+            if now < self.next_calibration or self.last_reading is None or self.last_reading >= yellow:
+                return
+            self.recorder = self.new_recorder()
+            self.next_calibration_frame = now
+            print("開始定期校正")
+        if now < self.next_calibration_frame:
+            return
+        self.next_calibration_frame = now + 1.0 / self.calibration_config.get("fps", 7)
+        if self.recorder.add(image_crop):
+            recorder, self.recorder = self.recorder, None
+            self.finish_calibration(recorder, scheduled=True)
+            self.next_calibration = self.schedule_calibration() or now
+            if self.next_calibration <= now:
+                # 未採用時 created 沒有更新，等一個間隔再試
+                self.next_calibration = now + self.calibration_config["interval_hours"] * 3600
+
+    def process_frame(self, frame):
+        """分析一張影像，到達視窗的輸出時機時回傳 0~100 的讀數，否則回傳 None"""
+        started = time.perf_counter()
+        image_crop = self.roi.extract(frame)
+        self.stage_timers["roi"].observe(time.perf_counter() - started)
+        return self.process_crop(image_crop)
+
+    def process_crop(self, image_crop):
+        self.image_crop = image_crop
+        score = self.analyzer.score(self.image_crop)  # 演算法部分
+        for stage, seconds in zip(self.analyzer.stages, self.analyzer.durations):
+            self.stage_timers[stage].observe(seconds)
+        if self.sampler is not None:
+            self.sampler.update(score)
+
+        # 各指標已在 analyzer 內正規化，視窗直接平均分數
+        started = time.perf_counter()
+        reading = self.window.push(score)
+        self.stage_timers["window"].observe(time.perf_counter() - started)
+        if reading is not None:
+            registry.inc("readings_total", camera=self.metrics_camera)
+            self.last_reading = reading
+        if self.next_calibration is not None:
+            self.calibrate_in_background(image_crop)
+        return reading
+
+    def collect_metrics(self):
+        """佇列深度、丟棄張數等即時狀態，由 metrics 輸出時呼叫"""
+        labels = {"camera": self.metrics_camera}
+        gauges = [("capture_" + key, labels, value) for key, value in self.cap.stats().items()]
+        if self.sampler is not None:
+            gauges.append(("sampler_rate", labels, self.sampler.current_rate))
+        if self.light is not None:
+            light = self.light.stats()
+            gauges.append(("light_relay_on", labels, light["relay"]))
+            gauges.append(("light_commands_sent", labels, light["commands_sent"]))
+            gauges.append(("light_write_errors", labels, light["write_errors"]))
+        return gauges
+
+    def vedio_stream(self, cv2_show=True):
+        self.light = LightTowerController.from_config(self.config_dict)
+        if self.light is not None:
+            self.light.start()
+        self.metrics_server = start_http_server(self.config_dict.get("metrics"))
+        registry.add_collector(self.collect_metrics)
+        try:
+            # 斷線由 StreamSession 在背景重連，這個迴圈只在 close() 或按 q 時結束
+            while self.cap.isOpened() == True:
                 status, frame = self.cap.read()
-                image = cv2.resize(frame, (1000, 750), interpolation=cv2.INTER_AREA)
-                image_crop = image[230:300, 310:410]
-                val = self.algorithm_hist(image_crop)  # 演算法部分
-
-                # 1.self.val_list的長度等於w時
-                # 2.將self.val_list做移動平均
-                # 3.將做移動平均的結果存入db
-                # 4.清空self.val_list
-                self.val_list.append(val)
-                if len(self.val_list) >= w:
-                    val_mv = self.moving_average(self.val_list, w)[0]
-                    normalized_val_mv = self.normalization(val_mv)
-                    if self.to_db == True:
-                        print("save to db")
-                        self.data2db(normalized_val_mv, mode="shot")
-                    self.val_list = []
+                self.record_gaps()
+                self.reload_config()
+                if status == False:
+                    continue
+                try:
+                    normalized_val_mv = self.process_frame(frame)
+                except Exception as e:
+                    # 單張影像分析失敗不影響連線，略過這張
+                    print("影像分析失敗：{}".format(e))
+                    registry.inc("frame_errors_total", camera=self.metrics_camera)
+                    continue
+                if normalized_val_mv is not None and self.light is not None:
+                    # 警示燈在背景執行緒送出指令，不會延誤下一張影像
+                    self.light.update(normalized_val_mv)
+                if normalized_val_mv is not None and self.to_db == True:
+                    print("save to db")
+                    self.data2db(normalized_val_mv, mode="shot")
 
                 if cv2_show == True:
-                    cv2.imshow("Webcam", image)
+                    cv2.imshow("Webcam", self.roi.preview(frame))
                     cv2.namedWindow("crop", 0)
                     cv2.resizeWindow("crop", 400, 280)
-                    cv2.imshow("crop", image_crop)
+                    cv2.imshow("crop", self.image_crop)
                     key = cv2.waitKey(1) & 0xFF
                     if key == ord("q"):
                         print("退出程式")
@@ -214,19 +467,16 @@ class Dust_Monitor(object):
                         print(
                             "{}.jpg 存檔".format(current_time.strftime("%Y-%m-%d %H-%M-%S"))
                         )
-            except Exception as e:
-                if e is not KeyboardInterrupt:
-                    print(e)
-                    print("error")
-                    self.cap.release()
-                    cv2.destroyAllWindows()                    
-                    self.cap = cv2.VideoCapture(self.config_dict["rtsp_url"])
-                    time.sleep(3)
-                    continue
-                else:
-                    self.cap.release()
-                    cv2.destroyAllWindows()
-            
-tt = Dust_Monitor(rtsp_site="rtsp://localhost:8554/mystream")
-# tt.test2db()
-tt.vedio_stream()
+        except KeyboardInterrupt:
+            print("退出程式")
+        finally:
+            if cv2_show == True:
+                cv2.destroyAllWindows()
+            self.close()
+
+
+if __name__ == "__main__":
+    tt = Dust_Monitor()  # 使用 config.yaml 的 rtsp_url，測試時可傳入 rtsp_site="rtsp://localhost:8554/mystream"
+    # tt.test2db()
+    tt.vedio_stream()
+
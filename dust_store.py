@@ -0,0 +1,307 @@
+import itertools
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from episodes import open_episodes
+from rollup import query_rollup
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+SUMMARY_WINDOWS = ["本日", "本班", "最近一小時"]
+
+
+def list_tables(conn):
+    return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+
+def validate_table(conn, table_name):
+    """確認資料表存在後才回傳加上引號的名稱，避免把使用者輸入直接拼進 SQL"""
+    if table_name not in list_tables(conn):
+        raise ValueError("資料表不存在：{}".format(table_name))
+    return '"{}"'.format(table_name.replace('"', '""'))
+
+
+def ensure_timestamp_index(conn, table_name="dust_data"):
+    quoted = validate_table(conn, table_name)
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS "idx_{}_timestamp" ON {} ("Timestamp")'.format(
+            table_name.replace('"', '""'), quoted
+        )
+    )
+    conn.commit()
+
+
+def time_column(conn, table_name):
+    """回傳資料表的時間欄位（原始資料為 Timestamp、彙總表為 Bucket、事件與中斷為 Start），沒有則回傳 None"""
+    quoted = validate_table(conn, table_name)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info({})".format(quoted))]
+    for column in ("Timestamp", "Bucket", "Start"):
+        if column in columns:
+            return column
+    return None
+
+
+def _history_where(conn, table_name, start, end):
+    quoted = validate_table(conn, table_name)
+    column = time_column(conn, table_name)
+    if column is None or start is None or end is None:
+        return quoted, column, "", ()
+    return (
+        quoted,
+        column,
+        ' WHERE "{0}" >= ? AND "{0}" < ?'.format(column),
+        (start.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT)),
+    )
+
+
+def _archive_of(archive, table_name):
+    # 歸檔只涵蓋來源資料表，其他資料表照常只查 SQLite
+    if archive is not None and archive.table_name == table_name:
+        return archive
+    return None
+
+
+# 以下 history 函式的 archive 為 archive.DustArchive，提供時一併查詢已移出 SQLite 的歸檔，
+# 歸檔的資料排在 SQLite 的資料之前
+
+
+def history_range(conn, table_name, archive=None):
+    """資料表時間欄位的最小與最大值，經由索引取得不需掃描整張表"""
+    quoted, column, _, _ = _history_where(conn, table_name, None, None)
+    if column is None:
+        return None, None
+    # MIN 與 MAX 寫在同一個 SELECT 時 SQLite 不會使用索引的最佳化，會掃描整張表
+    first, last = conn.execute(
+        'SELECT (SELECT MIN("{0}") FROM {1}), (SELECT MAX("{0}") FROM {1})'.format(column, quoted)
+    ).fetchone()
+    archive = _archive_of(archive, table_name)
+    if archive is not None:
+        archived_first, archived_last = archive.range()
+        firsts = [value for value in (first, archived_first) if value is not None]
+        lasts = [value for value in (last, archived_last) if value is not None]
+        first, last = min(firsts, default=None), max(lasts, default=None)
+    if first is None:
+        return None, None
+    return pd.Timestamp(first), pd.Timestamp(last)
+
+
+def count_history(conn, table_name, start=None, end=None, archive=None):
+    quoted, _, where, params = _history_where(conn, table_name, start, end)
+    count = conn.execute("SELECT COUNT(*) FROM {}{}".format(quoted, where), params).fetchone()[0]
+    archive = _archive_of(archive, table_name)
+    if archive is not None:
+        count += archive.count(start, end)
+    return count
+
+
+def query_history(conn, table_name, start=None, end=None, limit=500, offset=0, archive=None):
+    """依日期區間分頁查詢，區間條件在 SQL 端經由時間索引過濾"""
+    quoted, column, where, params = _history_where(conn, table_name, start, end)
+    order = ' ORDER BY "{}"'.format(column) if column else " ORDER BY rowid"
+    archived = None
+    archive = _archive_of(archive, table_name)
+    if archive is not None:
+        archived_count = archive.count(start, end)
+        if offset < archived_count:
+            # 這一頁從歸檔開始，不足的部分再由 SQLite 補上
+            archived = archive.page(start, end, limit, offset)
+            limit -= len(archived)
+            offset = 0
+        else:
+            offset -= archived_count
+        if limit <= 0:
+            return archived
+    df = pd.read_sql_query(
+        "SELECT * FROM {}{}{} LIMIT ? OFFSET ?".format(quoted, where, order),
+        conn,
+        params=params + (limit, offset),
+    )
+    if archived is not None:
+        df = pd.concat([archived, df], ignore_index=True)
+    return df
+
+
+def iter_history(conn, table_name, start=None, end=None, chunksize=50000, archive=None):
+    """逐塊讀取區間內的資料，匯出時不需一次載入全部資料；歸檔部分每個分割為一塊"""
+    quoted, column, where, params = _history_where(conn, table_name, start, end)
+    order = ' ORDER BY "{}"'.format(column) if column else " ORDER BY rowid"
+    chunks = pd.read_sql_query(
+        "SELECT * FROM {}{}{}".format(quoted, where, order),
+        conn,
+        params=params,
+        chunksize=chunksize,
+    )
+    archive = _archive_of(archive, table_name)
+    if archive is not None:
+        return itertools.chain(archive.read(start, end), chunks)
+    return chunks
+
+
+def export_history(conn, table_name, path, start=None, end=None, file_format="csv",
+                   chunksize=50000, archive=None):
+    """將區間內的資料分塊寫入 CSV 或 Parquet 檔，回傳寫入筆數"""
+    rows, writer = 0, None
+    try:
+        for i, chunk in enumerate(iter_history(conn, table_name, start, end, chunksize, archive)):
+            if file_format == "csv":
+                chunk.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+            elif file_format == "parquet":
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    # 第一塊全為空值的欄位型別未知，先以字串欄位寫入
+                    schema = pa.schema(
+                        [
+                            field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                            for field in table.schema
+                        ]
+                    )
+                    writer = pq.ParquetWriter(path, schema, compression="zstd")
+                writer.write_table(table.cast(writer.schema))
+            else:
+                raise ValueError("不支援的匯出格式：{}".format(file_format))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def time_window(window, now=None, shift_starts=("08:00", "20:00")):
+    """回傳統計區間的 (起, 迄)，window 為 SUMMARY_WINDOWS 其中之一"""
+    now = now or datetime.now()
+    if window == "本日":
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif window == "最近一小時":
+        start = now - timedelta(hours=1)
+    elif window == "本班":
+        # 取最近一個已開始的班別，凌晨時段屬於前一天的夜班
+        candidates = []
+        for shift_start in shift_starts:
+            hour, minute = [int(part) for part in shift_start.split(":")]
+            start = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if start > now:
+                start -= timedelta(days=1)
+            candidates.append(start)
+        start = max(candidates)
+    else:
+        raise ValueError("未知的統計區間：{}".format(window))
+    return start, now
+
+
+class DustDataCache(object):
+    """儀表板用的增量資料快取：只讀取上次之後新增的資料列，並只保留最近 max_rows 筆"""
+
+    def __init__(self, db_path="dust_data.db", table_name="dust_data", max_rows=5000):
+        self.db_path = db_path
+        self.table_name = table_name
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.conn = None
+        self.quoted_table = None
+        # rowid 是資料表本身的 B-tree 鍵，用它當 watermark 不需要額外索引
+        self.watermark = 0
+        # 其他連線（寫入器）提交後 PRAGMA data_version 才會改變，可當作資料變動通知
+        self.data_version = None
+        # 快取內容每變動一次加一，讓儀表板判斷是否需要重新計算
+        self.version = 0
+        self.df = pd.DataFrame({"Timestamp": [], "Dust_Level": []})
+
+    def _connect(self):
+        if self.conn is None:
+            # 資料表還不存在（寫入端尚未寫入第一筆）時不保留連線，下次呼叫重新檢查
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            try:
+                quoted_table = validate_table(conn, self.table_name)
+            except Exception:
+                conn.close()
+                raise
+            try:
+                ensure_timestamp_index(conn, self.table_name)
+            except sqlite3.OperationalError:
+                # 寫入端正在鎖定資料庫時先略過，索引由 DustDBWriter 建立
+                pass
+            self.conn, self.quoted_table = conn, quoted_table
+        return self.conn
+
+    def _read(self, query, params):
+        df = pd.read_sql_query(query, self.conn, params=params)
+        if not df.empty:
+            df["Timestamp"] = pd.to_datetime(df["Timestamp"], errors="coerce")
+            self.watermark = int(df["_rowid"].iloc[-1])
+        return df.drop(columns="_rowid")
+
+    def refresh(self):
+        """讀取新資料並回傳目前快取的 DataFrame（請勿直接修改）"""
+        with self.lock:
+            conn = self._connect()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return self.df
+            self.data_version = data_version
+            previous_watermark = self.watermark
+
+            max_rowid = conn.execute(
+                "SELECT MAX(rowid) FROM {}".format(self.quoted_table)
+            ).fetchone()[0] or 0
+
+            if max_rowid < self.watermark:
+                # 資料庫被替換或清空，重新載入
+                self.watermark = 0
+                self.df = self.df.iloc[0:0]
+
+            if self.watermark == 0:
+                self.df = self._read(
+                    "SELECT * FROM (SELECT rowid AS _rowid, * FROM {} ORDER BY rowid DESC LIMIT ?) "
+                    "ORDER BY _rowid".format(self.quoted_table),
+                    (self.max_rows,),
+                )
+            elif max_rowid > self.watermark:
+                new_rows = self._read(
+                    "SELECT rowid AS _rowid, * FROM {} WHERE rowid > ? ORDER BY rowid".format(
+                        self.quoted_table
+                    ),
+                    (self.watermark,),
+                )
+                self.df = pd.concat([self.df, new_rows], ignore_index=True).tail(self.max_rows)
+
+            if self.watermark != previous_watermark:
+                self.version += 1
+            return self.df
+
+    def band_counts(self, start, end, yellow_line, red_line):
+        """在 SQL 端統計區間內各警戒等級的筆數，只掃描 Timestamp 索引範圍內的資料列"""
+        with self.lock:
+            conn = self._connect()
+            total, yellow, red = conn.execute(
+                'SELECT COUNT(*), SUM("Dust_Level" > ?), SUM("Dust_Level" > ?) FROM {} '
+                'WHERE "Timestamp" >= ? AND "Timestamp" <= ?'.format(self.quoted_table),
+                (yellow_line, red_line, start.strftime(TIMESTAMP_FORMAT),
+                 end.strftime(TIMESTAMP_FORMAT)),
+            ).fetchone()
+        yellow, red = yellow or 0, red or 0
+        return {"安全": total - yellow, "警告": yellow - red, "危險": red, "總數": total}
+
+    def trend(self, level, start, end, camera_id=None):
+        """長區間趨勢改讀分、時、日彙總表，level 為 minute/hour/day"""
+        with self.lock:
+            return query_rollup(self._connect(), level, start, end, camera_id)
+
+    def open_episodes(self, stale_seconds=130):
+        """進行中的警報事件，經由部分索引查詢；資料庫還沒有事件表時回傳 None"""
+        with self.lock:
+            conn = self._connect()
+            try:
+                return open_episodes(conn, stale_seconds=stale_seconds)
+            except sqlite3.OperationalError:
+                return None
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,263 @@
+import argparse
+import copy
+import sqlite3
+from collections import deque
+from datetime import datetime
+
+from config_loader import load_config, threshold_lines
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPISODE_TABLE = "alarm_episodes"
+# 事件等級，rate 為讀數快速上升
+EPISODE_LEVELS = ("yellow", "red", "rate")
+
+_UPSERT_SQL = (
+    'INSERT INTO "alarm_episodes" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT ("Camera_ID", "Level", "Start") DO UPDATE SET "End" = excluded."End", '
+    '"Updated" = excluded."Updated", "Seconds" = excluded."Seconds", "Peak" = excluded."Peak", '
+    '"Peak_Time" = excluded."Peak_Time", "Readings" = excluded."Readings", "Sum" = excluded."Sum"'
+)
+
+
+def ensure_episode_table(conn):
+    """警報事件表；End 為 NULL 的是進行中的事件，以部分索引查詢，不需掃描整張表"""
+    # Camera_ID 為主鍵的一部分，沒有攝影機編號的讀數以空字串表示
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS "alarm_episodes" ('
+        '"Camera_ID" TEXT NOT NULL DEFAULT \'\', "Level" TEXT NOT NULL, "Start" TEXT NOT NULL, '
+        '"End" TEXT, "Updated" TEXT NOT NULL, "Seconds" REAL NOT NULL, "Peak" REAL, '
+        '"Peak_Time" TEXT, "Readings" INTEGER NOT NULL, "Sum" REAL NOT NULL, '
+        'PRIMARY KEY ("Camera_ID", "Level", "Start"))'
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS "idx_alarm_episodes_start" ON "alarm_episodes" ("Start")')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS "idx_alarm_episodes_open" ON "alarm_episodes" ("Updated") '
+        'WHERE "End" IS NULL'
+    )
+    conn.commit()
+
+
+class Episode(object):
+    """一段警報事件，累計期間內的筆數、總和與峰值"""
+
+    def __init__(self, camera_id, level, start, value):
+        self.camera_id = camera_id
+        self.level = level
+        self.start = start
+        self.end = None
+        self.updated = start
+        self.peak = value
+        self.peak_time = start
+        self.readings = 1
+        self.sum = value
+        self.confirmed = False  # 持續達到 min_duration 後才寫入資料庫
+        self.last_written = None
+
+    def add(self, timestamp, value):
+        self.updated = timestamp
+        self.readings += 1
+        self.sum += value
+        if value > self.peak:
+            self.peak, self.peak_time = value, timestamp
+
+    @property
+    def seconds(self):
+        return (self.updated - self.start).total_seconds()
+
+    def row(self):
+        return (
+            self.camera_id or "",
+            self.level,
+            self.start.strftime(TIMESTAMP_FORMAT),
+            self.end.strftime(TIMESTAMP_FORMAT) if self.end is not None else None,
+            self.updated.strftime(TIMESTAMP_FORMAT),
+            self.seconds,
+            self.peak,
+            self.peak_time.strftime(TIMESTAMP_FORMAT),
+            self.readings,
+            self.sum,
+        )
+
+
+class _CameraState(object):
+    # 每台攝影機進行中的事件與變化率視窗
+    def __init__(self):
+        self.last = None
+        self.active = {}  # 等級 -> Episode
+        self.recent = deque()  # rate_window 秒內的 (時間, 讀數)
+
+
+class EpisodeDetector(object):
+    """把讀數串流轉成警報事件（開始、結束、峰值、持續時間），與 DustRollup 相同在寫入讀數的同一個交易內更新
+
+    - 遲滯：超過警戒線即開始，低於警戒線 hysteresis 以下才結束
+    - 最短持續：持續 min_duration 秒以上才記錄，較短的突波不算事件
+    - 變化率：rate_window 秒內平均每分鐘上升 rate_limit 以上時記錄 rate 事件，上升率降到一半以下結束
+    - 同攝影機兩筆讀數間隔超過 max_gap 秒（斷線）時，進行中的事件在斷線前最後一筆結束
+    進行中的事件每 update_interval 秒更新一次，End 為 NULL
+    """
+
+    def __init__(self, yellow_line=45, red_line=60, hysteresis=5, min_duration=30, rate_limit=0,
+                 rate_window=60, max_gap=120, update_interval=10):
+        self.lines = (yellow_line, red_line)
+        self.hysteresis = hysteresis
+        self.min_duration = min_duration
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.max_gap = max_gap
+        self.update_interval = update_interval
+        self.states = {}
+
+    @classmethod
+    def from_config(cls, config_dict):
+        episodes_config = config_dict.get("episodes") or {}
+        yellow, red = threshold_lines(config_dict)
+        return cls(
+            yellow,
+            red,
+            episodes_config.get("hysteresis", 5),
+            episodes_config.get("min_duration", 30),
+            episodes_config.get("rate_limit", 0),
+            episodes_config.get("rate_window", 60),
+            episodes_config.get("max_gap", 120),
+            episodes_config.get("update_interval", 10),
+        )
+
+    def save_state(self):
+        return copy.deepcopy(self.states)
+
+    def restore_state(self, states):
+        # 寫入失敗時回到交易前的狀態，下次重送同一批讀數
+        self.states = states
+
+    def _end(self, state, level, end, changed):
+        episode = state.active.pop(level)
+        episode.end = episode.updated = end
+        if episode.confirmed or episode.seconds >= self.min_duration:
+            changed.append(episode)
+
+    def update(self, timestamp, value, camera_id=None):
+        """送入一筆讀數（timestamp 為 datetime），回傳需要寫入的事件"""
+        state = self.states.get(camera_id)
+        if state is None:
+            state = self.states[camera_id] = _CameraState()
+        changed = []
+        if state.last is not None:
+            if timestamp < state.last:
+                return changed  # 時間倒退（補匯入的舊資料）不影響事件判斷
+            if (timestamp - state.last).total_seconds() > self.max_gap:
+                for level in list(state.active):
+                    self._end(state, level, state.last, changed)
+                state.recent.clear()
+        state.last = timestamp
+
+        for level, line in zip(EPISODE_LEVELS, self.lines):
+            episode = state.active.get(level)
+            if episode is None:
+                if value > line:
+                    state.active[level] = Episode(camera_id, level, timestamp, value)
+            elif value < line - self.hysteresis:
+                self._end(state, level, timestamp, changed)
+            else:
+                episode.add(timestamp, value)
+
+        if self.rate_limit:
+            state.recent.append((timestamp, value))
+            while (timestamp - state.recent[0][0]).total_seconds() > self.rate_window:
+                state.recent.popleft()
+            first_time, first_value = state.recent[0]
+            span = (timestamp - first_time).total_seconds()
+            rise = (value - first_value) * 60 / span if span > 0 else 0.0
+            episode = state.active.get("rate")
+            if episode is None:
+                if rise >= self.rate_limit:
+                    state.active["rate"] = Episode(camera_id, "rate", timestamp, value)
+            elif rise < self.rate_limit / 2:
+                self._end(state, "rate", timestamp, changed)
+            else:
+                episode.add(timestamp, value)
+
+        for episode in state.active.values():
+            if not episode.confirmed:
+                if episode.level == "rate" or episode.seconds >= self.min_duration:
+                    episode.confirmed = True
+                    episode.last_written = timestamp
+                    changed.append(episode)
+            elif (timestamp - episode.last_written).total_seconds() >= self.update_interval:
+                episode.last_written = timestamp
+                changed.append(episode)
+        return changed
+
+    def apply(self, conn, rows):
+        """rows: (Timestamp, Dust_Level, Camera_ID)，與原始讀數在同一個交易內寫入事件"""
+        changed = []
+        for timestamp, val, camera_id in sorted(rows, key=lambda row: row[0]):
+            changed.extend(
+                self.update(datetime.strptime(timestamp, TIMESTAMP_FORMAT), float(val), camera_id)
+            )
+        if changed:
+            conn.executemany(_UPSERT_SQL, [episode.row() for episode in changed])
+        return changed
+
+    def finish(self, conn):
+        """結束所有進行中的事件（在最後一筆讀數結束），程式關閉時呼叫"""
+        changed = []
+        for state in self.states.values():
+            for level in list(state.active):
+                self._end(state, level, state.last, changed)
+        if changed:
+            conn.executemany(_UPSERT_SQL, [episode.row() for episode in changed])
+        return changed
+
+
+def open_episodes(conn, now=None, stale_seconds=130):
+    """進行中的事件 [(Camera_ID, Level, Start, Peak)]，超過 stale_seconds 沒有更新的（程式已停止）不列入"""
+    now = now or datetime.now()
+    cutoff = datetime.fromtimestamp(now.timestamp() - stale_seconds).strftime(TIMESTAMP_FORMAT)
+    return conn.execute(
+        'SELECT "Camera_ID", "Level", "Start", "Peak" FROM "alarm_episodes" '
+        'WHERE "End" IS NULL AND "Updated" >= ? ORDER BY "Start"',
+        (cutoff,),
+    ).fetchall()
+
+
+def episode_summary(conn, start=None, end=None):
+    """區間內各等級的事件數、總持續秒數、最長持續與最高峰值，安全報表使用"""
+    where, params = "", ()
+    if start is not None and end is not None:
+        where, params = ' WHERE "Start" >= ? AND "Start" < ?', (
+            start.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT))
+    return conn.execute(
+        'SELECT "Level", COUNT(*), SUM("Seconds"), MAX("Seconds"), MAX("Peak") '
+        'FROM "alarm_episodes"{} GROUP BY "Level"'.format(where),
+        params,
+    ).fetchall()
+
+
+if __name__ == "__main__":
+    from archive import DustArchive
+    from dust_store import iter_history
+
+    parser = argparse.ArgumentParser(description="由原始讀數（含歸檔）重建警報事件表")
+    parser.add_argument("--db", default="dust_data.db")
+    parser.add_argument("--table", default="dust_data")
+    parser.add_argument("--config", default="config.yaml")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    archive = DustArchive.from_config(config, args.table)
+    conn = sqlite3.connect(args.db)
+    ensure_episode_table(conn)
+    conn.execute('DELETE FROM "alarm_episodes"')
+    detector = EpisodeDetector.from_config(config)
+    count = 0
+    for chunk in iter_history(conn, args.table, archive=archive if archive.covers(args.db, args.table) else None):
+        camera = chunk["Camera_ID"] if "Camera_ID" in chunk else [None] * len(chunk)
+        rows = [(t, v, c if isinstance(c, str) else None)
+                for t, v, c in zip(chunk["Timestamp"], chunk["Dust_Level"], camera) if v == v]
+        detector.apply(conn, rows)
+        count += len(rows)
+    conn.commit()
+    total = conn.execute('SELECT COUNT(*) FROM "alarm_episodes"').fetchone()[0]
+    print("{} 筆讀數，{} 個事件".format(count, total))
+    conn.close()
@@ -0,0 +1,376 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+from datetime import datetime
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from config_loader import file_version, load_config
+from dust_cv import Dust_Monitor, UserCaseException
+from roi import RoiMapper
+from stream_reader import Backoff, open_capture
+
+# 共享記憶體開頭的控制區：最新影像序號、擷取端是否運作中
+_CONTROL = 2
+_LATEST, _ALIVE = 0, 1
+
+
+class FrameBus(object):
+    """共享記憶體中的影像環狀緩衝，擷取行程直接解碼進槽位，分析與預覽行程取得槽位的 view 而不複製
+
+    每個槽位記錄 (序號, 擷取時間)；寫入中序號為 -1，讀取端用完後比對序號確認沒有被覆寫
+    """
+
+    def __init__(self, name=None, shape=(1080, 1920, 3), slots=8, create=False):
+        self.shape = tuple(shape)
+        self.slots = slots
+        frame_size = int(np.prod(self.shape))
+        meta_size = 8 * (_CONTROL + 2 * slots)
+        if create:
+            self.shm = shared_memory.SharedMemory(
+                name=name, create=True, size=meta_size + slots * frame_size
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.control = np.ndarray((_CONTROL,), dtype=np.int64, buffer=self.shm.buf)
+        self.meta = np.ndarray(
+            (slots, 2), dtype=np.int64, buffer=self.shm.buf, offset=8 * _CONTROL
+        )
+        self.frames = np.ndarray(
+            (slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf, offset=meta_size
+        )
+        if create:
+            self.control[:] = 0
+            self.meta[:] = 0
+
+    def next_slot(self):
+        """擷取端：取得下一個要寫入的槽位，回傳 (序號, 槽位 view)"""
+        seq = int(self.control[_LATEST]) + 1
+        index = seq % self.slots
+        self.meta[index, 0] = -1
+        return seq, self.frames[index]
+
+    def commit(self, seq, captured_at=None):
+        """擷取端：槽位寫入完成後公開給讀取端"""
+        index = seq % self.slots
+        self.meta[index, 1] = time.monotonic_ns() if captured_at is None else captured_at
+        self.meta[index, 0] = seq
+        self.control[_LATEST] = seq
+
+    def publish(self, frame):
+        seq, slot = self.next_slot()
+        np.copyto(slot, frame)
+        self.commit(seq)
+        return seq
+
+    def latest(self):
+        """回傳最新完整影像 (序號, 擷取時間, view)，沒有影像時回傳 None"""
+        seq = int(self.control[_LATEST])
+        if seq == 0:
+            return None
+        index = seq % self.slots
+        captured_at = int(self.meta[index, 1])
+        if self.meta[index, 0] != seq:
+            return None
+        return seq, captured_at, self.frames[index]
+
+    def valid(self, seq):
+        """讀取端：確認序號 seq 的槽位尚未被覆寫"""
+        return self.meta[seq % self.slots, 0] == seq
+
+    @property
+    def alive(self):
+        return bool(self.control[_ALIVE])
+
+    @alive.setter
+    def alive(self, value):
+        self.control[_ALIVE] = int(value)
+
+    def close(self):
+        # 先釋放指向共享記憶體的陣列，否則 close() 會因仍有 view 而失敗
+        self.control = self.meta = self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            print("FrameBus 仍有影像被引用，略過關閉")
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedFrameReader(object):
+    """以 LatestFrameReader 的介面讀取 FrameBus，read() 回傳的是共享記憶體的 view"""
+
+    def __init__(self, bus, max_age=1.0, poll_interval=0.002, read_timeout=5.0):
+        self.bus = bus
+        self.max_age_ns = int(max_age * 1e9)
+        self.poll_interval = poll_interval
+        self.read_timeout = read_timeout
+        self.last_seq = int(bus.control[_LATEST])
+        # 重連由擷取行程負責，這裡只記錄超過 read_timeout 沒有影像的區間
+        self.last_frame = time.monotonic()
+        self.last_frame_time = datetime.now()
+        self.outage = None
+        self.gaps = []
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.frames_stale = 0
+        self.frames_torn = 0
+
+    def read(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            latest = self.bus.latest()
+            if latest is not None and latest[0] > self.last_seq:
+                seq, captured_at, frame = latest
+                self.frames_dropped += seq - self.last_seq - 1
+                self.last_seq = seq
+                if time.monotonic_ns() - captured_at > self.max_age_ns:
+                    self.frames_stale += 1
+                    continue
+                self.frames_read += 1
+                self.last_frame = time.monotonic()
+                self.last_frame_time = datetime.now()
+                if self.outage is not None:
+                    self.gaps.append((self.outage, self.last_frame_time, "stall"))
+                    self.outage = None
+                return True, frame
+            if self.outage is None and time.monotonic() - self.last_frame > self.read_timeout:
+                self.outage = self.last_frame_time
+            if not self.bus.alive or time.monotonic() >= deadline:
+                return False, None
+            time.sleep(self.poll_interval)
+
+    def pop_gaps(self):
+        gaps, self.gaps = self.gaps, []
+        return gaps
+
+    def frame_valid(self):
+        """上一張 read() 的影像是否仍未被擷取端覆寫"""
+        if self.bus.valid(self.last_seq):
+            return True
+        self.frames_torn += 1
+        return False
+
+    def isOpened(self):
+        return self.bus.control is not None and self.bus.alive
+
+    def release(self):
+        # FrameBus 由建立者關閉，讀取端不持有擷取資源
+        if self.outage is not None:
+            self.gaps.append((self.outage, datetime.now(), "stall"))
+            self.outage = None
+
+    def stats(self):
+        return {
+            "frames_read": self.frames_read,
+            "frames_dropped": self.frames_dropped,
+            "frames_stale": self.frames_stale,
+            "frames_torn": self.frames_torn,
+            "latest_seq": int(self.bus.control[_LATEST]),
+        }
+
+
+def capture_process(url, bus_name, ready_queue, stop_event, slots=8, reconnect_interval=3,
+                    open_timeout=10.0, read_timeout=5.0):
+    """擷取行程：依第一張影像的大小建立 FrameBus，之後每張影像直接解碼進槽位
+
+    開啟與讀取都設定逾時，卡住的連線會讓 grab() 失敗並重連，不會讓擷取行程永遠停住；
+    串流解析度改變時槽位大小不再相符，將新的大小放進 ready_queue 後結束，由 run() 重建 FrameBus
+    """
+    cap = open_capture(url, open_timeout, read_timeout)
+    status, frame = cap.read()
+    if not status:
+        ready_queue.put(None)
+        return
+    bus = FrameBus(bus_name, frame.shape, slots, create=True)
+    bus.publish(frame)
+    bus.alive = True
+    ready_queue.put(frame.shape)
+    frame = slot = image = None
+    parent = multiprocessing.parent_process()
+    backoff = Backoff(reconnect_interval)
+
+    try:
+        # 主行程異常結束時不會設定 stop_event，擷取行程也一併結束
+        while not stop_event.is_set() and (parent is None or parent.is_alive()):
+            if not cap.grab():
+                cap.release()
+                stop_event.wait(backoff.next())
+                cap = open_capture(url, open_timeout, read_timeout)
+                continue
+            captured_at = time.monotonic_ns()
+            seq, slot = bus.next_slot()
+            # 影像大小相符時 OpenCV 直接寫入 slot，不另外配置記憶體
+            status, image = cap.retrieve(slot)
+            if not status:
+                continue
+            if image.shape != bus.shape:
+                print("串流解析度改變：{} -> {}".format(bus.shape, image.shape))
+                ready_queue.put(image.shape)
+                break
+            bus.commit(seq, captured_at)
+            backoff.reset()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bus.alive = False
+        cap.release()
+        slot = image = None
+        bus.close()
+        bus.unlink()
+
+
+def preview_process(bus_name, shape, stop_event, slots=8, roi_config=None,
+                    snapshot_folder="./save_image"):
+    """預覽行程：顯示最新影像與 ROI，按 s 存檔、按 q 結束整個程式，不影響分析速度"""
+    bus = FrameBus(bus_name, shape, slots)
+    roi = RoiMapper.from_config(roi_config)
+    last_seq, frame = 0, None
+    config_version, next_reload_check = file_version("config.yaml"), time.monotonic() + 1
+    try:
+        while not stop_event.is_set() and bus.alive:
+            if time.monotonic() >= next_reload_check:
+                # 與分析行程相同，config.yaml 修改後更新預覽的 ROI
+                next_reload_check = time.monotonic() + 1
+                version = file_version("config.yaml")
+                if version != config_version:
+                    config_version = version
+                    try:
+                        roi = RoiMapper.from_config(load_config().get("roi"))
+                    except Exception as e:
+                        print("config.yaml 重新載入失敗：{}".format(e))
+            latest = bus.latest()
+            if latest is None or latest[0] == last_seq:
+                time.sleep(0.01)
+                continue
+            last_seq, _, frame = latest
+            preview, crop = roi.preview(frame), roi.extract(frame)
+            if not bus.valid(last_seq):
+                continue
+            cv2.imshow("Webcam", preview)
+            cv2.namedWindow("crop", 0)
+            cv2.resizeWindow("crop", 400, 280)
+            cv2.imshow("crop", crop)
+            key = cv2.waitKey(1) & 0xFF
+            if key == ord("q"):
+                print("退出程式")
+                stop_event.set()
+            elif key == ord("s"):
+                snapshot = frame.copy()
+                if bus.valid(last_seq):
+                    name = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+                    cv2.imwrite(os.path.join(snapshot_folder, "{}.jpg".format(name)), snapshot)
+                    print("{}.jpg 存檔".format(name))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cv2.destroyAllWindows()
+        latest = frame = None
+        bus.close()
+
+
+class BusDustMonitor(Dust_Monitor):
+    """從 FrameBus 讀取影像的 Dust_Monitor，串流連線與重連由擷取行程負責"""
+
+    def __init__(self, bus, **kwargs):
+        self.bus = bus
+        super().__init__(**kwargs)
+
+    def open_stream(self, url):
+        capture_config = self.config_dict.get("capture") or {}
+        return SharedFrameReader(
+            self.bus,
+            capture_config.get("max_frame_age", 1.0),
+            read_timeout=capture_config.get("read_timeout", 5.0),
+        )
+
+    def process_frame(self, frame):
+        # 只有 ROI 會讀取整張影像，取出後確認槽位沒有在讀取期間被覆寫
+        started = time.perf_counter()
+        image_crop = self.roi.extract(frame)
+        self.stage_timers["roi"].observe(time.perf_counter() - started)
+        if not self.cap.frame_valid():
+            return None
+        return self.process_crop(image_crop)
+
+
+def run(slots=8, preview=True):
+    """啟動擷取、預覽行程，並在主行程分析影像；串流解析度改變時以新的大小重新啟動"""
+    ctx = multiprocessing.get_context("spawn")
+    session = 0
+    while True:
+        resized = run_session(ctx, "dust_bus_{}_{}".format(os.getpid(), session), slots, preview)
+        if resized is None:
+            break
+        print("以新的解析度 {} 重建 FrameBus".format(resized))
+        session += 1
+
+
+def run_session(ctx, bus_name, slots=8, preview=True):
+    """執行一次擷取、預覽與分析，擷取行程因解析度改變而結束時回傳新的影像大小，否則回傳 None"""
+    stop_event = ctx.Event()
+    ready_queue = ctx.Queue()
+    monitor_config = Dust_Monitor.process_config_file()
+    url = monitor_config["rtsp_url"]
+    capture_config = monitor_config.get("capture") or {}
+
+    capture = ctx.Process(
+        target=capture_process,
+        args=(url, bus_name, ready_queue, stop_event, slots),
+        kwargs={
+            "open_timeout": capture_config.get("open_timeout", 10.0),
+            "read_timeout": capture_config.get("read_timeout", 5.0),
+        },
+        daemon=True,
+    )
+    capture.start()
+    try:
+        shape = ready_queue.get(timeout=30)
+    except queue.Empty:
+        shape = None
+    if shape is None:
+        stop_event.set()
+        raise UserCaseException("無法開啟串流：{}".format(url))
+
+    bus = FrameBus(bus_name, shape, slots)
+    workers = [capture]
+    if preview:
+        viewer = ctx.Process(
+            target=preview_process,
+            args=(bus_name, shape, stop_event, slots, monitor_config.get("roi")),
+            daemon=True,
+        )
+        viewer.start()
+        workers.append(viewer)
+
+    monitor = BusDustMonitor(bus)
+    try:
+        # 預覽由 preview_process 負責，擷取行程結束後 vedio_stream 隨即返回
+        monitor.vedio_stream(cv2_show=False)
+    except KeyboardInterrupt:
+        print("退出程式")
+        return None
+    finally:
+        stop_event.set()
+        monitor.close()
+        bus.close()
+        for worker in workers:
+            worker.join(timeout=5)
+    try:
+        return ready_queue.get(timeout=1)
+    except queue.Empty:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以共享記憶體分離擷取、分析與預覽行程")
+    parser.add_argument("--slots", type=int, default=8, help="環狀緩衝的影像張數")
+    parser.add_argument("--no-preview", action="store_true", help="不開啟預覽視窗")
+    args = parser.parse_args()
+    run(args.slots, not args.no_preview)
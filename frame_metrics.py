@@ -0,0 +1,115 @@
+import time
+
+import cv2
+import numpy as np
+
+# 可用的指標，dust_cv.py 原本的 algorithm_hist / algorithm_contrast 對應 hist / contrast
+METRICS = ("hist", "contrast", "intensity", "edges")
+
+# 正規化上下界：max 為乾淨畫面的值，min 為粉塵最多時的值
+# 亮度這類粉塵越多數值越大的指標，max 小於 min 即可反向
+DEFAULT_BOUNDS = {
+    "hist": {"max": 1.0, "min": 0.0},
+    "intensity": {"max": 80.0, "min": 200.0},
+    "edges": {"max": 0.2, "min": 0.0},
+}
+
+
+class FrameAnalyzer(object):
+    """ROI 影像只轉一次灰階，再計算設定中啟用的所有指標，並依權重合成 0~100 的粉塵分數
+
+    灰階、Laplacian、邊緣與直方圖都使用預先配置的緩衝，ROI 大小不變時每張影像不再配置記憶體
+    """
+
+    def __init__(self, init_hist, metrics=None, bounds=None, canny=(50, 150)):
+        metrics = metrics or {"hist": 1.0}
+        for name in metrics:
+            if name not in METRICS:
+                raise ValueError("未知的指標：{}".format(name))
+        # 權重為 0 的指標不計算
+        self.metrics = [name for name in METRICS if metrics.get(name, 0)]
+        if not self.metrics:
+            raise ValueError("至少需要啟用一個指標")
+        weights = np.array([metrics[name] for name in self.metrics], dtype=np.float64)
+        self.weights = weights / weights.sum()
+
+        self.set_bounds(bounds)
+
+        self.canny = tuple(canny)
+        self.values = np.zeros(len(self.metrics), dtype=np.float64)
+        # 每個步驟最近一次的耗時（秒），第一格為灰階轉換，其餘依 self.metrics 的順序
+        self.stages = ["gray"] + self.metrics
+        self.durations = np.zeros(len(self.stages), dtype=np.float64)
+        self.hist = np.zeros((256, 1), dtype=np.float32)
+        self.shape = None
+        self.set_reference(init_hist)
+
+    @classmethod
+    def from_config(cls, analysis_config, init_hist, max_min=None):
+        """max_min 為 Dust_Monitor 的校正上下界，設定檔中的 bounds 會覆蓋它"""
+        analysis_config = analysis_config or {}
+        bounds = dict(max_min or {})
+        bounds.update(analysis_config.get("bounds") or {})
+        return cls(
+            init_hist,
+            analysis_config.get("metrics"),
+            bounds,
+            analysis_config.get("canny", (50, 150)),
+        )
+
+    def set_bounds(self, bounds):
+        """更新正規化上下界，未提供的指標使用 DEFAULT_BOUNDS"""
+        bounds = dict(DEFAULT_BOUNDS, **(bounds or {}))
+        for name in self.metrics:
+            if name not in bounds:
+                raise ValueError("指標 {} 缺少正規化上下界".format(name))
+            if bounds[name]["max"] == bounds[name]["min"]:
+                raise ValueError("指標 {} 的上下界相同".format(name))
+        high = np.array([bounds[name]["max"] for name in self.metrics], dtype=np.float64)
+        low = np.array([bounds[name]["min"] for name in self.metrics], dtype=np.float64)
+        # 先算好再一起替換，分析中途更新也不會用到一半新一半舊的值
+        self.bias, self.scale = high, 100 / (high - low)
+
+    def set_reference(self, init_hist):
+        # 相關係數不受直方圖縮放影響，參考直方圖只需轉成與計算結果相同的型別
+        self.init_hist = np.asarray(init_hist, dtype=np.float32).reshape(256, 1)
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.gray = np.empty(shape[:2], dtype=np.uint8)
+        self.shifted = np.empty(shape[:2], dtype=np.uint8)
+        self.laplacian = np.empty(shape[:2], dtype=np.int16)
+        self.edges = np.empty(shape[:2], dtype=np.uint8)
+
+    def analyze(self, image):
+        """計算各指標的原始值，依 self.metrics 的順序寫入 self.values 並回傳"""
+        if image.shape != self.shape:
+            self._allocate(image.shape)
+        started = time.perf_counter()
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        for i, name in enumerate(self.metrics):
+            finished = time.perf_counter()
+            self.durations[i] = finished - started
+            started = finished
+            if name == "hist":
+                cv2.calcHist([gray], [0], None, [256], [0, 256], hist=self.hist)
+                self.values[i] = cv2.compareHist(self.hist, self.init_hist, cv2.HISTCMP_CORREL)
+            elif name == "contrast":
+                # 與 algorithm_contrast 相同；8 位元灰階的 Laplacian 落在 int16 範圍內不會失真，變異數以 double 累加
+                cv2.convertScaleAbs(gray, dst=self.shifted, alpha=1, beta=50)
+                cv2.Laplacian(self.shifted, cv2.CV_16S, dst=self.laplacian)
+                _, std = cv2.meanStdDev(self.laplacian)
+                self.values[i] = std[0, 0] ** 2
+            elif name == "intensity":
+                self.values[i] = cv2.mean(gray)[0]
+            elif name == "edges":
+                cv2.Canny(gray, self.canny[0], self.canny[1], edges=self.edges)
+                self.values[i] = cv2.countNonZero(self.edges) / self.edges.size
+        self.durations[-1] = time.perf_counter() - started
+        return self.values
+
+    def score(self, image):
+        """各指標正規化到 0~100 後依權重加總"""
+        values = self.analyze(image)
+        return float(np.dot(self.weights, np.clip(self.scale * (self.bias - values), 0, 100)))
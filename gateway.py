@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import json
+import math
+import re
+import time
+from datetime import datetime
+
+from config_loader import load_config
+from db_writer import DustDBWriter
+from episodes import EpisodeDetector
+from metrics import registry, start_http_server, stop_http_server
+from rollup import DustRollup
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+CAMERA_PATTERN = re.compile(r"^[\w.-]{1,64}$")
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class ReadingValidator(object):
+    """檢查外部送入的讀數並轉成 (Timestamp, Dust_Level, Camera_ID)
+
+    每筆讀數可為 {"Timestamp", "Dust_Level", "Camera_ID"}（與 CSV 欄位相同）或 [時間, 數值, 攝影機]；
+    時間可省略（使用收到的時間）、為 "%Y-%m-%d %H:%M:%S" 字串或 Unix 秒數，攝影機可省略
+    """
+
+    def __init__(self, min_value=0, max_value=100, max_future=300):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.max_future = max_future  # 允許比本機時鐘快幾秒
+
+    def validate(self, item, now):
+        if isinstance(item, dict):
+            timestamp, value, camera_id = (
+                item.get("Timestamp"), item.get("Dust_Level"), item.get("Camera_ID"))
+        elif isinstance(item, list) and 2 <= len(item) <= 3:
+            timestamp, value, camera_id = (list(item) + [None])[:3]
+        else:
+            raise ValueError("讀數格式錯誤")
+
+        if timestamp is None:
+            moment = datetime.fromtimestamp(now)
+        elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+            moment = datetime.fromtimestamp(timestamp)
+        elif isinstance(timestamp, str):
+            moment = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        else:
+            raise ValueError("Timestamp 格式錯誤")
+        if moment.timestamp() > now + self.max_future:
+            raise ValueError("Timestamp 晚於現在時間")
+
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError("Dust_Level 必須為數值")
+        value = float(value)
+        if not math.isfinite(value) or not self.min_value <= value <= self.max_value:
+            raise ValueError("Dust_Level 超出範圍 {}~{}".format(self.min_value, self.max_value))
+
+        if camera_id is not None and (
+            not isinstance(camera_id, str) or not CAMERA_PATTERN.match(camera_id)
+        ):
+            raise ValueError("Camera_ID 格式錯誤")
+        return moment.strftime(TIMESTAMP_FORMAT), value, camera_id
+
+    def validate_batch(self, items):
+        """回傳 (有效的讀數, [(索引, 錯誤訊息)])，無效的讀數個別略過不影響其他讀數"""
+        now = time.time()
+        rows, errors = [], []
+        for i, item in enumerate(items):
+            try:
+                rows.append(self.validate(item, now))
+            except (ValueError, TypeError, OverflowError, OSError) as e:
+                errors.append((i, str(e)))
+        return rows, errors
+
+
+def parse_batch(body):
+    """JSON 內容可為讀數陣列或 {"readings": [...]}"""
+    data = json.loads(body)
+    if isinstance(data, dict):
+        data = data.get("readings")
+    if not isinstance(data, list):
+        raise ValueError("內容必須為讀數陣列或 {\"readings\": [...]}")
+    return data
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    # 每個封包為一批讀數，UDP 無法回覆背壓，忙碌或超過 max_batch 時整批丟棄並計數
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def datagram_received(self, data, addr):
+        try:
+            items = parse_batch(data)
+        except ValueError:
+            self.gateway.rejected += 1
+            registry.inc("gateway_rejected_total", reason="malformed", transport="udp")
+            return
+        if len(items) > self.gateway.max_batch:
+            # 與 HTTP 的 413 相同整批拒收，不只寫入前 max_batch 筆
+            self.gateway.rejected += len(items)
+            registry.inc("gateway_rejected_total", len(items), reason="too_large", transport="udp")
+            return
+        self.gateway.ingest(items, "udp")
+
+
+class IngestGateway(object):
+    """接收外部感測器與其他分析程式批次送入的讀數，驗證後交給同一個 DustDBWriter 寫入
+
+    - HTTP：POST /readings（JSON），GET /health 回傳統計
+    - UDP：每個封包為一批 JSON 讀數
+    已接受但尚未寫入資料庫的讀數超過 max_pending 時，HTTP 回覆 503 與 Retry-After，由送出端稍後重送
+    """
+
+    def __init__(self, writer, validator=None, host="127.0.0.1", http_port=8765, udp_port=None,
+                 max_batch=5000, max_body=1 << 20, max_pending=20000, idle_timeout=30):
+        self.writer = writer
+        self.validator = validator or ReadingValidator()
+        self.host = host
+        self.http_port = http_port
+        self.udp_port = udp_port
+        self.max_batch = max_batch
+        self.max_body = max_body
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+
+        self.accepted = 0
+        self.rejected = 0
+        self.busy = 0
+        self.request_timer = registry.histogram("gateway_request_seconds")
+
+    @classmethod
+    def from_config(cls, config_dict, writer):
+        gateway_config = config_dict.get("gateway") or {}
+        return cls(
+            writer,
+            ReadingValidator(
+                gateway_config.get("min_value", 0),
+                gateway_config.get("max_value", 100),
+                gateway_config.get("max_future_seconds", 300),
+            ),
+            gateway_config.get("host", "127.0.0.1"),
+            gateway_config.get("http_port", 8765),
+            gateway_config.get("udp_port"),
+            gateway_config.get("max_batch", 5000),
+            gateway_config.get("max_body", 1 << 20),
+            gateway_config.get("max_pending", 20000),
+        )
+
+    @property
+    def pending(self):
+        # 已交給寫入器但還沒寫入（或被丟棄）的讀數
+        return self.accepted - self.writer.rows_written - self.writer.rows_dropped
+
+    def stats(self):
+        stats = {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "busy": self.busy,
+            "pending": self.pending,
+        }
+        stats.update(("writer_" + key, value) for key, value in self.writer.stats().items())
+        return stats
+
+    def _collect(self):
+        return [("gateway_pending", {}, self.pending)]
+
+    def ingest(self, items, transport):
+        """驗證並放入寫入器，回傳 (接受筆數, 錯誤清單)；忙碌時接受筆數為 None，整批都不寫入"""
+        rows, errors = self.validator.validate_batch(items)
+        if errors:
+            self.rejected += len(errors)
+            registry.inc("gateway_rejected_total", len(errors), reason="invalid", transport=transport)
+        if not rows:
+            return 0, errors
+        # 整批放入佇列，不會只寫入一部分
+        if self.pending + len(rows) > self.max_pending or not self.writer.write_batch(rows):
+            self.busy += len(rows)
+            registry.inc("gateway_rejected_total", len(rows), reason="busy", transport=transport)
+            return None, errors
+        self.accepted += len(rows)
+        registry.inc("gateway_readings_total", len(rows), transport=transport)
+        return len(rows), errors
+
+    def _route(self, method, path, body):
+        if path == "/health":
+            if method != "GET":
+                return 405, {"error": "只接受 GET"}, {}
+            return 200, self.stats(), {}
+        if path != "/readings":
+            return 404, {"error": "找不到 {}".format(path)}, {}
+        if method != "POST":
+            return 405, {"error": "只接受 POST"}, {}
+        try:
+            items = parse_batch(body)
+        except ValueError as e:
+            return 400, {"error": str(e)}, {}
+        if len(items) > self.max_batch:
+            return 413, {"error": "單次最多 {} 筆".format(self.max_batch)}, {}
+
+        accepted, errors = self.ingest(items, "http")
+        rejected = [{"index": i, "error": message} for i, message in errors[:100]]
+        if accepted is None:
+            return 503, {"error": "寫入佇列已滿，請稍後重送", "rejected": rejected}, {"Retry-After": "1"}
+        return (200 if accepted or not errors else 400), {"accepted": accepted, "rejected": rejected}, {}
+
+    async def _respond(self, writer, status, payload, headers, keep_alive):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        lines = [
+            "HTTP/1.1 {} {}".format(status, REASONS.get(status, "")),
+            "Content-Type: application/json; charset=utf-8",
+            "Content-Length: {}".format(len(body)),
+            "Connection: {}".format("keep-alive" if keep_alive else "close"),
+        ]
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _handle_http(self, reader, writer):
+        # 只實作本機送資料需要的 HTTP/1.1 子集：Content-Length 內容與 keep-alive，不支援 chunked
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line:
+                    break
+                started = time.perf_counter()
+                parts = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self._respond(writer, 400, {"error": "請求格式錯誤"}, {}, False)
+                    break
+                method, path, version = parts
+                if "transfer-encoding" in headers:
+                    await self._respond(writer, 411, {"error": "需要 Content-Length"}, {}, False)
+                    break
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > self.max_body:
+                    await self._respond(writer, 413, {"error": "內容超過 {} bytes".format(self.max_body)},
+                                        {}, False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout)
+
+                status, payload, extra = self._route(method, path.split("?")[0], body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, payload, extra, keep_alive)
+                self.request_timer.observe(time.perf_counter() - started)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        server = await asyncio.start_server(self._handle_http, self.host, self.http_port)
+        print("gateway: http://{}:{}/readings".format(self.host, self.http_port))
+        transport = None
+        if self.udp_port:
+            transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _UDPProtocol(self), local_addr=(self.host, self.udp_port))
+            print("gateway: udp://{}:{}".format(self.host, self.udp_port))
+        registry.add_collector(self._collect)
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            registry.remove_collector(self._collect)
+            if transport is not None:
+                transport.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("退出程式")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="接收 HTTP/UDP 批次讀數並寫入資料庫")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--table", default="dust_data")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    gateway_config = config.get("gateway") or {}
+    db_writer = DustDBWriter(
+        gateway_config.get("db_file", "dust_data.db"),
+        args.table,
+        batch_size=500,
+        rollup=DustRollup.from_config(config, args.table),
+        episodes=EpisodeDetector.from_config(config),
+    ).start()
+    metrics_server = start_http_server(config.get("metrics"))
+    try:
+        IngestGateway.from_config(config, db_writer).run()
+    finally:
+        db_writer.close()
+        stop_http_server(metrics_server)
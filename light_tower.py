@@ -0,0 +1,274 @@
+import abc
+import os
+import queue
+import subprocess
+import threading
+import time
+
+from config_loader import threshold_lines
+
+# 燈號等級，索引即為嚴重程度
+LEVELS = ("normal", "yellow", "red")
+_STOP = object()
+
+
+class SerialDriver(abc.ABC):
+    """警示燈繼電器的驅動介面，控制器在自己的執行緒內呼叫；缺少任一方法的驅動無法建立"""
+
+    @abc.abstractmethod
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def write(self, data):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class PySerialDriver(SerialDriver):
+    """直接開啟 CH34x 序列埠並保持開啟，與 Comport.exe 相同以 9600 8N1 傳送指令"""
+
+    def __init__(self, port="COM3", baudrate=9600, timeout=1.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.serial = None
+
+    def open(self):
+        import serial  # pyserial，只有使用序列埠時才需要安裝
+
+        self.serial = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+
+    def write(self, data):
+        self.serial.write(data)
+        self.serial.flush()
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+
+class ComportExeDriver(SerialDriver):
+    """沿用 Light/Red/ON|OFF 的 Comport.exe，每個指令啟動一次執行檔"""
+
+    def __init__(self, folder="Light/Red", timeout=10):
+        self.executables = {
+            b"1": os.path.join(folder, "ON", "Debug", "Comport.exe"),
+            b"0": os.path.join(folder, "OFF", "Debug", "Comport.exe"),
+        }
+        self.timeout = timeout
+
+    def open(self):
+        for path in self.executables.values():
+            if not os.path.isfile(path):
+                raise FileNotFoundError("Red light執行檔不存在!! {}".format(path))
+
+    def write(self, data):
+        subprocess.run([self.executables[data]], check=True, timeout=self.timeout)
+
+    def close(self):
+        pass
+
+
+class LoopbackDriver(SerialDriver):
+    """不接硬體，只記錄寫入的指令，用於測試與開發"""
+
+    def __init__(self):
+        self.opened = False
+        self.written = []  # [(time.monotonic(), 指令)]
+
+    def open(self):
+        self.opened = True
+
+    def write(self, data):
+        if not self.opened:
+            raise IOError("序列埠尚未開啟")
+        self.written.append((time.monotonic(), data))
+
+    def close(self):
+        self.opened = False
+
+
+DRIVERS = {
+    "serial": PySerialDriver,
+    "comport_exe": ComportExeDriver,
+    "loopback": LoopbackDriver,
+}
+
+
+class LightTowerController(object):
+    """在背景執行緒依讀數控制警示燈，update() 不會阻塞影像分析
+
+    - 遲滯：超過警戒線即升級，低於警戒線 hysteresis 以下才降級
+    - 去彈跳：新的等級需維持 debounce 秒才生效
+    - 只有繼電器狀態改變時才送出指令
+    - 超過 stale_seconds 沒有讀數的攝影機不再列入判斷，停止回報的攝影機不會讓燈一直亮著
+    """
+
+    def __init__(self, driver, yellow_line=45, red_line=60, alarm_level="red", hysteresis=5,
+                 debounce=0, on_command=b"1", off_command=b"0", retry_interval=30, stale_seconds=60):
+        if alarm_level not in LEVELS[1:]:
+            raise ValueError("alarm_level 必須為 yellow 或 red")
+        self.driver = driver
+        self.lines = (yellow_line, red_line)
+        self.alarm_level = LEVELS.index(alarm_level)
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.commands = {True: on_command, False: off_command}
+        self.retry_interval = retry_interval
+        self.stale_seconds = stale_seconds  # 0 為不過期
+
+        self.events = queue.Queue()
+        self.thread = None
+        self.latest = {}  # 各攝影機最新的 (時間, 讀數)，多攝影機時以最大值判斷
+        self.level = 0
+        self.candidate = None  # (等級, 開始時間)
+        self.relay = None  # 繼電器目前狀態，None 為未知
+        self.opened = False
+        self.last_open_attempt = None
+
+        self.commands_sent = 0
+        self.write_errors = 0
+        self.last_latency = None
+
+    @classmethod
+    def from_config(cls, config_dict):
+        """config.yaml 沒有 light_tower 設定時回傳 None"""
+        light_config = config_dict.get("light_tower")
+        if not light_config:
+            return None
+        light_config = dict(light_config)
+        driver_name = light_config.pop("driver", "serial")
+        if driver_name == "serial":
+            driver = PySerialDriver(
+                light_config.pop("port", "COM3"), light_config.pop("baudrate", 9600)
+            )
+        elif driver_name == "comport_exe":
+            driver = ComportExeDriver(light_config.pop("folder", "Light/Red"))
+        elif driver_name in DRIVERS:
+            driver = DRIVERS[driver_name]()
+        else:
+            raise ValueError("未知的警示燈驅動：{}".format(driver_name))
+        yellow, red = threshold_lines(config_dict)
+        return cls(
+            driver,
+            yellow,
+            red,
+            light_config.get("alarm_level", "red"),
+            light_config.get("hysteresis", 5),
+            light_config.get("debounce", 0),
+            stale_seconds=light_config.get("stale_seconds", 60),
+        )
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def update(self, value, source=None):
+        """送入一筆讀數，立即返回"""
+        self.events.put((time.monotonic(), source, float(value)))
+
+    def close(self, timeout=5):
+        if self.thread is not None:
+            self.events.put(_STOP)
+            self.thread.join(timeout)
+            self.thread = None
+        if self.opened:
+            self.driver.close()
+            self.opened = False
+
+    def stats(self):
+        return {
+            "level": LEVELS[self.level],
+            "relay": self.relay,
+            "commands_sent": self.commands_sent,
+            "write_errors": self.write_errors,
+            "last_latency": self.last_latency,
+        }
+
+    def _classify(self, value):
+        level = self.level
+        while level < len(self.lines) and value > self.lines[level]:
+            level += 1
+        while level > 0 and value < self.lines[level - 1] - self.hysteresis:
+            level -= 1
+        return level
+
+    def step(self, now, source=None, value=None):
+        """處理一筆讀數（value 為 None 時只檢查去彈跳與過期），now 為 time.monotonic() 的時間
+
+        背景執行緒依序呼叫；測試可直接呼叫並指定時間，不需等待
+        """
+        changed = value is not None
+        if changed:
+            self.latest[source] = (now, value)
+        if self.stale_seconds:
+            for key, (seen, _) in list(self.latest.items()):
+                if now - seen > self.stale_seconds:
+                    del self.latest[key]
+                    changed = True
+        if changed:
+            # 所有攝影機都沒有讀數時回到正常
+            level = self._classify(max(v for _, v in self.latest.values())) if self.latest else 0
+            if level == self.level:
+                self.candidate = None
+            elif self.candidate is None or self.candidate[0] != level:
+                self.candidate = (level, now)
+
+        if self.candidate is not None and now - self.candidate[1] >= self.debounce:
+            self.level = self.candidate[0]
+            self.candidate = None
+        self._apply(self.level >= self.alarm_level, now)
+
+    def _timeout(self, now):
+        # 下一次需要檢查的時間：去彈跳到期或最舊的讀數過期
+        deadlines = []
+        if self.candidate is not None:
+            deadlines.append(self.candidate[1] + self.debounce)
+        if self.stale_seconds and self.latest:
+            deadlines.append(min(seen for seen, _ in self.latest.values()) + self.stale_seconds)
+        return max(min(deadlines) - now, 0) if deadlines else None
+
+    def _run(self):
+        while True:
+            try:
+                event = self.events.get(timeout=self._timeout(time.monotonic()))
+            except queue.Empty:
+                event = None
+            if event is _STOP:
+                break
+            if event is None:
+                self.step(time.monotonic())
+            else:
+                self.step(*event)
+
+    def _apply(self, relay, received):
+        if relay == self.relay:
+            return
+        now = time.monotonic()
+        try:
+            if not self.opened:
+                # 開啟失敗時每 retry_interval 秒才重試一次，避免每筆讀數都印錯誤
+                last = self.last_open_attempt
+                if last is not None and now - last < self.retry_interval:
+                    return
+                self.last_open_attempt = now
+                self.driver.open()
+                self.opened = True
+            self.driver.write(self.commands[relay])
+        except Exception as e:
+            self.write_errors += 1
+            print("警示燈指令失敗：{}".format(e))
+            if self.opened:
+                self.driver.close()
+                self.opened = False
+            return
+        self.relay = relay
+        self.commands_sent += 1
+        self.last_latency = time.monotonic() - received
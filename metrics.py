@@ -0,0 +1,326 @@
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 時間直方圖的上界（秒），最後一格為 +Inf
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+def quantile(histogram, q):
+    """由直方圖快照估計分位數，在所在的桶內線性內插，與 Prometheus 的 histogram_quantile 相同"""
+    total = sum(histogram["counts"])
+    if total == 0:
+        return None
+    rank, cumulative = q * total, 0
+    buckets = histogram["buckets"]
+    for i, count in enumerate(histogram["counts"]):
+        if count and cumulative + count >= rank:
+            if i == len(buckets):
+                return buckets[-1]
+            lower = buckets[i - 1] if i > 0 else 0.0
+            return lower + (buckets[i] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+def histogram_delta(current, previous):
+    """兩次快照之間的直方圖，用於計算最近一段時間的分位數"""
+    if previous is None or previous["buckets"] != current["buckets"]:
+        return current
+    return {
+        "buckets": current["buckets"],
+        "counts": [a - b for a, b in zip(current["counts"], previous["counts"])],
+        "sum": current["sum"] - previous["sum"],
+        "count": current["count"] - previous["count"],
+    }
+
+
+class MetricsRegistry(object):
+    """計數器、量測值與時間直方圖，可輸出 Prometheus 文字格式或 JSON
+
+    指標以 (名稱, 標籤) 區分，例如 observe("stage_seconds", 0.002, stage="decode", camera="BC6")
+    """
+
+    def __init__(self, prefix="dust_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.imported = {}  # 其他行程送來的快照，來源 -> 快照
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def histogram(self, name, **labels):
+        """取得 (名稱, 標籤) 的直方圖，每張影像都要記錄的地方先取得再直接 observe()，省去查表"""
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        """collector() 回傳 [(名稱, 標籤 dict, 數值)]，在輸出時才呼叫，用於佇列深度等即時狀態"""
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def import_snapshot(self, source, snapshot):
+        with self.lock:
+            self.imported[source] = snapshot
+
+    def snapshot(self):
+        with self.lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()
+            ]
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.gauges.items()
+            ]
+            histograms = [
+                dict(histogram.snapshot(), name=name, labels=dict(labels))
+                for (name, labels), histogram in self.histograms.items()
+            ]
+            collectors = list(self.collectors)
+            imported = list(self.imported.values())
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    if value is not None:
+                        gauges.append({"name": name, "labels": labels, "value": value})
+            except Exception as e:
+                print("metrics collector 失敗：{}".format(e))
+        for other in imported:
+            counters.extend(other["counters"])
+            gauges.extend(other["gauges"])
+            histograms.extend(other["histograms"])
+        return {"time": time.time(), "counters": counters, "gauges": gauges,
+                "histograms": histograms}
+
+    def render(self):
+        """Prometheus 文字格式"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def label_text(labels, extra=None):
+            items = sorted(labels.items()) + (extra or [])
+            if not items:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                               for k, v in items) + "}"
+
+        for kind, entries in (("counter", snapshot["counters"]), ("gauge", snapshot["gauges"])):
+            typed = set()
+            for entry in sorted(entries, key=lambda e: e["name"]):
+                name = self.prefix + entry["name"]
+                if name not in typed:
+                    lines.append("# TYPE {} {}".format(name, kind))
+                    typed.add(name)
+                lines.append("{}{} {}".format(name, label_text(entry["labels"]), float(entry["value"])))
+
+        typed = set()
+        for entry in sorted(snapshot["histograms"], key=lambda e: e["name"]):
+            name = self.prefix + entry["name"]
+            if name not in typed:
+                lines.append("# TYPE {} histogram".format(name))
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(list(entry["buckets"]) + ["+Inf"], entry["counts"]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, label_text(entry["labels"], [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(name, label_text(entry["labels"]), entry["sum"]))
+            lines.append("{}_count{} {}".format(name, label_text(entry["labels"]), entry["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# 每個行程共用的預設登錄表
+registry = MetricsRegistry()
+
+
+class SamplingProfiler(object):
+    """定期擷取各執行緒的呼叫堆疊並累計次數，開銷與取樣間隔成正比，可在正式機上開啟"""
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while self.running:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < self.max_depth:
+                        code = frame.f_code
+                        stack.append("{}:{}:{}".format(
+                            os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                        frame = frame.f_back
+                    self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+            del frames
+
+    def top(self, limit=20):
+        """回傳 [(位置, 自身取樣數, 包含子呼叫的取樣數)]，依自身取樣數排序"""
+        own, inclusive = Counter(), Counter()
+        with self.lock:
+            stacks = list(self.stacks.items())
+        for stack, count in stacks:
+            if not stack:
+                continue
+            own[stack[-1]] += count
+            for location in set(stack):
+                inclusive[location] += count
+        return [(location, count, inclusive[location]) for location, count in own.most_common(limit)]
+
+    def collapsed(self):
+        """flamegraph.pl / speedscope 可讀取的 collapsed stack 格式"""
+        with self.lock:
+            stacks = list(self.stacks.items())
+        return "\n".join("{} {}".format(";".join(stack), count) for stack, count in stacks) + "\n"
+
+    def report(self, limit=20):
+        lines = ["samples: {}  interval: {}s".format(self.samples, self.interval),
+                 "{:>8} {:>8}  location".format("self", "total")]
+        for location, count, total in self.top(limit):
+            lines.append("{:>8} {:>8}  {}".format(count, total, location))
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body, content_type = self.server.registry.render(), "text/plain; version=0.0.4"
+        elif path == "/metrics.json":
+            body, content_type = json.dumps(self.server.registry.snapshot()), "application/json"
+        elif path == "/profile" and self.server.profiler is not None:
+            body, content_type = self.server.profiler.report(), "text/plain"
+        elif path == "/profile/collapsed" and self.server.profiler is not None:
+            body, content_type = self.server.profiler.collapsed(), "text/plain"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "{}; charset=utf-8".format(content_type))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # 不在終端機印出每次抓取
+
+
+def start_http_server(metrics_config=None, metrics_registry=None):
+    """依 config.yaml 的 metrics 設定開啟 /metrics、/metrics.json 與 /profile，未設定 port 時回傳 None"""
+    metrics_config = metrics_config or {}
+    port = metrics_config.get("port")
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((metrics_config.get("host", "127.0.0.1"), port), _MetricsHandler)
+    except OSError as e:
+        # 同一台電腦已有其他分析程式佔用此 port 時不影響分析
+        print("metrics 無法開啟 port {}：{}".format(port, e))
+        return None
+    server.daemon_threads = True
+    server.registry = metrics_registry or registry
+    server.profiler = None
+    if metrics_config.get("profile"):
+        server.profiler = SamplingProfiler(metrics_config.get("profile_interval", 0.005)).start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("metrics: http://{}:{}/metrics".format(*server.server_address[:2]))
+    return server
+
+
+def stop_http_server(server):
+    """關閉 start_http_server 開啟的伺服器與取樣分析器，server 為 None 時不做任何事"""
+    if server is None:
+        return
+    server.shutdown()
+    server.server_close()
+    if server.profiler is not None:
+        server.profiler.stop()
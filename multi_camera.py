@@ -0,0 +1,244 @@
+import multiprocessing
+import os
+import queue
+import time
+from datetime import datetime
+
+from config_loader import file_version, load_config, threshold_lines
+from db_writer import DustDBWriter
+from episodes import EpisodeDetector
+from dust_cv import Dust_Monitor, UserCaseException
+from light_tower import LightTowerController
+from metrics import registry, start_http_server, stop_http_server
+from rollup import DustRollup
+
+
+def load_cameras(config_path="config.yaml"):
+    """讀取 config.yaml 的攝影機清單，未設定 cameras 時沿用單一 rtsp_url"""
+    config = load_config(config_path)
+
+    cameras = config.get("cameras")
+    if not cameras:
+        if config.get("rtsp_url") is None:
+            raise UserCaseException("config.yaml沒有設定攝影機!!")
+        cameras = [{"id": "default", "rtsp_url": config["rtsp_url"]}]
+
+    camera_ids = [camera["id"] for camera in cameras]
+    if len(set(camera_ids)) != len(camera_ids):
+        raise UserCaseException("攝影機id重複!!")
+    return config, cameras
+
+
+def camera_worker(cameras, reading_queue, stop_event, stats_interval=10):
+    """子行程：輪流分析分配到的攝影機，讀數、串流中斷與統計都送回主行程"""
+    monitors = [Dust_Monitor(camera=camera) for camera in cameras]
+    counters = {monitor.camera_id: {"frames": 0, "readings": 0} for monitor in monitors}
+    last_stats = time.monotonic()
+    for monitor in monitors:
+        registry.add_collector(monitor.collect_metrics)
+
+    try:
+        _worker_loop(monitors, counters, last_stats, reading_queue, stop_event, stats_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for monitor in monitors:
+            monitor.cap.release()
+            _send_gaps(monitor, reading_queue)
+
+
+def _send_gaps(monitor, reading_queue):
+    for gap in monitor.cap.pop_gaps():
+        reading_queue.put(("gap", monitor.camera_id, time.time(), gap))
+
+
+def _worker_loop(monitors, counters, last_stats, reading_queue, stop_event, stats_interval):
+    while not stop_event.is_set():
+        idle = True
+        for monitor in monitors:
+            counter = counters[monitor.camera_id]
+            # 擷取與重連都在背景執行緒進行，這裡不等待，沒有新影像就換下一台
+            status, frame = monitor.cap.read(timeout=0)
+            _send_gaps(monitor, reading_queue)
+            monitor.reload_config()
+            if status == False:
+                continue
+            idle = False
+
+            try:
+                reading = monitor.process_frame(frame)
+            except Exception as e:
+                print(monitor.camera_id, e)
+                continue
+            counter["frames"] += 1
+            if reading is not None:
+                counter["readings"] += 1
+                reading_queue.put(
+                    (
+                        "reading",
+                        monitor.camera_id,
+                        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        float(reading),
+                    )
+                )
+
+        if time.monotonic() - last_stats >= stats_interval:
+            for monitor in monitors:
+                stats = dict(counters[monitor.camera_id])
+                stats.update(monitor.cap.stats())
+                reading_queue.put(("stats", monitor.camera_id, time.time(), stats))
+            # 子行程的指標快照，由主行程合併後一起輸出
+            source = "worker-{}".format(os.getpid())
+            reading_queue.put(("metrics", source, time.time(), registry.snapshot()))
+            last_stats = time.monotonic()
+
+        if idle:
+            time.sleep(0.005)
+
+
+class CameraSupervisor(object):
+    """在同一個行程池內執行多台攝影機的分析，所有讀數由主行程統一寫入資料庫"""
+
+    def __init__(self, config_path="config.yaml", processes=None,
+                 db_file="dust_data.db", table_name="dust_data"):
+        self.config_path = config_path
+        self.config, self.cameras = load_cameras(config_path)
+        self.to_db = str(self.config.get("to_db", "true")).lower() == "true"
+        self.processes = min(processes or os.cpu_count() or 1, len(self.cameras))
+        self.db_file, self.table_name = db_file, table_name
+        self.camera_stats = {
+            camera["id"]: {"readings_sent": 0, "last_reading": None}
+            for camera in self.cameras
+        }
+        self.workers = []
+
+    def stats(self):
+        """各攝影機的吞吐量統計，frames/readings 為累計值，fps 為最近一次回報區間的平均"""
+        return {camera_id: dict(stats) for camera_id, stats in self.camera_stats.items()}
+
+    def _update_stats(self, camera_id, reported_at, stats):
+        camera_stats = self.camera_stats[camera_id]
+        previous = camera_stats.get("reported_at")
+        if previous is not None and reported_at > previous:
+            elapsed = reported_at - previous
+            camera_stats["fps"] = (stats["frames"] - camera_stats["frames"]) / elapsed
+            camera_stats["readings_per_min"] = (
+                60 * (stats["readings"] - camera_stats["readings"]) / elapsed
+            )
+        camera_stats.update(stats)
+        camera_stats["reported_at"] = reported_at
+
+    def _reload_thresholds(self, writer, light):
+        # 子行程的 Dust_Monitor 各自重新載入 ROI 與取樣門檻，主行程只需更新警示燈與彙總表
+        try:
+            config = load_config(self.config_path)
+        except Exception as e:
+            print("config.yaml 重新載入失敗：{}".format(e))
+            return
+        lines = threshold_lines(config)
+        if lines == threshold_lines(self.config):
+            return
+        self.config["thresholds"] = config.get("thresholds")
+        if light is not None:
+            light.lines = lines
+        if writer.rollup is not None:
+            writer.rollup.yellow_line, writer.rollup.red_line = lines
+        if writer.episodes is not None:
+            writer.episodes.lines = lines
+        print("警戒值已更新：黃 {} 紅 {}".format(*lines))
+
+    def _collect(self):
+        gauges = []
+        for camera_id, stats in self.camera_stats.items():
+            labels = {"camera": camera_id}
+            gauges.append(("camera_readings_sent", labels, stats["readings_sent"]))
+            gauges.append(("camera_fps", labels, stats.get("fps")))
+            gauges.append(("camera_readings_per_min", labels, stats.get("readings_per_min")))
+        return gauges
+
+    def run(self, stats_interval=10):
+        reading_queue = multiprocessing.Queue(maxsize=10000)
+        stop_event = multiprocessing.Event()
+
+        # 攝影機平均分配到各子行程
+        groups = [self.cameras[i :: self.processes] for i in range(self.processes)]
+        for group in groups:
+            worker = multiprocessing.Process(
+                target=camera_worker,
+                args=(group, reading_queue, stop_event, stats_interval),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        print("啟動 {} 個子行程，監控 {} 台攝影機".format(len(groups), len(self.cameras)))
+
+        writer = DustDBWriter(
+            self.db_file,
+            self.table_name,
+            rollup=DustRollup.from_config(self.config, self.table_name),
+            episodes=EpisodeDetector.from_config(self.config),
+        ).start()
+        light = LightTowerController.from_config(self.config)
+        if light is not None:
+            light.start()
+        metrics_server = start_http_server(self.config.get("metrics"))
+        registry.add_collector(self._collect)
+        last_print = time.monotonic()
+        config_version = file_version(self.config_path)
+        try:
+            while any(worker.is_alive() for worker in self.workers):
+                version = file_version(self.config_path)
+                if version != config_version:
+                    config_version = version
+                    self._reload_thresholds(writer, light)
+
+                readings = []
+                try:
+                    message = reading_queue.get(timeout=1)
+                    while True:
+                        kind, camera_id, stamp, payload = message
+                        if kind == "reading":
+                            readings.append((stamp, payload, camera_id))
+                            self.camera_stats[camera_id]["last_reading"] = (stamp, payload)
+                            if light is not None:
+                                light.update(payload, source=camera_id)
+                        elif kind == "metrics":
+                            registry.import_snapshot(camera_id, payload)
+                        elif kind == "gap":
+                            start, end, reason = payload
+                            print(camera_id, "串流中斷", start, "~", end, reason)
+                            if self.to_db:
+                                writer.write_gap(start, end, camera_id, reason)
+                        else:
+                            self._update_stats(camera_id, stamp, payload)
+                        message = reading_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+                if readings and self.to_db:
+                    writer.write_many(readings)
+                    for _, _, camera_id in readings:
+                        self.camera_stats[camera_id]["readings_sent"] += 1
+
+                if time.monotonic() - last_print >= stats_interval:
+                    for camera_id, stats in self.stats().items():
+                        print(camera_id, stats)
+                    print("writer", writer.stats())
+                    if light is not None:
+                        print("light", light.stats())
+                    last_print = time.monotonic()
+        except KeyboardInterrupt:
+            print("退出程式")
+        finally:
+            stop_event.set()
+            for worker in self.workers:
+                worker.join(timeout=5)
+            writer.close()
+            if light is not None:
+                light.close()
+            registry.remove_collector(self._collect)
+            stop_http_server(metrics_server)
+
+
+if __name__ == "__main__":
+    CameraSupervisor().run()
@@ -0,0 +1,154 @@
+import argparse
+import pickle
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from config_loader import load_config
+from db_writer import DustDBWriter, ensure_dust_table
+from episodes import EpisodeDetector
+from rollup import DustRollup
+
+
+def load_signal(path):
+    """讀取錄製的訊號：params.pkl、contrast_var_list.pkl、.npy 或含 Metric 欄位的 CSV"""
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if isinstance(data, dict):
+            data = data["contrast_var_list"]
+        return np.asarray(data, dtype=np.float64)
+    if path.endswith(".npy"):
+        return np.load(path).astype(np.float64).reshape(-1)
+    if path.endswith(".csv"):
+        df = pd.read_csv(path)
+        column = "Metric" if "Metric" in df.columns else df.select_dtypes("number").columns[0]
+        return df[column].to_numpy(dtype=np.float64)
+    raise ValueError("不支援的訊號檔案：{}".format(path))
+
+
+def moving_average(x, w):
+    """移動平均，以累積和計算"""
+    cumsum = np.concatenate(([0.0], np.cumsum(x, dtype=np.float64)))
+    return (cumsum[w:] - cumsum[:-w]) / w
+
+
+def calibration_bounds(signal, w=100):
+    """與 window_stats.mean_bounds 相同的正規化上下界，整段訊號一次向量化計算"""
+    mv = moving_average(signal, w)
+    return {"max": float(mv.max()), "min": float(mv.min())}
+
+
+def window_means(signal, w, count, rng):
+    """從訊號中隨機取 count 段長度 w 的視窗並回傳各段平均，等同 test2db 逐筆累加的結果"""
+    if len(signal) <= w:
+        raise ValueError("訊號長度必須大於視窗大小")
+    cumsum = np.concatenate(([0.0], np.cumsum(signal, dtype=np.float64)))
+    starts = rng.integers(0, len(signal) - w, size=count)
+    return (cumsum[starts + w] - cumsum[starts]) / w
+
+
+def normalize(values, bounds):
+    """向量化的 Dust_Monitor.normalization"""
+    scale = 100 / abs(bounds["max"] - bounds["min"])
+    return np.clip(scale * (bounds["max"] - values), 0, 100)
+
+
+def timestamps(start, count, interval):
+    """由 start 起每 interval 秒一筆的時間字串，interval 可為小數，時間字串只到秒"""
+    step = np.timedelta64(int(round(interval * 1000)), "ms")
+    stamps = np.datetime64(start, "ms") + np.arange(count) * step
+    return np.char.replace(np.datetime_as_string(stamps, unit="s"), "T", " ")
+
+
+class ReplayEngine(object):
+    """以錄製的訊號產生粉塵讀數，可一次大量寫入或依指定速率逐筆寫入，用於壓力測試儀表板"""
+
+    def __init__(self, signal, w=70, seed=None, bounds=None, camera_id=None):
+        self.signal = np.asarray(signal, dtype=np.float64)
+        self.w = w
+        self.rng = np.random.default_rng(seed)
+        self.bounds = bounds or calibration_bounds(self.signal)
+        self.camera_id = camera_id
+
+    def generate(self, count):
+        return normalize(window_means(self.signal, self.w, count, self.rng), self.bounds)
+
+    def bulk_insert(self, db_file, count, start=None, interval=10, table_name="dust_data",
+                    chunk_size=100000, rollup=None):
+        """直接以 executemany 分塊寫入，最後由 SQL 重建彙總表，回傳寫入筆數"""
+        if start is None:
+            start = datetime.now() - timedelta(seconds=interval * count)
+        conn = sqlite3.connect(db_file)
+        conn.execute("PRAGMA journal_mode=WAL")
+        ensure_dust_table(conn, table_name)
+        insert_sql = 'INSERT INTO "{}" ("Timestamp", "Dust_Level", "Camera_ID") VALUES (?, ?, ?)'.format(
+            table_name
+        )
+        written = 0
+        while written < count:
+            size = min(chunk_size, count - written)
+            chunk_start = start + timedelta(seconds=interval * written)
+            values = self.generate(size)
+            stamps = timestamps(chunk_start, size, interval)
+            conn.executemany(
+                insert_sql,
+                zip(stamps.tolist(), values.tolist(), [self.camera_id] * size),
+            )
+            conn.commit()
+            written += size
+        if rollup is not None:
+            rollup.backfill(conn)
+        conn.close()
+        return written
+
+    def paced(self, writer, count, interval=10, speed=1.0):
+        """依 interval/speed 的間隔逐筆寫入現在時間的讀數，模擬即時資料"""
+        period = interval / speed
+        next_time = time.monotonic()
+        for value in self.generate(count):
+            writer.write(value, camera_id=self.camera_id)
+            next_time += period
+            time.sleep(max(next_time - time.monotonic(), 0))
+        writer.flush()
+        return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以錄製的訊號回放或回填粉塵讀數")
+    parser.add_argument("--signal", default="params.pkl")
+    parser.add_argument("--db", default="dust_data_simulation.db")
+    parser.add_argument("--table", default="dust_data")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=70)
+    parser.add_argument("--interval", type=float, default=10, help="讀數間隔（秒）")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--camera", default=None)
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--start", default=None, help="回填起始時間，例如 2025-01-01 00:00:00")
+    parser.add_argument("--speed", type=float, default=0, help="回放速度倍率，0 為不等待直接大量寫入")
+    parser.add_argument("--no-rollup", action="store_true", help="大量寫入後不重建彙總表")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    engine = ReplayEngine(
+        load_signal(args.signal), w=args.window, seed=args.seed, camera_id=args.camera
+    )
+    began = time.perf_counter()
+    if args.speed > 0:
+        rollup = DustRollup.from_config(config, args.table)
+        writer = DustDBWriter(
+            args.db, args.table, rollup=rollup, episodes=EpisodeDetector.from_config(config)
+        ).start()
+        written = engine.paced(writer, args.count, args.interval, args.speed)
+        writer.close()
+    else:
+        start = datetime.strptime(args.start, "%Y-%m-%d %H:%M:%S") if args.start else None
+        rollup = None if args.no_rollup else DustRollup.from_config(config, args.table)
+        written = engine.bulk_insert(
+            args.db, args.count, start, args.interval, args.table, rollup=rollup
+        )
+    print("寫入 {} 筆，耗時 {:.2f} 秒".format(written, time.perf_counter() - began))
@@ -0,0 +1,76 @@
+import math
+from fractions import Fraction
+
+import cv2
+
+
+class RoiMapper(object):
+    """將設定在縮放後畫面上的 ROI 換算回原始解析度，只縮放需要的區域"""
+
+    def __init__(self, reference_size=(1000, 750), x=(310, 410), y=(230, 300),
+                 interpolation=cv2.INTER_AREA):
+        # reference_size: 原本整張縮放的目標大小 (寬, 高)
+        # x, y: ROI 在縮放後畫面上的範圍，等同 image[y0:y1, x0:x1]
+        self.reference_size = tuple(reference_size)
+        self.x = tuple(x)
+        self.y = tuple(y)
+        self.interpolation = interpolation
+        self.frame_shape = None
+
+    @classmethod
+    def from_config(cls, roi_config):
+        roi_config = roi_config or {}
+        return cls(
+            reference_size=roi_config.get("reference_size", (1000, 750)),
+            x=roi_config.get("x", (310, 410)),
+            y=roi_config.get("y", (230, 300)),
+        )
+
+    def _map_axis(self, src_len, ref_len, start, stop):
+        # 縮放比例為 src_len/ref_len，以分母為週期對齊，
+        # 對齊後的起點在原始畫面上剛好落在整數像素，區域縮放結果與整張縮放一致
+        scale = Fraction(src_len, ref_len)
+        period = scale.denominator
+        ref_start = (start // period) * period
+        ref_stop = min(int(math.ceil(stop / period)) * period, ref_len)
+        if scale < 1:
+            # 放大時內插會參考相鄰像素，多留一個週期的邊界
+            ref_start = max(ref_start - period, 0)
+            ref_stop = min(ref_stop + period, ref_len)
+        src_start = int(ref_start * scale)
+        src_stop = int(ref_stop * scale)
+        return (
+            slice(src_start, src_stop),
+            ref_stop - ref_start,
+            slice(start - ref_start, stop - ref_start),
+        )
+
+    def configure(self, frame_shape):
+        """依據串流的解析度計算原始畫面上的來源區域，解析度改變時才需重算"""
+        height, width = frame_shape[:2]
+        ref_width, ref_height = self.reference_size
+        self.src_x, self.dst_width, self.inner_x = self._map_axis(
+            width, ref_width, *self.x
+        )
+        self.src_y, self.dst_height, self.inner_y = self._map_axis(
+            height, ref_height, *self.y
+        )
+        self.frame_shape = tuple(frame_shape[:2])
+
+    def extract(self, frame):
+        """回傳與 resize(frame, reference_size)[y0:y1, x0:x1] 相同的 ROI"""
+        if self.frame_shape != frame.shape[:2]:
+            self.configure(frame.shape)
+        region = frame[self.src_y, self.src_x]
+        region = cv2.resize(
+            region, (self.dst_width, self.dst_height), interpolation=self.interpolation
+        )
+        return region[self.inner_y, self.inner_x]
+
+    def preview(self, frame):
+        """顯示用的整張縮放畫面，並標示 ROI 位置"""
+        image = cv2.resize(frame, self.reference_size, interpolation=self.interpolation)
+        cv2.rectangle(
+            image, (self.x[0], self.y[0]), (self.x[1] - 1, self.y[1] - 1), (0, 0, 255), 1
+        )
+        return image
@@ -0,0 +1,182 @@
+import argparse
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from config_loader import load_config, threshold_lines
+
+# 各粒度的彙總表與時間桶字串長度，時間桶沿用 Timestamp 的字串格式方便排序與比較
+ROLLUP_LEVELS = {
+    "minute": ("dust_rollup_1min", 16, ":00"),
+    "hour": ("dust_rollup_1hour", 13, ":00:00"),
+    "day": ("dust_rollup_1day", 10, " 00:00:00"),
+}
+
+
+def bucket_of(timestamp, level):
+    _, length, suffix = ROLLUP_LEVELS[level]
+    return timestamp[:length] + suffix
+
+
+def ensure_rollup_tables(conn):
+    for table, _, _ in ROLLUP_LEVELS.values():
+        # Camera_ID 為主鍵的一部分，沒有攝影機編號的讀數以空字串表示
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS "{}" ('
+            '"Bucket" TEXT NOT NULL, "Camera_ID" TEXT NOT NULL DEFAULT \'\', '
+            '"Count" INTEGER NOT NULL, "Sum" REAL NOT NULL, "Min" REAL, "Max" REAL, '
+            '"Seconds_Over_Yellow" REAL NOT NULL DEFAULT 0, '
+            '"Seconds_Over_Red" REAL NOT NULL DEFAULT 0, '
+            'PRIMARY KEY ("Bucket", "Camera_ID"))'.format(table)
+        )
+    conn.commit()
+
+
+class DustRollup(object):
+    """在寫入原始讀數的同一個交易內，增量更新分、時、日彙總表"""
+
+    def __init__(self, yellow_line=45, red_line=60, max_gap=60, table_name="dust_data"):
+        # 每筆讀數代表與同攝影機上一筆之間的時間，max_gap 秒以上的斷線不計入超標時間
+        self.yellow_line = yellow_line
+        self.red_line = red_line
+        self.max_gap = max_gap
+        self.table_name = table_name
+        self.last_seen = {}
+
+    @classmethod
+    def from_config(cls, config_dict, table_name="dust_data"):
+        yellow, red = threshold_lines(config_dict)
+        return cls(yellow, red, table_name=table_name)
+
+    def _previous_timestamp(self, conn, camera_id):
+        if camera_id not in self.last_seen:
+            row = conn.execute(
+                'SELECT MAX("Timestamp") FROM "{}" WHERE "Camera_ID" IS ?'.format(self.table_name),
+                (camera_id,),
+            ).fetchone()
+            self.last_seen[camera_id] = (
+                datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") if row[0] else None
+            )
+        return self.last_seen[camera_id]
+
+    def apply(self, conn, rows):
+        """rows: (Timestamp, Dust_Level, Camera_ID)，需在原始讀數寫入前呼叫"""
+        buckets = {}
+        for timestamp, val, camera_id in sorted(rows, key=lambda row: row[0]):
+            current = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            previous = self._previous_timestamp(conn, camera_id)
+            duration = 0.0
+            if previous is not None:
+                duration = min(max((current - previous).total_seconds(), 0.0), self.max_gap)
+            self.last_seen[camera_id] = current
+
+            over_yellow = duration if val > self.yellow_line else 0.0
+            over_red = duration if val > self.red_line else 0.0
+            for level in ROLLUP_LEVELS:
+                key = (level, bucket_of(timestamp, level), camera_id or "")
+                stats = buckets.get(key)
+                if stats is None:
+                    buckets[key] = [1, val, val, val, over_yellow, over_red]
+                else:
+                    stats[0] += 1
+                    stats[1] += val
+                    stats[2] = min(stats[2], val)
+                    stats[3] = max(stats[3], val)
+                    stats[4] += over_yellow
+                    stats[5] += over_red
+
+        for level, (table, _, _) in ROLLUP_LEVELS.items():
+            conn.executemany(
+                'INSERT INTO "{}" VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT ("Bucket", "Camera_ID") DO UPDATE SET '
+                '"Count" = "Count" + excluded."Count", "Sum" = "Sum" + excluded."Sum", '
+                '"Min" = MIN("Min", excluded."Min"), "Max" = MAX("Max", excluded."Max"), '
+                '"Seconds_Over_Yellow" = "Seconds_Over_Yellow" + excluded."Seconds_Over_Yellow", '
+                '"Seconds_Over_Red" = "Seconds_Over_Red" + excluded."Seconds_Over_Red"'.format(table),
+                [
+                    (bucket, camera_id) + tuple(stats)
+                    for (row_level, bucket, camera_id), stats in buckets.items()
+                    if row_level == level
+                ],
+            )
+
+    def backfill(self, conn):
+        """以原始資料重建所有彙總表，用於既有資料庫
+
+        原始資料已移到歸檔（archive.py）的時段不在資料表中，保留這些時段的分鐘彙總，只重建之後的部分
+        """
+        ensure_rollup_tables(conn)
+        minute_table = ROLLUP_LEVELS["minute"][0]
+        first = conn.execute('SELECT MIN("Timestamp") FROM "{}"'.format(self.table_name)).fetchone()[0]
+        if first is not None:
+            conn.execute(
+                'DELETE FROM "{}" WHERE "Bucket" >= ?'.format(minute_table), (bucket_of(first, "minute"),)
+            )
+        for level in ("hour", "day"):
+            conn.execute('DELETE FROM "{}"'.format(ROLLUP_LEVELS[level][0]))
+
+        # 舊資料表沒有 Camera_ID 欄位，直接引用會被 SQLite 當成字串常數
+        columns = [row[1] for row in conn.execute('PRAGMA table_info("{}")'.format(self.table_name))]
+        camera = 'COALESCE("Camera_ID", \'\')' if "Camera_ID" in columns else "''"
+
+        # 分鐘表由原始資料計算，LAG 取得同攝影機上一筆的時間差
+        conn.execute(
+            'INSERT INTO "{0}" SELECT substr("Timestamp", 1, 16) || \':00\', camera, '
+            'COUNT(*), SUM("Dust_Level"), MIN("Dust_Level"), MAX("Dust_Level"), '
+            'SUM(CASE WHEN "Dust_Level" > ? THEN duration ELSE 0 END), '
+            'SUM(CASE WHEN "Dust_Level" > ? THEN duration ELSE 0 END) '
+            'FROM (SELECT "Timestamp", "Dust_Level", {2} AS camera, '
+            'MIN(MAX(COALESCE(ROUND((julianday("Timestamp") - julianday(LAG("Timestamp") OVER ('
+            'PARTITION BY {2} ORDER BY "Timestamp", rowid))) * 86400, 3), 0), 0), ?) '
+            'AS duration FROM "{1}" WHERE "Dust_Level" IS NOT NULL) '
+            'GROUP BY 1, 2'.format(minute_table, self.table_name, camera),
+            (self.yellow_line, self.red_line, self.max_gap),
+        )
+        # 小時、日表由分鐘表往上彙總，不再掃描原始資料
+        for level in ("hour", "day"):
+            table, length, suffix = ROLLUP_LEVELS[level]
+            conn.execute(
+                'INSERT INTO "{0}" SELECT substr("Bucket", 1, {2}) || \'{3}\', "Camera_ID", '
+                'SUM("Count"), SUM("Sum"), MIN("Min"), MAX("Max"), '
+                'SUM("Seconds_Over_Yellow"), SUM("Seconds_Over_Red") '
+                'FROM "{1}" GROUP BY 1, 2'.format(table, minute_table, length, suffix)
+            )
+        conn.commit()
+        self.last_seen = {}
+
+
+def query_rollup(conn, level, start, end, camera_id=None):
+    """讀取彙總表的趨勢資料，長區間的圖表與報表應使用此函式而非掃描原始資料"""
+    table = ROLLUP_LEVELS[level][0]
+    query = (
+        'SELECT "Bucket" AS "Timestamp", SUM("Sum") / SUM("Count") AS "Mean", '
+        'MIN("Min") AS "Min", MAX("Max") AS "Max", SUM("Count") AS "Count", '
+        'SUM("Seconds_Over_Yellow") AS "Seconds_Over_Yellow", '
+        'SUM("Seconds_Over_Red") AS "Seconds_Over_Red" '
+        'FROM "{}" WHERE "Bucket" >= ? AND "Bucket" <= ?'.format(table)
+    )
+    params = [start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")]
+    if camera_id is not None:
+        query += ' AND "Camera_ID" = ?'
+        params.append(camera_id)
+    query += ' GROUP BY "Bucket" ORDER BY "Bucket"'
+    df = pd.read_sql_query(query, conn, params=params)
+    df["Timestamp"] = pd.to_datetime(df["Timestamp"])
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="重建粉塵資料的分、時、日彙總表")
+    parser.add_argument("--db", default="dust_data.db")
+    parser.add_argument("--table", default="dust_data")
+    parser.add_argument("--config", default="config.yaml")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    conn = sqlite3.connect(args.db)
+    DustRollup.from_config(config, table_name=args.table).backfill(conn)
+    for table, _, _ in ROLLUP_LEVELS.values():
+        count = conn.execute('SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0]
+        print("{}: {} 筆".format(table, count))
+    conn.close()
@@ -0,0 +1,54 @@
+from config_loader import threshold_lines
+
+
+class AdaptiveSampler(object):
+    """決定擷取端要 retrieve() 並分析哪些影像：平穩時以 rate 張/秒分析，讀數接近黃/紅線或快速變化時提高到 alert_rate
+
+    due() 在擷取執行緒呼叫，update() 在分析端呼叫，兩者只讀寫單一屬性
+    """
+
+    def __init__(self, rate=2.0, alert_rate=10.0, margin=10.0, yellow_line=45, red_line=60,
+                 alpha=0.2):
+        if rate <= 0 or alert_rate < rate:
+            raise ValueError("rate 必須大於 0 且不大於 alert_rate")
+        self.rate = rate
+        self.alert_rate = alert_rate
+        self.margin = margin
+        self.lines = (yellow_line, red_line)
+        self.alpha = alpha
+        self.level = None
+        self.current_rate = alert_rate  # 還沒有讀數前先以高頻率分析
+        self.next_due = 0.0
+
+    @classmethod
+    def from_config(cls, config_dict):
+        sampling_config = config_dict.get("sampling") or {}
+        yellow, red = threshold_lines(config_dict)
+        return cls(
+            sampling_config.get("rate", 2.0),
+            sampling_config.get("alert_rate", 10.0),
+            sampling_config.get("margin", 10.0),
+            yellow,
+            red,
+        )
+
+    def due(self, now):
+        """now 為 time.monotonic()，回傳這張影像是否需要分析"""
+        if now < self.next_due:
+            return False
+        # 落後超過一個間隔時從現在重新起算，不補分析
+        self.next_due = max(self.next_due + 1.0 / self.current_rate, now)
+        return True
+
+    def update(self, score):
+        """以每張影像的分數更新平滑後的粉塵程度並調整分析頻率"""
+        if self.level is None:
+            self.level = score
+        jump = abs(score - self.level) > self.margin
+        self.level += self.alpha * (score - self.level)
+        near = any(abs(self.level - line) <= self.margin for line in self.lines)
+        rate = self.alert_rate if near or jump else self.rate
+        if rate > self.current_rate:
+            # 升頻立即生效，不必等到原本排定的下一張
+            self.next_due = 0.0
+        self.current_rate = rate
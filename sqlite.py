@@ -1,42 +1,208 @@
 import os
-import pandas as pd
+import csv
+import queue
 import sqlite3
 import schedule
 import time
 import glob
+from datetime import datetime
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from config_loader import load_config
+from db_writer import DustDBWriter, ensure_ingested_table
+from episodes import EpisodeDetector
+from rollup import DustRollup
+
 # 資料庫設定
 db_file = "dust_data.db"
 table_name = "dust_data"
 watch_folder = "data"  # 替換為您的 CSV 資料夾路徑
+settle_seconds = 0.5  # 檔案大小維持不變超過此秒數才視為寫入完成
+max_batch_files = 500  # 一個交易最多合併的檔案數
+max_wait_seconds = 5  # Windows 上阻塞中的 Queue.get 無法被 Ctrl+C 中斷，最多等待此秒數
 
 
 # 定義檔案監控處理
 
 class NewCSVHandler(FileSystemEventHandler):
+    """只把檔案路徑放進佇列，解析與寫入由主迴圈批次處理"""
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def _push(self, path):
+        if path.endswith(".csv"):
+            self.events.put(path)
+
     def on_created(self, event):
-        if event.is_directory or not event.src_path.endswith(".csv"):
-            return
+        if not event.is_directory:
+            self._push(event.src_path)
 
-        print(f"檔案已生成：{event.src_path}")
-        try:
-            # 匯入新檔案資料
-            df = pd.read_csv(event.src_path)
-            conn = sqlite3.connect(db_file)
-            df.to_sql(table_name, conn, if_exists="append", index=False)
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._push(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._push(event.dest_path)
+
+
+def read_csv_rows(path):
+    """讀取單一 CSV 檔的讀數，回傳 (Timestamp, Dust_Level, Camera_ID) 清單
+
+    Timestamp 必須為 "%Y-%m-%d %H:%M:%S"，格式不符時拋出 ValueError，整個檔案不匯入
+    """
+    with open(path, "r", newline="", encoding="utf-8-sig") as f:
+        rows = []
+        for record in csv.DictReader(f):
+            # 彙總表與警報事件依這個格式解析時間，先在這裡檢查
+            datetime.strptime(record["Timestamp"], "%Y-%m-%d %H:%M:%S")
+            rows.append(
+                (
+                    record["Timestamp"],
+                    float(record["Dust_Level"]),
+                    record.get("Camera_ID") or None,
+                )
+            )
+    return rows
+
+
+class CSVIngestor(object):
+    """事件驅動的 CSV 匯入程式：沒有事件時阻塞等待，連續產生的檔案合併成一個交易寫入"""
+
+    def __init__(self, folder=watch_folder, db=db_file, table=table_name, config_path="config.yaml"):
+        config = load_config(config_path)
+        self.folder = folder
+        self.db_file = db
+        self.events = queue.Queue()
+        self.writer = DustDBWriter(
+            db,
+            table,
+            rollup=DustRollup.from_config(config, table),
+            episodes=EpisodeDetector.from_config(config),
+        ).start()
+        # 檔案路徑 -> (上次看到的大小, 大小開始不變的時間)
+        self.candidates = {}
+        self.ingested = self._load_ingested()
+
+    def _load_ingested(self):
+        conn = sqlite3.connect(self.db_file)
+        ensure_ingested_table(conn)
+        ingested = {row[0] for row in conn.execute('SELECT "Path" FROM "ingested_files"')}
+        conn.close()
+        return ingested
+
+    def _key(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def add_candidate(self, path):
+        if self._key(path) not in self.ingested:
+            self.candidates.setdefault(path, (-1, time.monotonic()))
+
+    def catch_up(self):
+        """啟動時補匯入停機期間產生、尚未匯入的檔案"""
+        for path in glob.glob(os.path.join(self.folder, "*.csv")):
+            self.add_candidate(path)
+
+    def ready_files(self):
+        """回傳已寫入完成的檔案：大小不為 0、維持 settle_seconds 不變且以換行結尾"""
+        now, ready = time.monotonic(), []
+        for path, (last_size, since) in list(self.candidates.items()):
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                del self.candidates[path]
+                continue
+            if size != last_size:
+                self.candidates[path] = (size, now)
+            elif size > 0 and now - since >= settle_seconds:
+                with open(path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    complete = f.read(1) == b"\n"
+                if complete:
+                    ready.append(path)
+        return ready[:max_batch_files]
+
+    def ingest(self, paths):
+        rows, files = [], []
+        for path in paths:
+            del self.candidates[path]
+            try:
+                file_rows = read_csv_rows(path)
+            except Exception as e:
+                print(f"匯入資料時發生錯誤：{path} {e}")
+                continue
+            stat = os.stat(path)
+            rows.extend(file_rows)
+            files.append((self._key(path), stat.st_size, stat.st_mtime, len(file_rows)))
+
+        if files:
+            # 佇列滿時在這裡等待，由匯入端承受背壓；提交成功後才記為已匯入
+            if self.writer.write_files(rows, files, wait=True):
+                self.ingested.update(f[0] for f in files)
+                print(f"新資料已匯入資料庫！{len(files)} 個檔案，{len(rows)} 筆")
+            else:
+                print(f"匯入資料時發生錯誤：{len(files)} 個檔案未寫入資料庫")
+
+    def cleanup(self, keep_count=10):
+        removed = cleanup_csv_files(self.folder, keep_count, ingested=self.ingested)
+        if removed:
+            # 已刪除的檔案不會再出現，匯入紀錄一併清掉
+            keys = [self._key(path) for path in removed]
+            self.ingested.difference_update(keys)
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.executemany('DELETE FROM "ingested_files" WHERE "Path" = ?', [(k,) for k in keys])
+            conn.commit()
             conn.close()
-            print("新資料已匯入資料庫！")
-        except Exception as e:
-            print(f"匯入資料時發生錯誤：{e}")
+
+    def run(self):
+        observer = Observer()
+        observer.schedule(NewCSVHandler(self.events), self.folder, recursive=False)
+        observer.start()
+        self.catch_up()
+
+        # 添加清理任務，與匯入共用同一個主迴圈
+        schedule.every().day.at("03:08").do(self.cleanup, keep_count=10)
+
+        print(f"監控資料夾：{self.folder}")
+        try:
+            while True:
+                # 沒有待確認的檔案時阻塞到下一個事件或下一個排程，不會空轉
+                timeout = schedule.idle_seconds()
+                timeout = max_wait_seconds if timeout is None else min(timeout, max_wait_seconds)
+                if self.candidates:
+                    timeout = min(timeout, settle_seconds)
+                try:
+                    path = self.events.get(timeout=max(timeout, 0))
+                    while True:
+                        self.add_candidate(path)
+                        path = self.events.get_nowait()
+                except queue.Empty:
+                    pass
+
+                ready = self.ready_files()
+                if ready:
+                    self.ingest(ready)
+                schedule.run_pending()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            observer.stop()
+            observer.join()
+            self.writer.close()
 
 
 # 清理舊 CSV 文件
 
 
-def cleanup_csv_files(folder, keep_count=10):
-    """清理資料夾內的舊 CSV 文件，只保留最新的 `keep_count` 個"""
+def cleanup_csv_files(folder, keep_count=10, ingested=None):
+    """清理資料夾內的舊 CSV 文件，只保留最新的 `keep_count` 個，尚未匯入的檔案不會刪除
+
+    回傳已刪除的檔案清單
+    """
+    removed = []
     try:
         # 獲取資料夾內的所有 CSV 文件，按修改時間排序
         csv_files = glob.glob(os.path.join(folder, "*.csv"))
@@ -46,38 +212,17 @@ def cleanup_csv_files(folder, keep_count=10):
         if len(csv_files) > keep_count:
             old_files = csv_files[keep_count:]  # 超過的文件
             for file in old_files:
+                if ingested is not None and os.path.normcase(os.path.abspath(file)) not in ingested:
+                    continue
                 os.remove(file)
+                removed.append(file)
                 print(f"已刪除舊文件：{file}")
         else:
             print("沒有需要刪除的文件，所有文件均在保留範圍內。")
     except Exception as e:
         print(f"清理舊文件時發生錯誤：{e}")
+    return removed
 
 
-# 啟動檔案監控
-event_handler = NewCSVHandler()
-observer = Observer()
-observer.schedule(event_handler, watch_folder, recursive=False)
-observer.start()
-
-try:
-    print(f"監控資料夾：{watch_folder}")
-    while True:
-        pass  # 持續監控
-except KeyboardInterrupt:
-    observer.stop()
-observer.join()
-
-# 添加清理任務
-schedule.every().day.at("03:08").do(
-    cleanup_csv_files, folder=watch_folder, keep_count=10)
-
-# 主循環添加調度執行
-try:
-    print(f"監控資料夾：{watch_folder}")
-    while True:
-        schedule.run_pending()  # 執行定時任務
-        time.sleep(1)  # 每秒檢查一次
-except KeyboardInterrupt:
-    observer.stop()
-observer.join()
+if __name__ == "__main__":
+    CSVIngestor().run()
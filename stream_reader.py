@@ -0,0 +1,318 @@
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import cv2
+
+from metrics import registry
+
+
+def open_capture(url, open_timeout=10.0, read_timeout=5.0):
+    """開啟串流並設定開啟與讀取逾時，卡住的連線不會讓 read()/grab() 永遠停住"""
+    timeouts = [
+        cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(1000 * open_timeout),
+        cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(1000 * read_timeout),
+    ]
+    return cv2.VideoCapture(url, cv2.CAP_ANY, timeouts)
+
+
+class LatestFrameReader(object):
+    """背景執行緒持續讀取串流，只保留最新的影像給分析端"""
+
+    def __init__(self, cap, maxlen=1, max_age=1.0, sampler=None, camera="default"):
+        # cap: cv2.VideoCapture 或任何提供 read()/isOpened()/release() 的物件
+        # maxlen: 交給分析端的緩衝長度，超過即丟棄最舊的影像
+        # max_age: 影像在緩衝內超過此秒數即視為過期
+        # sampler: 提供 due(now) 的取樣器，設定時每張影像都 grab()，只有需要分析的才 retrieve()
+        #          此時 cap 也必須提供 grab()/retrieve()
+        self.cap = cap
+        self.max_age = max_age
+        self.sampler = sampler
+        self.camera = camera  # 指標的 camera 標籤
+        self.buffer = deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.finished = False
+        self.orphaned = False
+
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.frames_stale = 0
+        self.read_failures = 0
+        self.frames_skipped = 0
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def _capture_loop(self):
+        while self.running and self.cap.isOpened():
+            started = time.perf_counter()
+            if self.sampler is None:
+                status, frame = self.cap.read()
+            else:
+                # 不需要分析的影像只 grab() 維持串流同步，跳過 retrieve() 的色彩轉換與複製（FFmpeg 後端 grab() 仍會解碼）
+                status, frame = self.cap.grab(), None
+                if status:
+                    if not self.sampler.due(time.monotonic()):
+                        self.frames_skipped += 1
+                        continue
+                    started = time.perf_counter()
+                    status, frame = self.cap.retrieve()
+            if not status or frame is None:
+                self.read_failures += 1
+                with self.cond:
+                    self.cond.notify_all()
+                time.sleep(0.01)
+                continue
+
+            registry.observe(
+                "stage_seconds", time.perf_counter() - started, stage="decode", camera=self.camera
+            )
+            with self.cond:
+                self.frames_read += 1
+                # 緩衝已滿時 deque 會自動丟掉最舊的一張
+                if len(self.buffer) == self.buffer.maxlen:
+                    self.frames_dropped += 1
+                self.buffer.append((time.monotonic(), frame))
+                self.cond.notify_all()
+
+        self.running = False
+        with self.cond:
+            self.finished = True
+            orphaned = self.orphaned
+            self.cond.notify_all()
+        if orphaned:
+            self.cap.release()  # release() 等待逾時，由擷取執行緒自己釋放
+
+    def wait_frame(self, timeout):
+        """等待第一張影像，用於確認新連線確實有畫面"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.frames_read == 0 and self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.frames_read > 0
+
+    def read(self, timeout=5.0):
+        """取得最新影像，介面與 cv2.VideoCapture.read() 相同"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                while self.buffer:
+                    captured_at, frame = self.buffer.popleft()
+                    if time.monotonic() - captured_at > self.max_age:
+                        self.frames_stale += 1
+                        continue
+                    return True, frame
+
+                remaining = deadline - time.monotonic()
+                if not self.running or remaining <= 0:
+                    return False, None
+                self.cond.wait(remaining)
+
+    def isOpened(self):
+        return self.running and self.cap.isOpened()
+
+    def release(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+            with self.cond:
+                if not self.finished:
+                    # 擷取執行緒仍卡在 read()，不能從其他執行緒釋放 VideoCapture，留給它結束時釋放
+                    self.orphaned = True
+                    return
+        self.cap.release()
+        with self.cond:
+            self.buffer.clear()
+
+    def stats(self):
+        return {
+            "frames_read": self.frames_read,
+            "frames_dropped": self.frames_dropped,
+            "frames_stale": self.frames_stale,
+            "read_failures": self.read_failures,
+            "frames_skipped": self.frames_skipped,
+            "buffered": len(self.buffer),
+        }
+
+
+class Backoff(object):
+    """指數退避加隨機抖動，多台攝影機同時斷線時不會在同一時間一起重連"""
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0, jitter=0.5):
+        # jitter: 每次等待時間隨機縮短的最大比例
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class StreamSession(object):
+    """串流連線管理，介面與 LatestFrameReader 相同，斷線時由背景執行緒重連
+
+    - 超過 read_timeout 秒沒有新影像或擷取端結束即視為斷線
+    - 以 Backoff 的間隔重試，新連線收到第一張影像後才切換，分析端在重連期間照常執行
+    - 斷線期間記錄為 (開始, 結束, 原因)，由 pop_gaps() 取出寫入資料庫
+    - 分析端的視窗與校正狀態都在 Dust_Monitor，重連不會清除
+    """
+
+    def __init__(self, open_reader, url, read_timeout=5.0, open_timeout=10.0, backoff=None,
+                 camera="default"):
+        # open_reader: url -> 已 start() 的 LatestFrameReader
+        self.open_reader = open_reader
+        self.url = url
+        self.read_timeout = read_timeout
+        self.open_timeout = open_timeout
+        self.backoff = backoff or Backoff()
+        self.camera = camera
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.reader = None
+        self.pending = None  # 背景開好、尚未切換的新連線
+        self.connector = None
+        self.last_frame = time.monotonic()
+        self.last_frame_time = datetime.now()
+        self.outage = None  # (開始時間, 原因)，第一次連線不算斷線
+        self.gaps = []
+
+        self.sessions = 0
+        self.reconnects = 0
+        self.connect_failures = 0
+
+    def start(self):
+        self._connect()
+        return self
+
+    def _connect(self):
+        # 已有連線中或開好等待切換的新連線時不重複開啟
+        if self.pending is None and (self.connector is None or not self.connector.is_alive()):
+            self.ready.clear()
+            self.connector = threading.Thread(target=self._connect_loop, daemon=True)
+            self.connector.start()
+
+    def _connect_loop(self):
+        while not self.stop_event.is_set():
+            reader = None
+            try:
+                reader = self.open_reader(self.url)
+                if reader.wait_frame(self.open_timeout):
+                    with self.lock:
+                        if not self.stop_event.is_set():
+                            self.pending, reader = reader, None
+                    self.backoff.reset()
+                    self.ready.set()
+                    return
+                print("{} 串流沒有畫面：{}".format(self.camera, self.url))
+            except Exception as e:
+                print("{} 串流連線失敗：{}".format(self.camera, e))
+            finally:
+                if reader is not None:
+                    reader.release()
+            self.connect_failures += 1
+            self.stop_event.wait(self.backoff.next())
+
+    def _swap(self):
+        with self.lock:
+            if self.pending is None:
+                return
+            old, self.reader, self.pending = self.reader, self.pending, None
+            self.sessions += 1
+        self.last_frame = time.monotonic()
+        if old is not None:
+            # 卡住的連線可能要等到讀取逾時才能釋放，不在分析端等待
+            threading.Thread(target=old.release, daemon=True).start()
+
+    def _fail(self, reason):
+        if self.stop_event.is_set():
+            return
+        if self.outage is None:
+            self.outage = (self.last_frame_time, reason)
+            self.reconnects += 1
+            registry.inc("reconnects_total", camera=self.camera)
+            print("{} 串流中斷（{}），背景重新連線".format(self.camera, reason))
+        self._connect()
+
+    def read(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            self._swap()
+            reader = self.reader
+            remaining = max(deadline - time.monotonic(), 0)
+            if reader is None or (self.outage is not None and not reader.isOpened()):
+                # 等待背景重連，不在已結束的連線上空轉
+                if self.stop_event.is_set() or not self.ready.wait(remaining):
+                    return False, None
+                continue
+
+            # 分段等待，卡住時能及時發現，新連線開好也能及時切換
+            status, frame = reader.read(min(remaining, 0.1))
+            now = time.monotonic()
+            if status:
+                self.last_frame = now
+                self.last_frame_time = datetime.now()
+                if self.outage is not None:
+                    self.gaps.append((self.outage[0], self.last_frame_time, self.outage[1]))
+                    self.outage = None
+                return True, frame
+
+            if not reader.isOpened():
+                self._fail("closed")
+            elif now - self.last_frame > self.read_timeout:
+                self._fail("stall")
+            if now >= deadline:
+                return False, None
+
+    def pop_gaps(self):
+        """取出已結束的斷線區間 [(開始, 結束, 原因)]"""
+        gaps, self.gaps = self.gaps, []
+        return gaps
+
+    def isOpened(self):
+        # 重連期間仍視為開啟，只有 release() 之後才結束
+        return not self.stop_event.is_set()
+
+    def release(self):
+        self.stop_event.set()
+        if self.connector is not None and self.connector is not threading.current_thread():
+            self.connector.join(timeout=self.open_timeout + 2)
+        with self.lock:
+            readers, self.reader, self.pending = [self.reader, self.pending], None, None
+        for reader in readers:
+            if reader is not None:
+                reader.release()
+        if self.outage is not None:
+            self.gaps.append((self.outage[0], datetime.now(), self.outage[1]))
+            self.outage = None
+
+    def stats(self):
+        stats = self.reader.stats() if self.reader is not None else {}
+        stats.update(
+            {
+                "connected": self.outage is None and self.reader is not None,
+                "sessions": self.sessions,
+                "reconnects": self.reconnects,
+                "connect_failures": self.connect_failures,
+            }
+        )
+        return stats
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 程式模組都在專案根目錄，測試時直接匯入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+import sqlite3
+
+import pytest
+
+from db_writer import ensure_dust_table
+from dust_store import DustDataCache
+
+
+def test_refresh_recovers_after_table_is_created(tmp_path):
+    # 寫入端還沒建立資料表時讀取失敗，建立之後同一個快取要能繼續使用
+    db_path = str(tmp_path / "dust_data.db")
+    sqlite3.connect(db_path).close()
+    cache = DustDataCache(db_path)
+
+    with pytest.raises(ValueError):
+        cache.refresh()
+    assert cache.conn is None
+
+    conn = sqlite3.connect(db_path)
+    ensure_dust_table(conn)
+    conn.execute('INSERT INTO "dust_data" VALUES (?, ?, ?)', ("2024-12-03 02:05:01", 12.5, None))
+    conn.commit()
+    conn.close()
+
+    df = cache.refresh()
+    assert list(df["Dust_Level"]) == [12.5]
+    cache.close()
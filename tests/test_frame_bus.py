@@ -0,0 +1,45 @@
+import queue
+import threading
+
+import numpy as np
+
+import frame_bus
+
+
+class FakeCapture(object):
+    """依序回傳指定大小的影像，模擬串流中途改變解析度"""
+
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+        self.released = False
+
+    def read(self):
+        return True, np.zeros(self.shapes.pop(0), dtype=np.uint8)
+
+    def grab(self):
+        return bool(self.shapes)
+
+    def retrieve(self, slot):
+        shape = self.shapes.pop(0)
+        if shape == slot.shape:
+            slot[:] = 1
+            return True, slot
+        return True, np.ones(shape, dtype=np.uint8)
+
+    def release(self):
+        self.released = True
+
+
+def test_capture_stops_when_resolution_changes(monkeypatch):
+    small, large = (4, 6, 3), (8, 12, 3)
+    cap = FakeCapture([small, small, small, large, large])
+    monkeypatch.setattr(frame_bus, "open_capture", lambda *args: cap)
+    ready_queue, stop_event = queue.Queue(), threading.Event()
+
+    frame_bus.capture_process("rtsp://test", None, ready_queue, stop_event, slots=2)
+
+    assert ready_queue.get_nowait() == small
+    assert ready_queue.get_nowait() == large
+    # 改變後的影像不再讀取，擷取行程結束並釋放串流
+    assert cap.shapes == [large]
+    assert cap.released
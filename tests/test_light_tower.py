@@ -0,0 +1,81 @@
+import pytest
+
+from light_tower import LightTowerController, LoopbackDriver, SerialDriver
+
+
+def make_controller(**kwargs):
+    driver = LoopbackDriver()
+    kwargs.setdefault("stale_seconds", 0)
+    return LightTowerController(driver, yellow_line=45, red_line=60, **kwargs), driver
+
+
+def commands(driver):
+    return [data for _, data in driver.written]
+
+
+def test_hysteresis_holds_red_until_below_line_minus_margin():
+    controller, driver = make_controller(hysteresis=5)
+    controller.step(0, value=30)
+    controller.step(1, value=61)
+    assert controller.level == 2
+    # 低於紅線但仍在遲滯範圍內，維持紅燈
+    controller.step(2, value=57)
+    assert controller.level == 2
+    controller.step(3, value=54)
+    assert controller.level == 1
+    assert commands(driver) == [b"0", b"1", b"0"]
+
+
+def test_debounce_requires_level_to_persist():
+    controller, driver = make_controller(debounce=10)
+    controller.step(0, value=30)
+    controller.step(1, value=70)
+    # 短暫的突波在去彈跳時間內消失，不亮燈
+    controller.step(5, value=30)
+    controller.step(20)
+    assert controller.level == 0
+    controller.step(30, value=70)
+    controller.step(35, value=70)
+    assert controller.level == 0
+    controller.step(40)
+    assert controller.level == 2
+    assert commands(driver) == [b"0", b"1"]
+
+
+def test_relay_written_only_on_change():
+    controller, driver = make_controller()
+    for t, value in enumerate([70, 71, 72, 30, 31]):
+        controller.step(t, value=value)
+    assert commands(driver) == [b"1", b"0"]
+    assert controller.stats()["commands_sent"] == 2
+
+
+def test_stale_camera_is_ignored():
+    controller, driver = make_controller(stale_seconds=30)
+    controller.step(0, "BC6", 70)
+    controller.step(1, "BC7", 20)
+    assert controller.level == 2
+    # BC6 停止回報，過期後只剩 BC7 的讀數
+    controller.step(20, "BC7", 20)
+    assert controller.level == 2
+    controller.step(31)
+    assert controller.level == 0
+    assert commands(driver) == [b"1", b"0"]
+
+
+def test_thread_applies_updates():
+    controller, driver = make_controller()
+    controller.start()
+    controller.update(70)
+    controller.close()
+    assert commands(driver) == [b"1"]
+    assert not driver.opened
+
+
+def test_incomplete_driver_cannot_be_created():
+    class WriteOnly(SerialDriver):
+        def write(self, data):
+            pass
+
+    with pytest.raises(TypeError):
+        WriteOnly()
@@ -0,0 +1,146 @@
+from collections import deque
+
+import numpy as np
+
+WINDOW_MODES = ("tumbling", "sliding", "ewma")
+
+
+class WindowStats(object):
+    """固定大小環狀緩衝的串流統計，每張影像 O(1) 更新總和、平均、變異數、最小與最大值
+
+    mode:
+        tumbling：每 size 張輸出一次平均後清空（原本的做法）
+        sliding：滿 size 張後每 step 張輸出最近 size 張的平均
+        ewma：指數加權平均，暖機 size 張後每 step 張輸出一次
+    """
+
+    def __init__(self, size=70, mode="tumbling", step=None, alpha=None):
+        if mode not in WINDOW_MODES:
+            raise ValueError("未知的視窗模式：{}".format(mode))
+        if size < 1:
+            raise ValueError("視窗大小必須大於 0")
+        self.size = size
+        self.mode = mode
+        if mode == "tumbling":
+            self.step = size
+        else:
+            self.step = step or max(size // 10, 1)
+        self.alpha = alpha or 2.0 / (size + 1)
+        self.buffer = np.zeros(size, dtype=np.float64)
+        self.reset()
+
+    @classmethod
+    def from_config(cls, window_config=None, size=70):
+        window_config = window_config or {}
+        return cls(
+            window_config.get("size", size),
+            window_config.get("mode", "tumbling"),
+            window_config.get("step"),
+            window_config.get("alpha"),
+        )
+
+    def reset(self):
+        self.index = 0
+        self.count = 0
+        self.pushed = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.ewma = None
+        self.ewm_var = 0.0
+        # 單調佇列 (序號, 值)，最小/最大值攤銷 O(1)
+        self.min_queue = deque()
+        self.max_queue = deque()
+
+    def push(self, value):
+        """加入一筆數值，到達輸出時機時回傳目前的平均，否則回傳 None"""
+        value = float(value)
+        seq = self.pushed
+        self.pushed += 1
+
+        if self.count == self.size:
+            old = float(self.buffer[self.index])
+            self.total -= old
+            self.total_sq -= old * old
+        else:
+            self.count += 1
+        self.buffer[self.index] = value
+        self.total += value
+        self.total_sq += value * value
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # 每繞一圈重算一次總和，避免加減累積浮點誤差
+            self.total = float(self.buffer.sum())
+            self.total_sq = float(np.dot(self.buffer, self.buffer))
+
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append((seq, value))
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append((seq, value))
+        expired = seq - self.size
+        if self.min_queue[0][0] <= expired:
+            self.min_queue.popleft()
+        if self.max_queue[0][0] <= expired:
+            self.max_queue.popleft()
+
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            diff = value - self.ewma
+            self.ewma += self.alpha * diff
+            self.ewm_var = (1 - self.alpha) * (self.ewm_var + self.alpha * diff * diff)
+
+        if self.mode == "tumbling":
+            if self.count == self.size:
+                mean = self.mean
+                self.reset()
+                return mean
+            return None
+        if self.pushed >= self.size and (self.pushed - self.size) % self.step == 0:
+            return self.mean
+        return None
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+    @property
+    def mean(self):
+        if self.mode == "ewma":
+            return self.ewma
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    @property
+    def variance(self):
+        if self.mode == "ewma":
+            return self.ewm_var
+        if self.count == 0:
+            return None
+        mean = self.total / self.count
+        return max(self.total_sq / self.count - mean * mean, 0.0)
+
+    @property
+    def min(self):
+        return self.min_queue[0][1] if self.min_queue else None
+
+    @property
+    def max(self):
+        return self.max_queue[0][1] if self.max_queue else None
+
+
+def mean_bounds(values, size=100):
+    """以滑動視窗計算移動平均的最大與最小值，作為正規化的上下界"""
+    window = WindowStats(size, "sliding", step=1)
+    high, low = None, None
+    for value in values:
+        mean = window.push(value)
+        if mean is not None:
+            high = mean if high is None else max(high, mean)
+            low = mean if low is None else min(low, mean)
+    if high is None:
+        raise ValueError("資料筆數少於視窗大小")
+    return {"max": high, "min": low}